@@ -1,11 +1,12 @@
 from Multilevel_LM.main_lm.params_options import LMTR_params_options
-from Multilevel_LM.main_lm.loss_poisson import loss_solving_poisson,compute_loss_gradients
-from Multilevel_LM.main_lm.subsolver_poisson import Taylor_solver,sub_A_solving_poisson,sub_b_solving_poisson
+from Multilevel_LM.main_lm.iteration_state import PoissonIterationState
+from Multilevel_LM.main_lm.step_solvers import compute_lm_step,KrylovRecycler,forcing_term
+from Multilevel_LM.main_lm.varpro import VarProState,eliminate_output_layer
+from Multilevel_LM.main_lm.neural_network_construction import FunctionalModel,to_functional_model
+from Multilevel_LM.main_lm.target_data import poisson_target
+from Multilevel_LM.main_lm.collocation import collocation_set
 import torch
 import copy
-from scipy.sparse.linalg import cg, LinearOperator,splu
-import numpy as np
-from scipy.sparse import csc_matrix
 
 
 
@@ -16,7 +17,10 @@ def flatten_parameters(model):
     return torch.cat([param.view(-1) for param in model.parameters()])
 
 # Unflatten the new parameters and update the model, then return the updated model
+# For a FunctionalModel, the new model is just theta + s, without any copy of the module
 def update_model_parameters(model, s):
+    if isinstance(model, FunctionalModel):
+        return model, model.step(s)
     model_new = copy.deepcopy(model)
     # Flatten the current model parameters
     flattened_params = flatten_parameters(model_new)
@@ -55,10 +59,36 @@ def update_model_parameters(model, s):
 
         
         
-def LMTR_solving_poisson(real_solution,model,x,lambdak,regularization=True,lambdap=0.1):
-    fk = loss_solving_poisson(real_solution, model, x)
+def LMTR_solving_poisson(real_solution,model,x,lambdak,regularization=True,lambdap=0.1,options=None,return_model=False):
+    """
+    model can be an nn.Module or a FunctionalModel, the iterates are FunctionalModel.
+    Returns model(x) of the final model, or the final FunctionalModel if return_model is True.
+    """
+    if options is None:
+        options = LMTR_params_options()
+    #one dtype (options.dtype, or the one of the model) for the parameters, the points and the solves
+    model = to_functional_model(model,options.dtype)
+    #x can be a tensor or a CollocationSet (e.g. a point cloud with its sdf)
+    x = collocation_set(x).to(model.theta.dtype).x
+    #f and the boundary values of the real solution, computed once per grid
+    real_solution = poisson_target(real_solution,options.target_expression,options.target_cache_dir)
+    #F1, J1, F2, J2, loss and gradient of the current model, computed once per accepted model
+    #VarPro needs J for the projection, then 'matrix_free' is CG on the products of the Kaufman Jacobian
+    state = PoissonIterationState(real_solution,model,x,regularization=True,lambdap=0.1,
+                                  matrix_free=options.step_solver == 'matrix_free' and not options.varpro)
+    
+    if options.varpro:
+        #least squares initialization of the output layer
+        state = eliminate_output_layer(state)
+        model = state.model
+    
+    #Ritz vectors of the CG solves, recycled from one iteration to the next
+    recycler = KrylovRecycler(options.recycle_dim) if options.recycle_dim > 0 else None
+    #forcing term of the inexact step, updated when the gradient changes
+    grad_norm = torch.norm(state.gradient)
+    tol = forcing_term(options,grad_norm)
+    prev_forcing = None
     
-    options = LMTR_params_options()
     eta1 = options.eta1
     eta2 = options.eta2
     gamma1 = options.gamma1
@@ -68,10 +98,14 @@ def LMTR_solving_poisson(real_solution,model,x,lambdak,regularization=True,lambd
     epsilon = options.epsilon
     max_iter = 100
     k=0
-    while torch.norm(compute_loss_gradients(real_solution,model,x,regularization=True,lambdap = 0.1))>=epsilon and k<=max_iter:
-        #print(torch.norm(compute_loss_gradients(real_solution,model,x,regularization=True,lambdap = 0.1))) 
+    while grad_norm>=epsilon and k<=max_iter:
+        #print(torch.norm(state.gradient)) 
         
-        A = sub_A_solving_poisson(real_solution,model,x,lambdak)
+        #solve As = b, where A = sub_A and b = -sub_b, with the solver options.step_solver
+        #with VarPro, only in the hidden parameters, the output layer is then eliminated again
+        sub_state = VarProState(state) if options.varpro else state
+        s_sub, info = compute_lm_step(sub_state,lambdak,options,recycler=recycler,tol=tol)
+        s = sub_state.full_step(s_sub) if options.varpro else s_sub
         #check the reason why CG didn't converge
         #check if A is poor conditioning
         #AA = A @ A.T
@@ -99,10 +133,8 @@ def LMTR_solving_poisson(real_solution,model,x,lambdak,regularization=True,lambd
         
 
 
-        b = (-1)*sub_b_solving_poisson(real_solution,model,x,lambdak)
         #A_sparse = csc_matrix(A.detach().numpy())
         
-        s = np.linalg.solve(A.detach().numpy(),b.detach().numpy().flatten())
         #try:
         #    s,info = cg(A.detach().numpy(),b.detach().numpy().flatten())
         #    if info > 0:
@@ -113,36 +145,118 @@ def LMTR_solving_poisson(real_solution,model,x,lambdak,regularization=True,lambd
         #    break
     
         
-        s = torch.tensor(s)
         new_model = update_model_parameters(model, s)[1]
-        fks = loss_solving_poisson(real_solution, new_model, x)
-        mks = Taylor_solver(real_solution,model,x,lambdak,s)
-        fk = loss_solving_poisson(real_solution, model, x)
+        #only the residuals of the trial model are evaluated, its Jacobians are built if it is accepted
+        new_state = state.new_state(new_model)
+        if options.varpro:
+            new_state = eliminate_output_layer(new_state)
+            new_model = new_state.model
+        fks = new_state.loss
+        fk = state.loss
         #print(fk)
-        mk = Taylor_solver(real_solution, model, x, lambdak, torch.zeros(sum(p.numel() for p in model.parameters())))
-        #print(mk)
+        #mk-mks, i.e. sub_state.taylor(0,lambdak)-sub_state.taylor(s_sub,lambdak)
+        pred = sub_state.predicted_reduction(s_sub,lambdak)
         ared = fk-fks
-        pred = mk-mks
         
-        pho = ared/pred
         #print(pho)
         print(fk)
         
-        if pred == 0 :
-            print("pred = 0")
-        
+        if pred <= 0:
+            #no predicted decrease (e.g. an inexact or sketched step), the step is rejected
+            print("pred <= 0")
+            lambdak = gamma3*lambdak
+            prev_forcing = None
+            tol = forcing_term(options,grad_norm)
         else:
-       
-    
+            pho = ared/pred
             if pho >= eta1:
                 model = new_model
+                state = new_state
+                prev_grad_norm, grad_norm = grad_norm, torch.norm(state.gradient)
+                tol = forcing_term(options,grad_norm,prev_grad_norm,prev_forcing)
+                prev_forcing = tol
                 if pho >= eta2:
                     lambdak = max(lambda_min,gamma2*lambdak)
                 else:
                     lambdak = max(lambda_min,gamma1*lambdak)
             else:
+                #the model does not change, so the state (and its Jacobians) is reused
                 model = model
                 lambdak = gamma3*lambdak
+                #the forcing term starts again from sqrt(||g_k||), without the safeguard
+                prev_forcing = None
+                tol = forcing_term(options,grad_norm)
             
         k+=1
+    if return_model:
+        return model
     return model(x)
+
+
+def sample_rows(n, size, sampling='random'):
+    """
+    size indices out of range(n), without replacement:
+        - 'random': uniform,
+        - 'stratified': range(n) is split into size equal strata, and one index
+          is drawn uniformly in each, so the sample covers the whole grid.
+    """
+    size = min(max(size,1),n)
+    if sampling == 'stratified':
+        edges = torch.linspace(0,n,size+1)
+        return torch.minimum((edges[:-1]+torch.rand(size)*(edges[1:]-edges[:-1])).long(),torch.tensor(n-1))
+    return torch.randperm(n)[:size]
+
+
+def LMTR_subsampled_poisson(real_solution,model,x,lambdak,regularization=True,lambdap=0.1,options=None,return_model=False):
+    """
+    Subsampled LMTR for large collocation sets. Each iteration draws a sample 
+    of options.batch_size of the interior rows and of the boundary rows 
+    (options.sampling), and the step, the loss reduction and the ratio pho 
+    are computed on the sample only (PoissonIterationState.subsample).
+    After an unsuccessful step (pho < eta1), the sample grows by the factor 
+    options.batch_growth as well as lambdak increases. Once the sample is 
+    the full set or the gradient of the sample is small, LMTR_solving_poisson 
+    runs on the full set, which is the final convergence check.
+    
+    Returns model(x) of the final model, or the final FunctionalModel if return_model is True.
+    """
+    if options is None:
+        options = LMTR_params_options()
+    #one dtype (options.dtype, or the one of the model) for the parameters, the points and the solves
+    model = to_functional_model(model,options.dtype)
+    #x can be a tensor or a CollocationSet (e.g. a point cloud with its sdf)
+    x = collocation_set(x).to(model.theta.dtype).x
+    #f and the boundary values of the real solution, computed once per grid
+    real_solution = poisson_target(real_solution,options.target_expression,options.target_cache_dir)
+    state = PoissonIterationState(real_solution,model,x,regularization=True,lambdap=0.1,
+                                  matrix_free=options.step_solver == 'matrix_free')
+    n_interior = torch.arange(state.functionals[1][0].shape[0])[state.loss_rows].numel()
+    n_boundary = state.functionals[3][0].shape[0]
+    batch_size = options.batch_size
+    max_iter = 100
+    k = 0
+    while batch_size < 1 and k <= max_iter:
+        sub_state = state.subsample(sample_rows(n_interior,round(batch_size*n_interior),options.sampling),
+                                    sample_rows(n_boundary,round(batch_size*n_boundary),options.sampling))
+        if torch.norm(sub_state.gradient) < options.epsilon:
+            break
+        s = compute_lm_step(sub_state,lambdak,options)[0]
+        new_model = model.step(s)
+        ared = sub_state.loss-sub_state.new_state(new_model).loss
+        pred = sub_state.predicted_reduction(s,lambdak)
+        #no predicted decrease, the step is rejected as an unsuccessful one
+        pho = ared/pred if pred > 0 else 0
+        if pho >= options.eta1:
+            model = new_model
+            state = state.new_state(model)
+            if pho >= options.eta2:
+                lambdak = max(options.lambda_min,options.gamma2*lambdak)
+            else:
+                lambdak = max(options.lambda_min,options.gamma1*lambdak)
+        else:
+            #the model of the sample is not reliable, a larger sample reduces its variance
+            lambdak = options.gamma3*lambdak
+            batch_size = min(1,options.batch_growth*batch_size)
+        k += 1
+    #full-batch LMTR from the last iterate
+    return LMTR_solving_poisson(real_solution,model,x,lambdak,regularization,lambdap,options,return_model)
@@ -3,8 +3,8 @@
 """
 In this file, we gave the PoissonPDE class, which is aimed to calculate 
 the source term.
-i.e. once we know the real solution u(x), (x could be in 1d or 2d), 
-we want to get the f = -\laplacian u(x).
+i.e. once we know the real solution u(x), (x could be in any dimension, 
+e.g. 1d, 2d or 3d), we want to get the f = -\laplacian u(x).
 
 """
 import torch
@@ -17,7 +17,7 @@ class PoissonPDE:
 
         Parameters:
         - real_solution: Function that provides the true solution of the PDE.
-        - dim: Dimensionality of the input (1 or 2).
+        - x: Input tensor of size (N, input_dim), for any input_dim.
         """
         self.real_solution = real_solution
         self.x = x
@@ -27,17 +27,14 @@ class PoissonPDE:
         Compute the source term for the PDE given the input.
 
         Parameters:
-        - x: Input tensor (1D or 2D grid)
+        - x: Input tensor (1D, 2D, 3D, ... grid)
 
         Returns:
         - source_term: Computed source term
         """
         if self.x.size(1) == 1:
             return self._compute_1d_source_term(x)
-        elif self.x.size(1) == 2:
-            return self._compute_2d_source_term(x)
-        else:
-            raise ValueError("Unsupported dimensionality")
+        return self._compute_nd_source_term(x)
 
     def _compute_1d_source_term(self, x):
         """
@@ -49,6 +46,8 @@ class PoissonPDE:
         Returns:
         - source_term: Computed source term for 1D
         """
+        if hasattr(self.real_solution, 'forward_taylor'):
+            return self._compute_nn_source_term(x)
         x.requires_grad_(True)
         output = self.real_solution(x)
         grad1 = torch.autograd.grad(outputs=output, inputs=x,
@@ -62,29 +61,55 @@ class PoissonPDE:
 
     def _compute_2d_source_term(self, x):
         """
-        Compute the source term for 2D PDE.
+        Compute the source term for 2D PDE, see _compute_nd_source_term.
+        """
+        return self._compute_nd_source_term(x)
+
+    def _compute_nd_source_term(self, x):
+        """
+        Compute the source term for a PDE in any dimension, the Laplacian is
+        the sum of the second derivatives over the x.shape[1] coordinates.
 
         Parameters:
-        - x: 2D input tensor
+        - x: input tensor of size (N, input_dim)
 
         Returns:
-        - source_term: Computed source term for 2D
+        - source_term: Computed source term of size (N,)
         """
+        if hasattr(self.real_solution, 'forward_taylor'):
+            return self._compute_nn_source_term(x).reshape(-1)
         x.requires_grad_(True)
         output = self.real_solution(x)
         grad1 = torch.autograd.grad(outputs=output, inputs=x,
                                     grad_outputs=torch.ones_like(output),
                                     create_graph=True)[0]
         grad2 = []
-        for i in range(2):
+        for i in range(x.shape[1]):
+            #only keep the diagonal entry d^2u/dx_i^2 of the Hessian row
             grad2_i = torch.autograd.grad(outputs=grad1[:, i], inputs=x,
                                           grad_outputs=torch.ones_like(grad1[:, i]),
-                                          create_graph=True)[0]
+                                          create_graph=True)[0][:, i]
             grad2.append(grad2_i)
         grad2 = torch.stack(grad2, dim=-1)
         source_term = -torch.sum(grad2, dim=-1)  # Sum over spatial dimensions
         return source_term
 
+    def _compute_nn_source_term(self, x):
+        """
+        Compute the source term when the solution is a network with a 
+        Taylor-mode forward pass (e.g. FullyConnectedNN), so the Laplacian 
+        comes without nested torch.autograd.grad calls.
+
+        Parameters:
+        - x: Input tensor (1D, 2D, 3D, ... grid)
+
+        Returns:
+        - source_term: Computed source term of size (N, 1)
+        """
+        u, grad_u, laplacian_u = self.real_solution.forward_taylor(x)
+        source_term = -laplacian_u
+        return source_term
+
 
 
 
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In this file, we gave the CollocationSet class, i.e. the collocation points x
+with their interior and boundary indices, the numbers of samples of the loss
+and the quadrature weights, computed once when the set is built instead of
+rescanning x (get_2d_boundary) and recomputing sample_num in every function.
+
+The boundary points are found by
+    - a bounding box test for a tensor-product grid (the uniform grids of the
+      tests, also non-square ones),
+    - a signed distance function sdf (negative inside the domain), i.e. the
+      points with |sdf(x)| <= tol, for any domain,
+    - otherwise (point cloud), a KD-tree test on the nearest neighbours of
+      each point, see _kdtree_boundary. It finds the boundary of a grid-like
+      cloud, but a random cloud has holes which look like boundary, so an sdf
+      is the better choice when the domain is known.
+
+collocation_set(x) gives the set of the tensor x, built once and reused as long
+as x is alive and not modified in place. The cache only holds a weak reference 
+to x and the attributes of its set without x, so it does not keep x alive.
+"""
+import weakref
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+
+#id(x) -> (weak reference to x, version of x, attributes of the CollocationSet but x)
+_COLLOCATION_SETS = {}
+
+
+def _grid_shape(x):
+    """
+    Number of points per direction if x is a tensor-product grid, None otherwise.
+    """
+    shape = tuple(torch.unique(x[:,i]).numel() for i in range(x.shape[1]))
+    return shape if int(np.prod(shape)) == x.shape[0] else None
+
+
+def _kdtree_boundary(x, k=None, max_gap=0.75*np.pi):
+    """
+    Boundary mask of a point cloud from its k nearest neighbours (KD-tree).
+    In 2D, a point is on the boundary when the directions to its neighbours 
+    leave an angular gap larger than max_gap (it is pi on a straight edge, 
+    pi/4 inside a uniform grid). In other dimensions, when the centroid of 
+    its neighbours is away from it by more than a quarter of their mean 
+    distance, i.e. the neighbours are on one side.
+    """
+    points = x.detach().cpu().double().numpy()
+    k = min(12 if k is None else k,points.shape[0]-1)
+    dist, idx = cKDTree(points).query(points,k=k+1)
+    offsets = points[idx[:,1:]]-points[:,None,:]
+    if points.shape[1] == 2:
+        angles = np.sort(np.arctan2(offsets[...,1],offsets[...,0]),axis=1)
+        gaps = np.diff(np.concatenate([angles,angles[:,:1]+2*np.pi],axis=1),axis=1)
+        return torch.from_numpy(gaps.max(1) > max_gap)
+    return torch.from_numpy(np.linalg.norm(offsets.mean(1),axis=1) > 0.25*dist[:,1:].mean(1))
+
+
+class CollocationSet:
+    def __init__(self, x, sdf=None, boundary=None, tol=None, k=None):
+        """
+        Split the points into interior and boundary, and set the bookkeeping of
+        the loss.
+
+        Parameters:
+        - x: collocation points of size (N, input_dim).
+        - sdf: signed distance function of the domain, sdf(x) of size (N,),
+          negative inside. None means a bounding box test for a grid and a
+          KD-tree test for a point cloud.
+        - boundary: indices (or boolean mask) of the boundary points, if known.
+        - tol: tolerance of the box and sdf tests, None means 100 times the
+          machine epsilon of x times the size of the domain.
+        - k: number of neighbours of the KD-tree test, None means 12.
+
+        Attributes:
+        - interior, boundary: index tensors of the points.
+        - n_interior, n_boundary: numbers of points.
+        - sample_num, boundary_num: the numbers which divide the interior and
+          the boundary rows in the LM model (sub_A, sub_b, Taylor_solver).
+        - loss_rows, loss_boundary_num: rows of F1 and number of boundary rows
+          in the loss (loss_solving_poisson).
+        - interior_weights, boundary_weights: quadrature weights of the rows of
+          F1 and F2 in the loss.
+        """
+        self.x = x
+        self.grid_shape = _grid_shape(x)
+        n, input_dim = x.shape
+        if tol is None:
+            tol = 100*torch.finfo(x.dtype).eps*float((x.max(0).values-x.min(0).values).max())
+        if boundary is not None:
+            mask = torch.zeros(n,dtype=torch.bool)
+            mask[torch.as_tensor(boundary)] = True
+        elif input_dim == 1 and sdf is None:
+            #the two ends of the interval, same as get_1d_boundary for a sorted grid
+            mask = torch.zeros(n,dtype=torch.bool)
+            mask[[int(x.argmin()),int(x.argmax())]] = True
+        elif sdf is not None:
+            mask = sdf(x).reshape(-1).abs() <= tol
+        elif self.grid_shape is not None:
+            lower = x.min(0).values
+            upper = x.max(0).values
+            mask = (((x-lower).abs() <= tol) | ((x-upper).abs() <= tol)).any(1)
+        else:
+            mask = _kdtree_boundary(x,k)
+        self.boundary = torch.nonzero(mask).flatten()
+        self.interior = torch.nonzero(~mask).flatten()
+        self.n_boundary = self.boundary.numel()
+        self.n_interior = self.interior.numel()
+        self.x_boundary = x[self.boundary].detach()
+
+        #Same bookkeeping as the original loss_solving_poisson and sub_A_solving_poisson
+        if input_dim == 1:
+            #the loss only keeps the interior rows of F1
+            self.sample_num = self.n_interior
+            self.boundary_num = self.n_boundary
+            self.loss_rows = self.interior
+        elif self.grid_shape is not None:
+            #number of cells of the grid, i.e. (sqrt(N)-1)^2 for a square one
+            self.sample_num = int(np.prod([m-1 for m in self.grid_shape]))
+            self.boundary_num = n-self.sample_num
+            self.loss_rows = slice(None)
+        else:
+            self.sample_num = n
+            self.boundary_num = self.n_boundary
+            self.loss_rows = slice(None)
+        self.loss_boundary_num = self.n_boundary
+        self.interior_weights = torch.zeros(n,dtype=x.dtype)
+        self.interior_weights[self.loss_rows] = 1/self.sample_num
+        self.boundary_weights = torch.full((self.n_boundary,),1/self.loss_boundary_num,dtype=x.dtype)
+        _register(x,self)
+
+    def to(self, dtype):
+        """
+        The same set with the points in dtype, without a new boundary test.
+        """
+        if dtype == self.x.dtype:
+            return self
+        points = CollocationSet.__new__(CollocationSet)
+        points.__dict__.update(self.__dict__)
+        points.x = self.x.to(dtype)
+        points.x_boundary = self.x_boundary.to(dtype)
+        points.interior_weights = self.interior_weights.to(dtype)
+        points.boundary_weights = self.boundary_weights.to(dtype)
+        _register(points.x,points)
+        return points
+
+
+def _register(x, points, sets=_COLLOCATION_SETS):
+    #the callback keeps the dictionary itself, the module globals may be gone at exit
+    attributes = {name: value for name, value in points.__dict__.items() if name != 'x'}
+    sets[id(x)] = (weakref.ref(x,lambda ref, key=id(x): sets.pop(key,None)),x._version,attributes)
+
+
+def collocation_set(x):
+    """
+    CollocationSet of the points x (a tensor or already a CollocationSet),
+    built at the first call and then reused.
+    """
+    if isinstance(x, CollocationSet):
+        return x
+    entry = _COLLOCATION_SETS.get(id(x))
+    if entry is not None and entry[0]() is x and entry[1] == x._version:
+        points = CollocationSet.__new__(CollocationSet)
+        points.__dict__.update(entry[2])
+        points.x = x
+        return points
+    return CollocationSet(x)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In this file, we gave the PoissonIterationState class, which keeps everything
+one LMTR iteration needs for the current model, i.e. the residuals F1, F2,
+the Jacobians J1, J2, the loss and its gradient (J^T F), evaluated at most once
+per model.
+
+The subsolver matrix A, the right-hand side b, the Taylor model (for the
+predicted reduction) and the stopping test all read from the same state, so a
+rejected step (the model does not change) does not need any new autograd work.
+
+With matrix_free=True, J1 and J2 are never built: the state only gives the
+products J v (jvp) and J^T u (vjp) of the residuals w.r.t. the flattened
+parameters, so the memory grows linearly with the number of parameters.
+"""
+import math
+import torch
+from torch.func import jvp, vjp
+from Multilevel_LM.main_lm.neural_network_construction import FunctionalModel,parameters_dict,unflatten_parameters,compute_flatten_gradients_vectorized
+from Multilevel_LM.main_lm.subsolver_poisson import Fk1_functional,Fk2_functional
+from Multilevel_LM.main_lm.sketching import sketch_rows
+from Multilevel_LM.main_lm.collocation import collocation_set
+
+
+class PoissonIterationState:
+    def __init__(self, real_solution, model, x, regularization=True, lambdap=0.1, jacobian_mode='auto', functionals=None, matrix_free=False):
+        """
+        Initialize the state of the model, nothing is evaluated until it is used.
+
+        Parameters:
+        - real_solution: Function that provides the true solution of the PDE.
+        - model: the network at the current iterate.
+        - x: collocation points (1D, 2D or 3D grid, or point cloud, see CollocationSet).
+        - lambdap: weight of the boundary term.
+        - jacobian_mode: mode of compute_flatten_gradients_vectorized.
+        - functionals: (Fk1,data1,Fk2,data2) from Fk1_functional / Fk2_functional,
+          they only depend on real_solution and x, so new_state reuses them.
+        - matrix_free: only use Jacobian-vector products, never build J1, J2.
+        """
+        self.real_solution = real_solution
+        self.model = model
+        self.x = x
+        self.regularization = regularization
+        self.lambdap = lambdap
+        self.jacobian_mode = jacobian_mode
+        self.matrix_free = matrix_free
+        if functionals is None:
+            functionals = Fk1_functional(real_solution,model,x)+Fk2_functional(real_solution,model,x)
+        self.functionals = functionals
+        self.s_size = sum(p.numel() for p in model.parameters())
+
+        #Same bookkeeping of the number of samples as loss_solving_poisson and sub_A_solving_poisson
+        points = collocation_set(x)
+        self.sample_num = points.sample_num
+        self.boundary_num = points.boundary_num
+        self.loss_rows = points.loss_rows
+        self.loss_boundary_num = points.loss_boundary_num
+
+        self._F1 = None
+        self._F2 = None
+        self._J1 = None
+        self._J2 = None
+        self._JTJ = None
+        self._JJT = None
+        self._svd = None
+        self._sketched_svd = None
+        self._nystrom = None
+        self._cholesky = None
+        self._vjp = None
+        self._diag = None
+
+    def new_state(self, model):
+        """
+        State of another model (e.g. the trial point), on the same problem.
+        """
+        state = PoissonIterationState(self.real_solution, model, self.x, self.regularization, self.lambdap,
+                                      self.jacobian_mode, self.functionals, self.matrix_free)
+        #same problem, so the same bookkeeping (it differs from the grid for a subsample)
+        state.sample_num = self.sample_num
+        state.boundary_num = self.boundary_num
+        state.loss_rows = self.loss_rows
+        state.loss_boundary_num = self.loss_boundary_num
+        return state
+
+    def subsample(self, idx1, idx2):
+        """
+        State of the same model on the interior rows idx1 (indices of F1[loss_rows])
+        and the boundary rows idx2 of F2. The numbers of samples are scaled by 
+        the fraction of the rows which are kept, so the loss, its gradient and 
+        the LM model of the subsample are unbiased estimates of the full ones 
+        for a uniform sample.
+        """
+        Fk1, data1, Fk2, data2 = self.functionals
+        rows1 = torch.arange(data1[0].shape[0])[self.loss_rows]
+        n_loss = rows1.numel()
+        n_boundary = data2[0].shape[0]
+        functionals = (Fk1,tuple(d[rows1[idx1]] for d in data1),Fk2,tuple(d[idx2] for d in data2))
+        state = PoissonIterationState(self.real_solution, self.model, self.x, self.regularization, self.lambdap,
+                                      self.jacobian_mode, functionals, self.matrix_free)
+        state.sample_num = self.sample_num*len(idx1)/n_loss
+        state.boundary_num = self.boundary_num*len(idx2)/n_boundary
+        state.loss_rows = slice(None)
+        state.loss_boundary_num = self.loss_boundary_num*len(idx2)/n_boundary
+        return state
+
+    @property
+    def theta(self):
+        """
+        Flattened parameters of the model, in the order of model.parameters().
+        """
+        if isinstance(self.model, FunctionalModel):
+            return self.model.theta
+        return torch.cat([p.reshape(-1) for p in parameters_dict(self.model).values()])
+
+    def residuals(self, theta):
+        """
+        (F1, F2) as a function of the flattened parameters.
+        """
+        params = unflatten_parameters(parameters_dict(self.model),theta)
+        Fk1, data1, Fk2, data2 = self.functionals
+        return Fk1(params,*data1), Fk2(params,*data2)
+
+    def J_times(self, v):
+        """
+        Jacobian-vector products (J1 v, J2 v).
+        """
+        if not self.matrix_free:
+            return self.J1@v, self.J2@v
+        J1v, J2v = jvp(self.residuals,(self.theta,),(v,))[1]
+        return J1v.flatten(), J2v.flatten()
+
+    def JT_times(self, u1, u2):
+        """
+        Vector-Jacobian product J1^T u1 + J2^T u2.
+        """
+        if not self.matrix_free:
+            return self.J1.T@u1.flatten()+self.J2.T@u2.flatten()
+        if self._vjp is None:
+            (F1, F2), self._vjp = vjp(self.residuals,self.theta)
+        return self._vjp((u1.reshape(self.F1.shape),u2.reshape(self.F2.shape)))[0]
+
+    def gauss_newton_times(self, v, lambdak):
+        """
+        (J1^T J1/n + lambdap*J2^T J2/nb + lambdak*I) v, i.e. sub_A times v, without building sub_A.
+        """
+        J1v, J2v = self.J_times(v)
+        return self.JT_times(J1v/self.sample_num,self.lambdap*J2v/self.boundary_num)+lambdak*v
+
+    def gauss_newton_diagonal(self, chunk_size=64):
+        """
+        Diagonal of J1^T J1/n + lambdap*J2^T J2/nb, from blocks of chunk_size rows of
+        the Jacobians, so the memory stays linear in the number of parameters.
+        """
+        if self._diag is not None:
+            return self._diag
+        diag = 0
+        for (Fk, data), scale in zip([self.functionals[:2],self.functionals[2:]],
+                                     [1/self.sample_num,self.lambdap/self.boundary_num]):
+            for i in range(0,data[0].shape[0],chunk_size):
+                J_block = self._jacobian(Fk,tuple(d[i:i+chunk_size] for d in data))
+                diag = diag+scale*(J_block**2).sum(0)
+        self._diag = diag
+        return diag
+
+    def nystrom(self, rank=20):
+        """
+        Randomized Nystrom approximation U diag(Lam) U^T of JTJ with rank 
+        columns, from rank products JTJ v (gauss_newton_times) with an 
+        orthonormal Gaussian test matrix, so it does not need J in matrix-free 
+        mode. It does not depend on lambdak, so it is computed once per model.
+        """
+        if self._nystrom is None:
+            dtype = self.F1.dtype
+            rank = min(rank,self.s_size)
+            Omega = torch.linalg.qr(torch.randn(self.s_size,rank,dtype=dtype))[0]
+            Y = torch.stack([self.gauss_newton_times(Omega[:,i],0) for i in range(rank)],dim=1)
+            #shift for the stability of the Cholesky factorization
+            nu = torch.finfo(dtype).eps*torch.norm(Y)
+            Y = Y+nu*Omega
+            C = torch.linalg.cholesky(Omega.T@Y)
+            B = torch.linalg.solve_triangular(C,Y.T,upper=False).T
+            U, S, _ = torch.linalg.svd(B,full_matrices=False)
+            self._nystrom = (U,torch.clamp(S**2-nu,min=0))
+        return self._nystrom
+
+    def _jacobian(self, Fk, data):
+        """
+        Jacobian of the residual Fk on the points data w.r.t. the flattened parameters.
+        """
+        return compute_flatten_gradients_vectorized(self.model,Fk,data,self.jacobian_mode)
+
+    @property
+    def F1(self):
+        if self._F1 is None:
+            Fk1, data1 = self.functionals[:2]
+            with torch.no_grad():
+                self._F1 = Fk1(parameters_dict(self.model),*data1)
+        return self._F1
+
+    @property
+    def F2(self):
+        if self._F2 is None:
+            Fk2, data2 = self.functionals[2:]
+            with torch.no_grad():
+                self._F2 = Fk2(parameters_dict(self.model),*data2)
+        return self._F2
+
+    @property
+    def J1(self):
+        if self._J1 is None:
+            Fk1, data1 = self.functionals[:2]
+            self._J1 = self._jacobian(Fk1,data1)
+        return self._J1
+
+    @property
+    def J2(self):
+        if self._J2 is None:
+            Fk2, data2 = self.functionals[2:]
+            self._J2 = self._jacobian(Fk2,data2)
+        return self._J2
+
+    @property
+    def loss(self):
+        """
+        Same value as loss_solving_poisson, from the cached residuals.
+        """
+        main_loss = 0.5*torch.norm(self.F1[self.loss_rows])**2 / self.sample_num
+        if self.regularization == True:
+            re_loss = 0.5*self.lambdap*torch.norm(self.F2)**2 / self.loss_boundary_num
+        else:
+            re_loss = 0
+        return main_loss+re_loss
+
+    @property
+    def gradient(self):
+        """
+        Gradient of the loss w.r.t. the flattened parameters, as J^T F.
+        """
+        u1 = torch.zeros_like(self.F1)
+        u1[self.loss_rows] = self.F1[self.loss_rows] / self.sample_num
+        if self.regularization == True:
+            u2 = self.lambdap*self.F2 / self.loss_boundary_num
+        else:
+            u2 = torch.zeros_like(self.F2)
+        return self.JT_times(u1,u2)
+
+    @property
+    def loss_weights(self):
+        """
+        Square roots of the weights of the rows of [F1; F2] in the loss, i.e. 
+        loss = 0.5*||loss_weights*[F1; F2]||^2.
+        """
+        w1 = torch.zeros(self.F1.numel(),dtype=self.F1.dtype)
+        w1[self.loss_rows] = 1/math.sqrt(self.sample_num)
+        w2 = torch.full((self.F2.numel(),),math.sqrt(self.lambdap/self.loss_boundary_num) if self.regularization == True else 0.,dtype=self.F2.dtype)
+        return torch.cat([w1,w2])
+
+    @property
+    def JTJ(self):
+        """
+        Gauss-Newton matrix J1^T J1/n + lambdap*J2^T J2/nb, which does not depend on lambdak.
+        """
+        if self._JTJ is None:
+            self._JTJ = self.J1.T@self.J1/self.sample_num+self.lambdap*self.J2.T@self.J2/self.boundary_num
+        return self._JTJ
+
+    @property
+    def stacked_J(self):
+        """
+        Weighted stacked Jacobian [J1/sqrt(n); sqrt(lambdap/nb)*J2], so that JTJ = stacked_J^T stacked_J.
+        """
+        return torch.cat([self.J1/math.sqrt(self.sample_num),math.sqrt(self.lambdap/self.boundary_num)*self.J2])
+
+    @property
+    def stacked_F(self):
+        """
+        Weighted stacked residual [F1/sqrt(n); sqrt(lambdap/nb)*F2], so that sub_b = stacked_J^T stacked_F.
+        """
+        return torch.cat([self.F1/math.sqrt(self.sample_num),math.sqrt(self.lambdap/self.boundary_num)*self.F2]).flatten()
+
+    @property
+    def n_rows(self):
+        return self.F1.numel()+self.F2.numel()
+
+    @property
+    def JJT(self):
+        """
+        Kernel matrix stacked_J stacked_J^T (rows x rows), which does not depend on lambdak.
+        """
+        if self._JJT is None:
+            J = self.stacked_J
+            self._JJT = J@J.T
+        return self._JJT
+
+    @property
+    def svd(self):
+        """
+        Thin SVD (U, S, Vh) of stacked_J, which does not depend on lambdak, 
+        so it is computed once per model and reused for every lambdak.
+        """
+        if self._svd is None:
+            self._svd = torch.linalg.svd(self.stacked_J,full_matrices=False)
+        return self._svd
+
+    def sketched_svd(self, sketch_type='gaussian', sketch_size=None):
+        """
+        Thin SVD (U, S, Vh) of S stacked_J for a random sketch S with sketch_size
+        rows (4 times the number of parameters if None), so that 
+        Vh^T diag(S^2) Vh ~ JTJ. If stacked_J has no more rows than the sketch,
+        sketching does not make the problem smaller, so it is the exact thin 
+        svd (of the kernel form when the rows are fewer than the parameters).
+        Like svd, it is computed once per model.
+        """
+        if self._sketched_svd is None:
+            d = 4*self.s_size if sketch_size is None else sketch_size
+            if d >= self.n_rows:
+                self._sketched_svd = self.svd
+            else:
+                self._sketched_svd = torch.linalg.svd(sketch_rows(self.stacked_J,d,sketch_type),full_matrices=False)
+        return self._sketched_svd
+
+    def cholesky(self, lambdak):
+        """
+        Lower Cholesky factor of sub_A(lambdak), kept for the last lambdak.
+        """
+        if self._cholesky is None or self._cholesky[0] != lambdak:
+            self._cholesky = (lambdak,torch.linalg.cholesky(self.sub_A(lambdak)))
+        return self._cholesky[1]
+
+    def sub_A(self, lambdak):
+        """
+        Same matrix as sub_A_solving_poisson.
+        """
+        A = self.JTJ.clone()
+        A.diagonal().add_(lambdak)
+        return A
+
+    def sub_b(self):
+        """
+        Same vector as sub_b_solving_poisson, i.e. -b of As = b.
+        """
+        if self.matrix_free:
+            return self.JT_times(self.F1/self.sample_num,self.lambdap*self.F2/self.boundary_num).view(-1,1)
+        return self.J1.T@self.F1/self.sample_num+self.lambdap*self.J2.T@self.F2/self.boundary_num
+
+    def taylor(self, s, lambdak):
+        """
+        Same value as Taylor_solver, i.e. the model m_k(s).
+        """
+        s = s.to(self.F1.dtype)
+        J1s, J2s = self.J_times(s)
+        m1 = (torch.norm(self.F1)**2+2*self.F1.T@J1s+J1s@J1s)/(2*self.sample_num)
+        m2 = self.lambdap*(torch.norm(self.F2)**2+2*self.F2.T@J2s+J2s@J2s)/(2*self.boundary_num)
+        m3 = 0.5*lambdak*torch.norm(s)**2
+        return m1+m2+m3
+
+    def predicted_reduction(self, s, lambdak):
+        """
+        taylor(0,lambdak)-taylor(s,lambdak), without the ||F||^2 terms, which 
+        cancel, so it stays accurate when the loss is small (e.g. in float32).
+        """
+        s = s.to(self.F1.dtype)
+        J1s, J2s = self.J_times(s)
+        d1 = (2*self.F1.T@J1s+J1s@J1s)/(2*self.sample_num)
+        d2 = self.lambdap*(2*self.F2.T@J2s+J2s@J2s)/(2*self.boundary_num)
+        return -(d1+d2+0.5*lambdak*torch.norm(s)**2).reshape(())
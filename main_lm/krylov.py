@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In this file, we gave the Krylov solvers for the subproblem As = b, where A is
+only known through the product v -> Av, e.g. A = J^T J + lambda*I applied by
+Jacobian-vector and vector-Jacobian products, so A (and J) is never built,
+MINRES for symmetric systems, and LSQR and LSMR for the least squares
+problems min ||Ax - b||, e.g. the damped LM problem, which never form the
+normal equations A^T A. ritz_pairs extracts
+approximate eigenvectors of A from the search directions of pcg, e.g. to be
+recycled in the solve of a nearby system.
+"""
+import torch
+
+
+def pcg(apply_A,b,M=None,x0=None,tol=1e-6,max_iter=None,n_keep=0):
+    """
+    Preconditioned conjugate gradient for the SPD system Ax = b.
+
+    Args:
+        apply_A (callable): v -> Av.
+        b (torch.Tensor): right-hand side, 1d tensor.
+        M (callable): r -> M^{-1}r, the preconditioner. None means no preconditioner.
+        x0 (torch.Tensor): initial guess, zero if None.
+        tol (float): stop when ||b-Ax|| <= tol*||b||.
+        max_iter (int): maximum number of iterations, the size of b if None.
+        n_keep (int): number of search directions p (and Ap) which are kept.
+
+    Returns
+    -------
+    x (torch.Tensor): the approximate solution
+    info (dict): 'iterations' and the relative 'residual' ||b-Ax||/||b||, and
+        'directions' = (P, AP), the first n_keep search directions as columns
+    """
+    if M is None:
+        M = lambda r: r
+    if max_iter is None:
+        max_iter = b.numel()
+    norm_b = torch.norm(b)
+    if norm_b == 0:
+        return torch.zeros_like(b), {'iterations': 0, 'residual': 0.0}
+    if x0 is None:
+        x = torch.zeros_like(b)
+        r = b.clone()
+    else:
+        x = x0.clone()
+        r = b-apply_A(x)
+    z = M(r)
+    p = z.clone()
+    rz = r@z
+    P, AP = [], []
+    k = 0
+    while torch.norm(r) > tol*norm_b and k < max_iter:
+        Ap = apply_A(p)
+        if len(P) < n_keep:
+            P.append(p)
+            AP.append(Ap)
+        alpha = rz/(p@Ap)
+        x = x+alpha*p
+        r = r-alpha*Ap
+        z = M(r)
+        rz_new = r@z
+        p = z+(rz_new/rz)*p
+        rz = rz_new
+        k += 1
+    info = {'iterations': k, 'residual': (torch.norm(r)/norm_b).item()}
+    if n_keep > 0:
+        info['directions'] = (torch.stack(P,dim=1) if P else b.new_zeros(b.numel(),0),
+                              torch.stack(AP,dim=1) if AP else b.new_zeros(b.numel(),0))
+    return x, info
+
+
+def lsqr(apply_A,apply_AT,b,tol=1e-6,max_iter=None):
+    """
+    LSQR (Paige and Saunders) for min ||Ax - b||, i.e. CG on A^T A x = A^T b 
+    without forming A^T A, which is more accurate when A is ill-conditioned.
+
+    Args:
+        apply_A (callable): v -> Av.
+        apply_AT (callable): u -> A^T u.
+        b (torch.Tensor): right-hand side, 1d tensor.
+        tol (float): stop when ||A^T(b-Ax)|| <= tol*||A^T b||.
+        max_iter (int): maximum number of iterations, the size of A^T b if None.
+
+    Returns
+    -------
+    x (torch.Tensor): the approximate solution
+    info (dict): 'iterations' and the relative 'residual' ||A^T(b-Ax)||/||A^T b||
+    """
+    beta = torch.norm(b)
+    if beta == 0:
+        return torch.zeros_like(apply_AT(b)), {'iterations': 0, 'residual': 0.0}
+    u = b/beta
+    v = apply_AT(u)
+    alpha = torch.norm(v)
+    if alpha == 0:
+        return torch.zeros_like(v), {'iterations': 0, 'residual': 0.0}
+    v = v/alpha
+    if max_iter is None:
+        max_iter = v.numel()
+    norm_ATb = alpha*beta
+    w = v.clone()
+    x = torch.zeros_like(v)
+    phibar = beta
+    rhobar = alpha
+    residual = 1.0
+    k = 0
+    while residual > tol and k < max_iter:
+        u = apply_A(v)-alpha*u
+        beta = torch.norm(u)
+        if beta > 0:
+            u = u/beta
+        v = apply_AT(u)-beta*v
+        alpha = torch.norm(v)
+        if alpha > 0:
+            v = v/alpha
+        rho = torch.sqrt(rhobar**2+beta**2)
+        c = rhobar/rho
+        s = beta/rho
+        theta = s*alpha
+        rhobar = -c*alpha
+        phi = c*phibar
+        phibar = s*phibar
+        x = x+(phi/rho)*w
+        w = v-(theta/rho)*w
+        #||A^T r_k|| = phibar*alpha*|c|
+        residual = (phibar*alpha*torch.abs(c)/norm_ATb).item()
+        k += 1
+    return x, {'iterations': k, 'residual': residual}
+
+
+
+def ritz_pairs(Z,AZ,k):
+    """
+    Rayleigh-Ritz for the SPD matrix A on span(Z), given AZ = A@Z, e.g. the
+    search directions of CG and their products, which come for free.
+
+    Returns
+    -------
+    Q (torch.Tensor): (p, k) orthonormal Ritz vectors of the k largest Ritz values
+    AQ (torch.Tensor): A@Q
+    """
+    #orthonormal basis Z V diag(e^{-1/2}) from Z^T Z = V diag(e) V^T, without 
+    #the (nearly) dependent directions
+    scale = torch.norm(Z,dim=0)
+    Z = Z/scale
+    AZ = AZ/scale
+    e, V = torch.linalg.eigh(Z.T@Z)
+    keep = e > e[-1]*Z.shape[0]*torch.finfo(Z.dtype).eps
+    V = V[:,keep]/torch.sqrt(e[keep])
+    Q = Z@V
+    AQ = AZ@V
+    G = Q.T@AQ
+    Y = torch.linalg.eigh(0.5*(G+G.T))[1][:,-k:]
+    return Q@Y, AQ@Y
+
+
+def lsmr(apply_A,apply_AT,b,tol=1e-6,max_iter=None):
+    """
+    LSMR (Fong and Saunders) for min ||Ax - b||, i.e. MINRES on A^T A x = A^T b 
+    without forming A^T A, so ||A^T r_k|| decreases monotonically, which makes
+    it safer than LSQR to stop early. Same arguments and info as lsqr.
+    """
+    beta = torch.norm(b)
+    if beta == 0:
+        return torch.zeros_like(apply_AT(b)), {'iterations': 0, 'residual': 0.0}
+    u = b/beta
+    v = apply_AT(u)
+    alpha = torch.norm(v)
+    if alpha == 0:
+        return torch.zeros_like(v), {'iterations': 0, 'residual': 0.0}
+    v = v/alpha
+    if max_iter is None:
+        max_iter = v.numel()
+    norm_ATb = alpha*beta
+    zetabar = alpha*beta
+    alphabar = alpha
+    rho = rhobar = cbar = torch.ones((),dtype=b.dtype)
+    sbar = torch.zeros((),dtype=b.dtype)
+    h = v.clone()
+    hbar = torch.zeros_like(v)
+    x = torch.zeros_like(v)
+    residual = 1.0
+    k = 0
+    while residual > tol and k < max_iter:
+        u = apply_A(v)-alpha*u
+        beta = torch.norm(u)
+        if beta > 0:
+            u = u/beta
+        v = apply_AT(u)-beta*v
+        alpha = torch.norm(v)
+        if alpha > 0:
+            v = v/alpha
+        #rotation Q_k, B_k to R_k
+        rhoold = rho
+        rho = torch.sqrt(alphabar**2+beta**2)
+        c = alphabar/rho
+        s = beta/rho
+        thetanew = s*alpha
+        alphabar = c*alpha
+        #rotation Qbar_k, R_k^T to Rbar_k
+        rhobarold = rhobar
+        thetabar = sbar*rho
+        rhobar = torch.sqrt((cbar*rho)**2+thetanew**2)
+        cbar, sbar = cbar*rho/rhobar, thetanew/rhobar
+        zeta = cbar*zetabar
+        zetabar = -sbar*zetabar
+        hbar = h-(thetabar*rho/(rhoold*rhobarold))*hbar
+        x = x+(zeta/(rho*rhobar))*hbar
+        h = v-(thetanew/rho)*h
+        #||A^T r_k|| = |zetabar|
+        residual = (torch.abs(zetabar)/norm_ATb).item()
+        k += 1
+    return x, {'iterations': k, 'residual': residual}
+
+
+def minres(apply_A,b,M=None,tol=1e-6,max_iter=None):
+    """
+    Preconditioned MINRES (Paige and Saunders) for the symmetric system Ax = b,
+    with a SPD preconditioner M. It minimizes the residual over the Krylov 
+    space, so it does not need A to be definite.
+
+    Args:
+        apply_A (callable): v -> Av.
+        b (torch.Tensor): right-hand side, 1d tensor.
+        M (callable): r -> M^{-1}r, the preconditioner. None means no preconditioner.
+        tol (float): stop when the estimate of ||b-Ax||_M^{-1} <= tol*||b||_M^{-1}.
+        max_iter (int): maximum number of iterations, the size of b if None.
+
+    Returns
+    -------
+    x (torch.Tensor): the approximate solution
+    info (dict): 'iterations' and the relative 'residual' estimate
+    """
+    if M is None:
+        M = lambda r: r
+    if max_iter is None:
+        max_iter = b.numel()
+    x = torch.zeros_like(b)
+    r1 = b.clone()
+    y = M(r1)
+    beta1 = torch.sqrt(r1@y)
+    if beta1 == 0:
+        return x, {'iterations': 0, 'residual': 0.0}
+    r2 = r1
+    oldb = torch.zeros((),dtype=b.dtype)
+    beta = beta1
+    dbar = epsln = sn = torch.zeros((),dtype=b.dtype)
+    cs = -torch.ones((),dtype=b.dtype)
+    phibar = beta1
+    w = w2 = torch.zeros_like(b)
+    k = 0
+    while phibar > tol*beta1 and k < max_iter:
+        v = y/beta
+        y = apply_A(v)
+        if k > 0:
+            y = y-(beta/oldb)*r1
+        alfa = v@y
+        y = y-(alfa/beta)*r2
+        r1, r2 = r2, y
+        y = M(r2)
+        oldb, beta = beta, torch.sqrt(r2@y)
+        #QR factorization of the Lanczos tridiagonal matrix
+        oldeps = epsln
+        delta = cs*dbar+sn*alfa
+        gbar = sn*dbar-cs*alfa
+        epsln = sn*beta
+        dbar = -cs*beta
+        gamma = torch.clamp(torch.sqrt(gbar**2+beta**2),min=torch.finfo(b.dtype).eps)
+        cs = gbar/gamma
+        sn = beta/gamma
+        phi = cs*phibar
+        phibar = sn*phibar
+        w1, w2 = w2, w
+        w = (v-oldeps*w1-delta*w2)/gamma
+        x = x+phi*w
+        k += 1
+    return x, {'iterations': k, 'residual': (phibar/beta1).item()}
+
+
+def as_scipy_operator(apply_A,n,dtype):
+    """
+    scipy.sparse.linalg.LinearOperator of v -> Av (torch), for the SciPy 
+    solvers. The vectors are shared between NumPy and torch (torch.from_numpy
+    and Tensor.numpy are views of the same CPU memory), so the handoff copies
+    nothing, and the dtype stays the one of the torch computation.
+    """
+    from scipy.sparse.linalg import LinearOperator
+    def matvec(v):
+        return apply_A(torch.as_tensor(v).reshape(-1)).detach().numpy()
+    return LinearOperator((n,n),matvec=matvec,dtype=torch.empty(0,dtype=dtype).numpy().dtype)
@@ -7,59 +7,63 @@ Created on Mon Sep  9 11:57:07 2024
 """
 
 from Multilevel_LM.main_lm.PoissonPDE import PoissonPDE
+from Multilevel_LM.main_lm.target_data import poisson_target
+from Multilevel_LM.main_lm.collocation import collocation_set
 import torch
 import numpy as np
 def get_1d_boundary(x):
-    return torch.tensor([x[0].item(), x[-1].item()], dtype=torch.float32)
+    #same dtype and device as x, without going through Python floats
+    return x[[0,-1]].detach().reshape(-1)
 
 def get_2d_boundary(x):
-    x_min = x[:,0].min().item()
-    x_max = x[:,0].max().item()
-    y_min = x[:,1].min().item()
-    y_max = x[:,1].max().item()
-    boundary_points = x[(x[:,0] == x_min) | (x[:,0] == x_max) |
-                         (x[:,1] == y_min) |(x[:,1] == y_max)]
-    return boundary_points
+    #boundary points of the CollocationSet of x, found once per grid
+    return collocation_set(x).x_boundary
+
+def subsample_grid(x,stride):
+    """
+    Coarse collocation grid, every stride-th point of the grid x in each
+    direction, always keeping the last point, so the boundary of the domain is 
+    kept (e.g. 41 -> 21 points per direction for stride 2). In 2D, 3D, ..., x 
+    is the flattened tensor-product grid (see CollocationSet.grid_shape), e.g. 
+    from meshgrid, in any order of the coordinates, which is kept.
+    """
+    if stride == 1:
+        return x
+    input_dim = x.shape[1]
+    def keep(n):
+        idx = list(range(0,n,stride))
+        if idx[-1] != n-1:
+            idx.append(n-1)
+        return torch.tensor(idx)
+    if input_dim == 1:
+        return x[keep(x.shape[0])]
+    #a point is kept when its index along every coordinate is kept
+    mask = torch.ones(x.shape[0],dtype=torch.bool)
+    for i, n in enumerate(collocation_set(x).grid_shape):
+        index = torch.searchsorted(torch.unique(x[:,i]),x[:,i].contiguous())
+        mask &= torch.isin(index,keep(n))
+    return x[mask]
 
 def loss_solving_poisson(real_solution,model,x,regularization=True,lambdap = 0.1):
-    input_dim = model.input_dim
+    #f and the boundary values of the real solution are computed once per grid
+    target = poisson_target(real_solution)
+    #boundary points and quadrature weights, computed once per grid
+    points = collocation_set(x)
     
-    if input_dim == 1:
-        pde_1d = PoissonPDE(real_solution,x)
-        real_source = pde_1d._compute_1d_source_term(x)
-        nn_pde = PoissonPDE(model,x)
-        nn_source = nn_pde._compute_1d_source_term(x)
-        main_cost = (real_source-nn_source)[1:-1]
-        sample_num = x.shape[0]-2
-        main_loss = 0.5*torch.norm(main_cost)**2 / sample_num
-        
-    if input_dim == 2:
-        
-        pde_2d = PoissonPDE(real_solution,x)
-        real_source = pde_2d._compute_2d_source_term(x)
-        nn_pde = PoissonPDE(model,x)
-        nn_source = nn_pde._compute_2d_source_term(x)
-        main_cost = (real_source-nn_source)
-        sample_num = (np.sqrt(x.shape[0])-1)**2 
-        main_loss = 0.5*torch.norm(main_cost)**2 / sample_num
+    real_source = target.source(x).reshape(-1)
+    nn_pde = PoissonPDE(model,x)
+    #sum of the second derivatives over the input_dim coordinates
+    nn_source = nn_pde.compute_source_term(x).reshape(-1)
+    main_cost = real_source-nn_source
+    main_loss = 0.5*(points.interior_weights*main_cost**2).sum()
         
     #Compute the regularization term if needed
     if regularization == True:
-        if input_dim == 1:
-            x_boundary = get_1d_boundary(x).reshape(-1,1)
-            real = real_solution(x_boundary)
-            nn = model(x_boundary)
-            re_term = real-nn
-            #re_tensor = re_term.clone().detach().requires_grad_(True)
-            boundary_num = x_boundary.size(0)
-            re_loss = 0.5*lambdap*torch.norm(re_term)**2 / boundary_num
-        if input_dim == 2:
-            x_boundary = get_2d_boundary(x)
-            real = real_solution(x_boundary).reshape(-1,1)
-            nn = model(x_boundary)
-            re_term = real-nn
-            boundary_num = x_boundary.size(0)
-            re_loss = 0.5*lambdap*torch.norm(re_term)**2 / boundary_num
+        x_boundary = points.x_boundary
+        real = target.boundary_values(x_boundary)
+        nn = model(x_boundary)
+        re_term = (real-nn).reshape(-1)
+        re_loss = 0.5*lambdap*(points.boundary_weights*re_term**2).sum()
     else:
         re_loss = 0
     return main_loss+re_loss
@@ -69,7 +73,8 @@ def compute_loss_gradients(real_solution,model,x,regularization=True,lambdap = 0
     output = model(x)
    
    
-    #Compute the function
+    #Compute the function, with the previous gradients zeroed out so that they do not accumulate
+    model.zero_grad()
     loss = loss_solving_poisson(real_solution, model, x, regularization=True,lambdap = 0.1)
     loss.backward()
     #Create a vector to store the flattened gradients
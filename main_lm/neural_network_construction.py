@@ -11,12 +11,26 @@ And the last function, we gave the Jacobian of any network-related function.
 
 Specially, for the potential usage, we gave the function to calculte the 
 first / second derivative of network w.r.t. the input data x.
+
+The vectorized Jacobian engine (compute_flatten_gradients_vectorized) gives the 
+same flattened Jacobian as compute_flatten_gradients, but in one batched call 
+through torch.func (vmap over the points of functional_call), instead of one 
+backward pass per row.
+
+The Taylor-mode forward pass (forward_taylor of FullyConnectedNN and FunctionalModel, 
+taylor_forward) gives u, grad u and laplacian u w.r.t. x in one pass, without 
+nested autograd.
+
+FunctionalModel keeps the parameters of a network as one flat vector, so the 
+solvers update the model by a vector addition instead of copying the module.
 """
 
 
+import copy
 import torch
 import torch.nn as nn
 import numpy as np
+from torch.func import functional_call, jacrev, jacfwd, jvp, vmap, hessian
 
 
 
@@ -47,8 +61,231 @@ class FullyConnectedNN(nn.Module):
             x = self.activation_function(layer(x))
         x = self.output_layer(x)
         return x
-  
-    
+
+    def forward_taylor(self, x):
+        """
+        Forward pass which carries the value, the gradient and the Laplacian of
+        the output w.r.t. x together, layer by layer (see taylor_forward).
+        """
+        return taylor_forward(self, dict(self.named_parameters()), x)
+
+
+def activation_derivatives(activation_function):
+    """
+    Closed-form derivatives of the activation function.
+
+    Returns
+    -------
+    derivatives (list): [sigma, d1, d2, d3], the activation and its first, second
+        and third derivatives, each one a function of the pre-activation z.
+        For activations other than sigmoid and tanh, the derivatives are obtained
+        by nested jvp of the (elementwise) activation.
+    """
+    if activation_function is torch.sigmoid or isinstance(activation_function, nn.Sigmoid):
+        def d1(z):
+            s = torch.sigmoid(z)
+            return s*(1-s)
+        def d2(z):
+            s = torch.sigmoid(z)
+            return s*(1-s)*(1-2*s)
+        def d3(z):
+            s = torch.sigmoid(z)
+            ds = s*(1-s)
+            return ds*(1-6*ds)
+        return [torch.sigmoid, d1, d2, d3]
+    if activation_function is torch.tanh or isinstance(activation_function, nn.Tanh):
+        def d1(z):
+            return 1-torch.tanh(z)**2
+        def d2(z):
+            t = torch.tanh(z)
+            return -2*t*(1-t**2)
+        def d3(z):
+            t = torch.tanh(z)
+            return (1-t**2)*(6*t**2-2)
+        return [torch.tanh, d1, d2, d3]
+    #Elementwise activation, so the jvp with a tangent of ones is the derivative
+    derivatives = [activation_function]
+    for _ in range(3):
+        previous = derivatives[-1]
+        derivatives.append(lambda z, f=previous: jvp(f,(z,),(torch.ones_like(z),))[1])
+    return derivatives
+
+
+def taylor_forward(model,params,x):
+    """
+    Propagate u, grad u and laplacian u (w.r.t. the input x) through the
+    FullyConnectedNN, using the closed-form first and second derivatives of the
+    activation. It only uses plain tensor operations, so the result is a
+    first-order graph in the parameters, which can be used with autograd as well
+    as with torch.func transforms.
+
+    Args:
+        model (FullyConnectedNN): the network, used for its structure and activation.
+        params (dict): parameters name -> tensor, e.g. dict(model.named_parameters()).
+        x (torch.Tensor): input data of size (N, input_dim).
+
+    Returns
+    -------
+    u (torch.Tensor): output of size (N, output_dim)
+    grad_u (torch.Tensor): gradient of size (N, input_dim, output_dim)
+    laplacian_u (torch.Tensor): Laplacian of size (N, output_dim)
+    """
+    sigma, d1, d2 = activation_derivatives(model.activation_function)[:3]
+    h = x
+    grad_h = torch.eye(x.shape[1],dtype=x.dtype).expand(x.shape[0],-1,-1)
+    laplacian_h = torch.zeros_like(x)
+    for i in range(model.n_hidden_layers):
+        W = params[f'hidden_layers.{i}.weight']
+        b = params[f'hidden_layers.{i}.bias']
+        z = h @ W.T + b
+        grad_z = grad_h @ W.T
+        laplacian_z = laplacian_h @ W.T
+        h = sigma(z)
+        grad_h = d1(z).unsqueeze(1)*grad_z
+        laplacian_h = d1(z)*laplacian_z+d2(z)*(grad_z**2).sum(1)
+    W = params['output_layer.weight']
+    b = params['output_layer.bias']
+    return h @ W.T + b, grad_h @ W.T, laplacian_h @ W.T
+
+
+def is_single_hidden_layer(model):
+    """
+    Whether the network is a FullyConnectedNN with one hidden layer and a
+    scalar output, i.e. u(x) = sum_j v_j sigma(w_j.x+b_j) + c, the architecture
+    of single_hidden_layer_jacobian.
+    """
+    module = as_module(model)
+    return isinstance(module, FullyConnectedNN) and module.n_hidden_layers == 1 and module.output_dim == 1
+
+
+def single_hidden_layer_jacobian(model,params,x,laplacian=False):
+    """
+    Closed-form value and Jacobian w.r.t. the parameters of u(x), or of its
+    Laplacian, for the network of is_single_hidden_layer. With z_j = w_j.x+b_j
+    and s1, s2, s3 the derivatives of the activation at z_j:
+        u = sum_j v_j sigma(z_j) + c,
+        du/dw_jk = v_j s1 x_k,  du/db_j = v_j s1,  du/dv_j = sigma(z_j),  du/dc = 1,
+        lap u = sum_j v_j |w_j|^2 s2,
+        dlap/dw_jk = v_j (2 w_jk s2 + |w_j|^2 s3 x_k),  dlap/db_j = v_j |w_j|^2 s3,
+        dlap/dv_j = |w_j|^2 s2,  dlap/dc = 0.
+    Only batched tensor operations, no autograd.
+
+    Args:
+        model: the network, used for its activation.
+        params (dict): parameters name -> tensor, e.g. parameters_dict(model).
+        x (torch.Tensor): input data of size (N, input_dim).
+        laplacian (bool): the Laplacian of u instead of u.
+
+    Returns
+    -------
+    value (torch.Tensor): u or its Laplacian, of size (N,)
+    J (torch.Tensor): the Jacobian of size (N, number of parameters), with the 
+        columns in the order of model.named_parameters()
+    """
+    sigma, d1, d2, d3 = activation_derivatives(model.activation_function)
+    W = params['hidden_layers.0.weight']
+    b = params['hidden_layers.0.bias']
+    v = params['output_layer.weight'][0]
+    x = x.to(W.dtype)
+    z = x @ W.T + b
+    n = x.shape[0]
+    if laplacian:
+        w_norm2 = (W**2).sum(1)
+        s2 = d2(z)
+        J_v = s2*w_norm2
+        J_b = v*w_norm2*d3(z)
+        J_W = 2*(v*s2).unsqueeze(2)*W+J_b.unsqueeze(2)*x.unsqueeze(1)
+        J_c = torch.zeros(n,1,dtype=W.dtype)
+        value = J_v @ v
+    else:
+        J_v = sigma(z)
+        J_b = v*d1(z)
+        J_W = J_b.unsqueeze(2)*x.unsqueeze(1)
+        J_c = torch.ones(n,1,dtype=W.dtype)
+        value = J_v @ v+params['output_layer.bias']
+    return value, torch.cat([J_W.reshape(n,-1),J_b,J_v,J_c],dim=1)
+
+
+class FunctionalModel:
+    """
+    Functional version of a network: one contiguous parameter vector theta plus
+    the layout (name, shape) of the parameters, evaluated through
+    torch.func.functional_call on a template module. The template only gives the
+    structure and the activation, its own parameters are never used.
+
+    A trial point of the solvers is then FunctionalModel.step(s), i.e. a vector
+    addition, without deepcopy of the module or a copy_ per parameter.
+    It has the attributes of FullyConnectedNN the solvers need (input_dim,
+    n_hidden_layers, ..., named_parameters, parameters, __call__, forward_taylor).
+    """
+    def __init__(self, module, theta=None, layout=None):
+        if layout is None:
+            layout = [(name, p.shape) for name, p in module.named_parameters()]
+        if theta is None:
+            theta = torch.cat([p.detach().reshape(-1) for p in module.parameters()])
+        self.module = module
+        self.theta = theta
+        self.layout = layout
+        for name in ['input_dim','n_hidden_layers','r_nodes_per_layer','output_dim','activation_function']:
+            if hasattr(module,name):
+                setattr(self,name,getattr(module,name))
+
+    @property
+    def params(self):
+        """
+        Parameters as a dict name -> tensor, views of theta.
+        """
+        numels = [int(np.prod(shape)) for _, shape in self.layout]
+        return {name: t.view(shape) for (name,shape),t in zip(self.layout,self.theta.split(numels))}
+
+    def named_parameters(self):
+        return iter(self.params.items())
+
+    def parameters(self):
+        return iter(self.params.values())
+
+    def __call__(self, x):
+        return functional_call(self.module,self.params,(x,))
+
+    def forward_taylor(self, x):
+        """
+        u, grad u and laplacian u w.r.t. x with the parameters theta (see taylor_forward).
+        """
+        return taylor_forward(self.module,self.params,x)
+
+    def step(self, s):
+        """
+        The model with parameters theta + s, sharing the template and the layout.
+        """
+        return FunctionalModel(self.module,self.theta+s.reshape(-1).to(self.theta.dtype),self.layout)
+
+    def to_module(self):
+        """
+        nn.Module with the parameters theta (one deepcopy of the template).
+        """
+        module = copy.deepcopy(self.module).to(self.theta.dtype)
+        with torch.no_grad():
+            for p, t in zip(module.parameters(),self.params.values()):
+                p.copy_(t)
+        return module
+
+
+#FunctionalModel of a network, the model itself if it is already one (and has the dtype)
+def to_functional_model(model, dtype=None):
+    if not isinstance(model, FunctionalModel):
+        model = FunctionalModel(model)
+    if dtype is None or model.theta.dtype == dtype:
+        return model
+    return FunctionalModel(model.module,model.theta.to(dtype),model.layout)
+
+
+#Module used by functional_call, i.e. the template of a FunctionalModel
+def as_module(model):
+    if isinstance(model, FunctionalModel):
+        return model.module
+    return model
+
+
 #Test and usage of FullyConnectedNN
 
 # Network configuration
@@ -149,6 +386,105 @@ def compute_flatten_gradients(model,func_nn,x):
     
     return torch.stack(gradients)
 
+#Detached copy of the model parameters, as a dict name -> tensor, which is the 
+#input format of torch.func.functional_call
+def parameters_dict(model):
+    return {name: param.detach() for name, param in model.named_parameters()}
+
+
+#Split a flat parameter vector back into a dict name -> tensor, shaped like params
+def unflatten_parameters(params,theta):
+    numels = [p.numel() for p in params.values()]
+    return {name: t.view(p.shape) for (name,p),t in zip(params.items(),theta.split(numels))}
+
+
+def nn_functional(model,params):
+    """
+    Stateless version of the network, i.e. x -> model(x) evaluated with the 
+    parameters in params instead of the ones stored in the model.
+    """
+    return lambda x: functional_call(as_module(model),params,(x,))
+
+
+def nn_laplacian_functional(model,params,x):
+    """
+    Laplacian of the network output w.r.t. the input x, written so that it can 
+    be differentiated again by jacrev / jvp w.r.t. params. For FullyConnectedNN 
+    it comes from the Taylor-mode forward pass, otherwise from vmap over the 
+    points of the hessian of a single point.
+
+    Returns
+    -------
+    laplacian (torch.Tensor): tensor of size (number of points,)
+    """
+    if isinstance(as_module(model), FullyConnectedNN):
+        return taylor_forward(model,params,x)[2].reshape(-1)
+    u = nn_functional(model,params)
+    def u_point(xi):
+        return u(xi.unsqueeze(0)).squeeze()
+    hess = vmap(hessian(u_point))(x)
+    return torch.diagonal(hess,dim1=-2,dim2=-1).sum(-1)
+
+
+def compute_flatten_gradients_vectorized(model,func_params,x,mode='auto',chunk_size=None):
+    """
+    Compute the Jacobian of a network-related function w.r.t. the parameters, 
+    flattened in the same order as model.parameters(), i.e. the same matrix as 
+    compute_flatten_gradients, in one batched call.
+
+    The function has to be pointwise, i.e. the rows of func_params(params,x) 
+    for the point x[i] only depend on x[i], which is the case for the residuals 
+    of the PDE. The Jacobian of a single point is computed by jacrev or jacfwd, 
+    and vmap runs it over all the points.
+
+    Args:
+        model (nn.Module): the network, only used for its parameters and structure.
+        func_params (callable): func_params(params,*x) evaluates the function with 
+            the parameters given as a dict (see parameters_dict / nn_functional).
+        x (torch.Tensor or tuple): input data, or a tuple of tensors with the same 
+            number of rows (e.g. the points and the target values on them).
+        mode (str): 'rev' (jacrev, cost grows with the number of rows per point), 
+            'fwd' (jacfwd, cost grows with the number of parameters), 
+            'auto' picks the cheaper one from rows vs. parameter count, 
+            'loop' falls back to the row-by-row backward passes.
+            If func_params has a closed-form Jacobian (func_params.jacobian, see 
+            Fk1_functional), 'auto' and 'analytic' use it instead.
+        chunk_size (int): number of points in one vmap call, which bounds the 
+            memory. None means all the points at once.
+
+    Returns
+    -------
+    J (torch.Tensor): The Jacobian of size (number of rows, number of parameters)
+    """
+    data = x if isinstance(x,tuple) else (x,)
+    if mode in ('auto','analytic') and getattr(func_params,'jacobian',None) is not None:
+        return func_params.jacobian(parameters_dict(model),*data)
+    if mode == 'analytic':
+        mode = 'auto'
+    if mode == 'loop':
+        if isinstance(model, FunctionalModel):
+            model = model.to_module()
+        return compute_flatten_gradients(model,lambda model,x: func_params(dict(model.named_parameters()),*data),data[0])
+    params = parameters_dict(model)
+    def func_point(params,*point):
+        return func_params(params,*[p.unsqueeze(0) for p in point]).reshape(-1)
+    if mode == 'auto':
+        with torch.no_grad():
+            n_rows = func_point(params,*[d[0] for d in data]).numel()
+        n_params = sum(p.numel() for p in params.values())
+        mode = 'rev' if n_rows <= n_params else 'fwd'
+    if mode == 'rev':
+        jac_point = jacrev(func_point)
+    elif mode == 'fwd':
+        jac_point = jacfwd(func_point)
+    else:
+        raise ValueError(f"Unknown Jacobian mode: {mode}")
+    in_dims = (None,)+(0,)*len(data)
+    jac = vmap(jac_point,in_dims=in_dims,chunk_size=chunk_size)(params,*data)
+    n_rows = data[0].shape[0]*next(iter(jac.values())).shape[1]
+    return torch.cat([jac[name].reshape(n_rows,-1) for name in params],dim=1)
+
+
 def nn_x(model,x):
     x = x.clone().detach().requires_grad_(True)
     #Forward pass to compute output of the neural network
@@ -1,4 +1,5 @@
 import torch
+from Multilevel_LM.main_lm.step_solvers import STEP_SOLVERS
 
 def real_solution_1d(x):
     return torch.sin(x)
@@ -14,7 +15,9 @@ class nn_params_options:
         
 
 class LMTR_params_options:
-    def __init__(self,eta1=0.1,eta2=0.75,gamma1=0.85,gamma2=0.5,gamma3=1.5,lambda_min=1e-4,epsilon = 1e-4,max_iter=1000):
+    def __init__(self,eta1=0.1,eta2=0.75,gamma1=0.85,gamma2=0.5,gamma3=1.5,lambda_min=1e-4,epsilon = 1e-4,max_iter=1000,
+                 step_solver='direct',direct_form='auto',cg_tol=1e-6,cg_max_iter=500,preconditioner=None,nystrom_rank=20,recycle_dim=0,forcing=None,forcing_max=0.5,varpro=False,dtype=None,
+                 sketch_type='gaussian',sketch_size=None,batch_size=0.25,batch_growth=2.0,sampling='random',target_expression=None,target_cache_dir=None):
         self.eta1 = 0.1 #pho successful 
         self.eta2 = 0.75 #pho very successful
         self.gamma1 = 0.85 #step is successful but not very successful,shrink the regularization coefficient (lambda0)
@@ -24,15 +27,47 @@ class LMTR_params_options:
         self.lambda_min = 1e-4 #the minimum of the regularization coefficient
         self.epsilon = 1e-4 #the tolerance of grad_obj
         self.max_iter = 1000 # the maximum of the number of iterations
+        self.step_solver = step_solver #'direct': build A and solve As = b, 'spectral': reuse the SVD of J for every lambda, 'matrix_free': CG with Jacobian-vector products, A is never built, 'sketch': J^T J from a random sketch SJ, 'sketch_lsqr': LSQR preconditioned by SJ, 'cholesky', 'lsqr', 'lsmr', 'minres', 'pcg' (any name of STEP_SOLVERS)
+        self.direct_form = direct_form #'primal': p x p system, 'dual': rows x rows kernel system, 'auto': the smaller one
+        self.cg_tol = cg_tol #relative residual tolerance of the Krylov solvers (CG, MINRES, LSQR, LSMR)
+        self.cg_max_iter = cg_max_iter #the maximum of the number of iterations of the Krylov solvers
+        self.preconditioner = preconditioner #preconditioner of CG, None (plain CG), 'jacobi' (diagonal of A) or 'nystrom' (randomized low-rank approximation of J^T J, the fewest iterations); on the Poisson problems, Jacobi needs about 10 times more CG iterations than plain CG
+        self.nystrom_rank = nystrom_rank #number of Jacobian-vector products of the Nystrom preconditioner
+        self.forcing = forcing #inexact LM: None (tolerance cg_tol), 'gradient' or 'eisenstat_walker', the tolerance of the Krylov solvers follows the gradient norm
+        self.forcing_max = forcing_max #the maximum of the forcing terms
+        self.recycle_dim = recycle_dim #number of Ritz vectors recycled between the CG solves of consecutive iterations (they replace the preconditioner), 0 means cold-started CG
+        self.sketch_type = sketch_type #random sketch of the rows of J, 'gaussian', 'srht' or 'countsketch'
+        self.sketch_size = sketch_size #number of rows of the sketch, None means 4 times the number of parameters, the exact SVD if J has no more rows
+        self.varpro = varpro #eliminate the (linear) output layer by least squares, LM only on the hidden parameters (J is built, also for 'matrix_free')
+        self.dtype = dtype #dtype of the parameters, the collocation points and every solve, e.g. torch.float64, None keeps the one of the model
+        self.target_expression = target_expression #exact real solution as a SymPy expression in x (and y), or a callable of the symbols, for f = -laplacian u* by lambdify, None means autograd
+        self.target_cache_dir = target_cache_dir #directory of the on-disk cache of f and the boundary values, None means in memory only
+        #subsampled LMTR (LMTR_subsampled_poisson)
+        self.batch_size = batch_size #initial fraction of the interior and boundary rows in a sample
+        self.batch_growth = batch_growth #the sample grows by this factor after an unsuccessful step
+        self.sampling = sampling #'random': uniform without replacement, 'stratified': one row from each of n equal strata of the grid
         
         assert 0<eta1<=eta2<1
         assert 0<gamma2<=gamma1<1<gamma3
         assert lambda_min>0
         assert epsilon>0 
+        assert step_solver in STEP_SOLVERS
+        assert direct_form in ('primal','dual','auto')
+        assert sketch_type in ('gaussian','srht','countsketch')
+        assert preconditioner in ('jacobi','nystrom',None)
+        assert nystrom_rank>=1
+        assert recycle_dim>=0
+        assert forcing in (None,'gradient','eisenstat_walker')
+        assert 0<forcing_max<1
+        assert 0<batch_size<=1 and batch_growth>1
+        assert sampling in ('random','stratified')
 
 
 class MLM_TR_params_options:
-    def __init__(self,eta1=0.1,eta2=0.75,gamma1=0.85,gamma2=0.5,gamma3=1.5,lambda_min=1e-4,epsilon = 1e-4,kappaH = 0.1,epsilonH = 1e-4,max_iter=1000):
+    def __init__(self,eta1=0.1,eta2=0.75,gamma1=0.85,gamma2=0.5,gamma3=1.5,lambda_min=1e-4,epsilon = 1e-4,kappaH = 0.1,epsilonH = 1e-4,max_iter=1000,
+                 step_solver='direct',direct_form='auto',cg_tol=1e-6,cg_max_iter=500,preconditioner=None,nystrom_rank=20,recycle_dim=0,forcing=None,forcing_max=0.5,
+                 sketch_type='gaussian',sketch_size=None,coarse_model='relinearize',cycle='V',min_width=2,max_levels=None,smoothing_steps=1,coarse_max_iter=5,
+                 fmg_epsilon=1e-3,grid_stride=1,varpro=False,dtype=None,target_expression=None,target_cache_dir=None):
         self.eta1 = 0.1 #pho successful 
         self.eta2 = 0.75 #pho very successful
         self.gamma1 = 0.85 #step is successful but not very successful,shrink the regularization coefficient (lambda0)
@@ -44,11 +79,49 @@ class MLM_TR_params_options:
         self.kappaH = 0.1 #torch.norm(R*grad_fh) >= kappaH*torch.norm(grad_fh)
         self.epsilonH = 1e-4 #torch.norm(R*grad_fh) > epsilonH
         self.max_iter = 1000 # the maximum of the number of iterations
+        #solver of the (coarse and fine) LM subproblems, same as in LMTR_params_options
+        self.step_solver = step_solver
+        self.direct_form = direct_form
+        self.cg_tol = cg_tol
+        self.cg_max_iter = cg_max_iter
+        self.preconditioner = preconditioner
+        self.nystrom_rank = nystrom_rank
+        self.recycle_dim = recycle_dim
+        self.forcing = forcing
+        self.forcing_max = forcing_max
+        self.sketch_type = sketch_type
+        self.sketch_size = sketch_size
+        self.dtype = dtype #dtype of the parameters, the collocation points and every solve, None keeps the one of the model
+        self.target_expression = target_expression #exact real solution as a SymPy expression in x (and y), or a callable of the symbols, for f = -laplacian u* by lambdify, None means autograd
+        self.target_cache_dir = target_cache_dir #directory of the on-disk cache of f and the boundary values, None means in memory only
+        self.varpro = varpro #VarPro in the LM steps of LMTR_solving_poisson (fine fallback, nested iteration)
+        self.coarse_model = coarse_model #'relinearize': differentiate the averaged coarse network, 'galerkin': J_H = J_h P from the fine Jacobian
+        self.grid_stride = grid_stride #the coarse level of MLM_TR uses every grid_stride-th collocation point, 1 means the full grid
+        #recursive multilevel (MLM_recursive)
+        self.cycle = cycle #'V': one visit of the coarser level per cycle, 'W': two
+        self.min_width = min_width #no coarser level with fewer nodes per layer than min_width
+        self.max_levels = max_levels #maximum number of levels, None means until min_width
+        self.smoothing_steps = smoothing_steps #LM steps of a level before and after its coarse correction
+        self.coarse_max_iter = coarse_max_iter #the maximum of the number of LM steps on the coarsest level
+        #nested iteration (FMG_width_continuation)
+        self.fmg_epsilon = fmg_epsilon #the tolerance of grad_obj on the narrow networks, epsilon is used on the target width
         
         assert 0<eta1<=eta2<1
         assert 0<gamma2<=gamma1<1<gamma3
         assert lambda_min>0
         assert epsilon>0 
+        assert step_solver in STEP_SOLVERS
+        assert sketch_type in ('gaussian','srht','countsketch')
+        assert preconditioner in ('jacobi','nystrom',None)
+        assert recycle_dim>=0
+        assert forcing in (None,'gradient','eisenstat_walker')
+        assert 0<forcing_max<1
+        assert coarse_model in ('relinearize','galerkin')
+        assert cycle in ('V','W')
+        assert min_width>=1
+        assert smoothing_steps>=0
+        assert fmg_epsilon>0
+        assert grid_stride>=1
         
 
 
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In this file, we gave the random sketches S (d x m, d << m) of the rows of the
+weighted stacked Jacobian [J1/sqrt(n); sqrt(lambdap/nb)*J2] (m x p), so that
+(SJ)^T (SJ) ~ J^T J for d of a few times p:
+    - 'gaussian': S = G/sqrt(d), G with i.i.d. N(0,1) entries, O(dmp),
+    - 'srht': subsampled randomized Hadamard transform S = sqrt(m/d) P H D, 
+      with random signs D, the normalized Walsh-Hadamard transform H (the rows
+      are padded with zeros to a power of 2) and d sampled rows P, O(mp log m),
+    - 'countsketch': every row goes to one of the d rows of SJ with a random 
+      sign, O(mp), i.e. one pass over J.
+"""
+import math
+import torch
+
+
+def _fwht(X):
+    """
+    Normalized Walsh-Hadamard transform of the rows of X (n x k), n a power of 2.
+    """
+    n = X.shape[0]
+    h = 1
+    while h < n:
+        X = X.reshape(n//(2*h),2,h,-1)
+        X = torch.stack([X[:,0]+X[:,1],X[:,0]-X[:,1]],dim=1)
+        h *= 2
+    return X.reshape(n,-1)/math.sqrt(n)
+
+
+def sketch_rows(J, d, sketch_type='gaussian'):
+    """
+    SJ for a random sketch S with d rows, a new S is drawn at every call.
+
+    Args:
+        J (torch.Tensor): (m, p) matrix.
+        d (int): number of rows of the sketch.
+        sketch_type (str): 'gaussian', 'srht' or 'countsketch'.
+
+    Returns
+    -------
+    SJ (torch.Tensor): (d, p) matrix
+    """
+    m = J.shape[0]
+    if sketch_type == 'gaussian':
+        return torch.randn(d,m,dtype=J.dtype)@J/math.sqrt(d)
+    if sketch_type == 'srht':
+        n = 2**math.ceil(math.log2(m))
+        signs = torch.randint(0,2,(m,1)).to(J.dtype)*2-1
+        HDJ = _fwht(torch.nn.functional.pad(signs*J,(0,0,0,n-m)))
+        return HDJ[torch.randperm(n)[:d]]*math.sqrt(n/d)
+    if sketch_type == 'countsketch':
+        signs = torch.randint(0,2,(m,1)).to(J.dtype)*2-1
+        return torch.zeros(d,J.shape[1],dtype=J.dtype).index_add_(0,torch.randint(0,d,(m,)),signs*J)
+    raise ValueError(f"Unknown sketch: {sketch_type}")
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In this file, we gave the solvers of the LM subproblem
+    (J1^T J1/n + lambdap*J2^T J2/nb + lambdak*I) s = -(J1^T F1/n + lambdap*J2^T F2/nb + correction),
+i.e. As = b, from a PoissonIterationState. The correction is an extra linear
+term of the model (e.g. the first-order coherence term of a coarse level), it is
+zero for the usual LM step.
+
+'direct' builds A (or the smaller kernel matrix J J^T) and solves the dense
+system, 'matrix_free' runs preconditioned CG on the products
+Av = J^T(Jv) + lambdak*v, without building J or A (with the Jacobi or a
+randomized Nystrom preconditioner, or the Ritz vectors recycled from the CG 
+solves of the previous iterations), and 'spectral' reuses the SVD
+of J, so a new lambdak (e.g. after a rejected step) costs no new factorization.
+For many rows and a moderate number of parameters, 'sketch' replaces J^T J by
+(SJ)^T (SJ) for a random sketch S with a few times p rows (sketch-and-solve),
+and 'sketch_lsqr' runs LSQR on the damped least squares problem, preconditioned
+by the SVD of SJ (sketch-and-precondition), so the step is the exact one.
+'cholesky' factorizes A (the factor is kept for the same state and lambdak),
+'lsqr' and 'lsmr' solve the damped least squares problem with J v and J^T u
+only (no normal equations, so they are more accurate in float32), 'minres' and
+'pcg' (same as 'matrix_free') are Krylov solvers for As = b, and 'scipy_cg'
+hands the products Av to SciPy without copying the vectors. Everything else 
+stays in torch, in the dtype of the state (of the model).
+
+The solvers are registered in STEP_SOLVERS by name (register_step_solver), and
+compute_lm_step reports the iterations, the relative residual ||As-b||/||b||
+and the time of every backend, so they can be compared on a problem.
+"""
+import time
+import numpy as np
+import torch
+from scipy.sparse.linalg import cg as scipy_cg
+from Multilevel_LM.main_lm.krylov import pcg,lsqr,lsmr,minres,ritz_pairs,as_scipy_operator
+
+
+#name -> solver(state,lambdak,options,correction=None,recycler=None,tol=None),
+#which returns the step s and a dict of information
+STEP_SOLVERS = {}
+
+
+def register_step_solver(*names):
+    """
+    Decorator, which adds the solver to STEP_SOLVERS under the names, so it 
+    can be chosen by options.step_solver.
+    """
+    def register(solver):
+        for name in names:
+            STEP_SOLVERS[name] = solver
+        return solver
+    return register
+
+
+def _rhs(state,correction):
+    g = state.sub_b().flatten()
+    if correction is not None:
+        g = g+correction.to(g.dtype)
+    return g
+
+
+@register_step_solver('direct')
+def direct_step(state,lambdak,options=None,correction=None,**kwargs):
+    """
+    Dense solve of As = b, in torch and in the dtype of the state. With fewer residual rows m than parameters p, the same 
+    step comes from the m x m dual (kernel) system, by the push-through identity
+        (J^T J + lambdak*I)^{-1} J^T = J^T (J J^T + lambdak*I)^{-1},
+    where J is the weighted stacked Jacobian, i.e. s = -J^T (J J^T + lambdak*I)^{-1} F.
+    With a correction, the right-hand side is not in the range of J^T, and the 
+    Woodbury identity gives s = -(g - J^T (J J^T + lambdak*I)^{-1} J g)/lambdak.
+    options.direct_form chooses 'primal', 'dual' or 'auto' (the smaller system).
+    """
+    form = 'primal' if options is None else options.direct_form
+    if form == 'auto':
+        form = 'dual' if state.n_rows < state.s_size else 'primal'
+    if form == 'dual':
+        K = state.JJT.clone()
+        K.diagonal().add_(lambdak)
+        J = state.stacked_J
+        if correction is None:
+            y = torch.linalg.solve(K,state.stacked_F)
+            s = (-1)*J.T@y
+        else:
+            g = _rhs(state,correction)
+            y = torch.linalg.solve(K,J@g)
+            s = (-1)*(g-J.T@y)/lambdak
+        return s, {'iterations': 1, 'form': 'dual'}
+    A = state.sub_A(lambdak)
+    b = (-1)*_rhs(state,correction)
+    return torch.linalg.solve(A,b), {'iterations': 1, 'form': 'primal'}
+
+
+@register_step_solver('spectral')
+def spectral_step(state,lambdak,options=None,correction=None,**kwargs):
+    """
+    Solve As = b from the thin SVD J = U diag(S) V^T of the weighted stacked 
+    Jacobian, kept in the state. Then A = V diag(S^2) V^T + lambdak*I and
+        s = -V diag(S/(S^2+lambdak)) U^T F,
+    plus, with a correction g, the part of g outside of the range of V divided 
+    by lambdak. Once the SVD is there, any lambdak costs O((m+p)k) with 
+    k = min(m,p), so a run of rejected steps costs almost nothing.
+    """
+    U, S, Vh = state.svd
+    if correction is None:
+        s = (-1)*Vh.T@(S/(S**2+lambdak)*(U.T@state.stacked_F))
+    else:
+        g = _rhs(state,correction)
+        Vg = Vh@g
+        s = (-1)*(Vh.T@(Vg/(S**2+lambdak))+(g-Vh.T@Vg)/lambdak)
+    return s, {'iterations': 1}
+
+
+def nystrom_preconditioner(state,lambdak,rank=20):
+    """
+    Inverse of the Nystrom preconditioner of A = JTJ + lambdak*I, from the 
+    approximation U diag(Lam) U^T of JTJ (state.nystrom):
+        M^{-1} r = (Lam_min+lambdak) U diag(1/(Lam+lambdak)) U^T r + (I - U U^T) r,
+    so the dominant eigenvalues of A are mapped close to Lam_min+lambdak, and 
+    CG converges in a number of iterations driven by the remaining spectrum.
+    """
+    U, Lam = state.nystrom(rank)
+    def M(r):
+        Ur = U.T@r
+        return (Lam[-1]+lambdak)*(U@(Ur/(Lam+lambdak)))+r-U@Ur
+    return M
+
+
+class KrylovRecycler:
+    """
+    Ritz pairs of the LM matrix, recycled from one CG solve to the next, since
+    consecutive systems are close: the same J with another lambdak after a 
+    rejected step, a slightly different J after an accepted one.
+    The Ritz vectors W (orthonormal) and values eta of JTJ give the limited
+    memory preconditioner of the next solve, of the same form as the Nystrom one,
+        M^{-1} r = (eta_min+lambdak) W diag(1/(eta+lambdak)) W^T r + (I - W W^T) r,
+    and its initial guess W diag(1/(eta+lambdak)) W^T b. They are then updated
+    by Rayleigh-Ritz on W and the first search directions of CG (pcg n_keep).
+    HW = JTJ W is kept for the state it was computed on, so a new lambdak costs
+    nothing, and a new state dim Gauss-Newton products.
+    """
+    def __init__(self, dim):
+        self.dim = dim #number of recycled Ritz vectors
+        self.W = None
+        self.HW = None
+        self.state = None
+        self.iterations = 0 #total number of CG iterations of the run
+
+    def solve(self, state, lambdak, b, M=None, tol=1e-6, max_iter=None):
+        """
+        CG on the LM matrix of state, M is only used until there are Ritz vectors.
+        """
+        if self.W is not None and self.W.shape[0] != state.s_size:
+            self.W = None
+        x0 = None
+        if self.W is not None:
+            if self.state is not state:
+                self.HW = torch.stack([state.gauss_newton_times(w,0) for w in self.W.T],dim=1)
+                self.state = state
+            #Ritz values of JTJ in span(W)
+            G = self.W.T@self.HW
+            eta, Y = torch.linalg.eigh(0.5*(G+G.T))
+            W, eta = self.W@Y, torch.clamp(eta,min=0)
+            d = 1/(eta+lambdak)
+            def M(r):
+                Wr = W.T@r
+                return (eta[0]+lambdak)*(W@(d*Wr))+r-W@Wr
+            x0 = W@(d*(W.T@b))
+        apply_A = lambda v: state.gauss_newton_times(v,lambdak)
+        s, info = pcg(apply_A,b,M=M,x0=x0,tol=tol,max_iter=max_iter,n_keep=self.dim)
+        P, AP = info.pop('directions')
+        if self.W is not None:
+            P = torch.cat([self.W,P],dim=1)
+            AP = torch.cat([self.HW+lambdak*self.W,AP],dim=1)
+        if P.shape[1] > 0:
+            self.W, AW = ritz_pairs(P,AP,self.dim)
+            self.HW = AW-lambdak*self.W
+            self.state = state
+        self.iterations += info['iterations']
+        return s, info
+
+
+@register_step_solver('matrix_free','pcg')
+def matrix_free_step(state,lambdak,options,correction=None,recycler=None,tol=None):
+    """
+    Preconditioned CG on the products Av, preconditioned by the Ritz vectors of
+    the previous solves if a KrylovRecycler is given.
+    """
+    b = (-1)*_rhs(state,correction)
+    apply_A = lambda v: state.gauss_newton_times(v,lambdak)
+    M = None
+    if options.preconditioner == 'jacobi':
+        diag = state.gauss_newton_diagonal()+lambdak
+        M = lambda r: r/diag
+    if options.preconditioner == 'nystrom':
+        M = nystrom_preconditioner(state,lambdak,options.nystrom_rank)
+    if tol is None:
+        tol = options.cg_tol
+    if recycler is not None:
+        return recycler.solve(state,lambdak,b,M=M,tol=tol,max_iter=options.cg_max_iter)
+    return pcg(apply_A,b,M=M,tol=tol,max_iter=options.cg_max_iter)
+
+
+@register_step_solver('sketch')
+def sketch_step(state,lambdak,options,correction=None,**kwargs):
+    """
+    Sketch-and-solve: As = b with J^T J replaced by (SJ)^T (SJ) = V diag(S^2) V^T
+    from state.sketched_svd, and the exact right-hand side g, i.e.
+        s = -(V diag(1/(S^2+lambdak)) V^T g + (g - V V^T g)/lambdak).
+    Without enough rows in the sketch, pred (of the exact model) can be 
+    negative, and the drivers reject the step.
+    """
+    U, S, Vh = state.sketched_svd(options.sketch_type,options.sketch_size)
+    g = _rhs(state,correction)
+    Vg = Vh@g
+    s = (-1)*(Vh.T@(Vg/(S**2+lambdak))+(g-Vh.T@Vg)/lambdak)
+    return s, {'iterations': 1}
+
+
+def _damped_operators(state,lambdak,correction=None,apply_N=None):
+    """
+    Operators v -> [J; sqrt(lambdak) I] N v, u -> N^T [J; sqrt(lambdak) I]^T u
+    and the right-hand side -[F; correction/sqrt(lambdak)] of the damped least
+    squares problem, whose normal equations are As = b (N = I if apply_N is 
+    None, otherwise a symmetric right preconditioner). J is the weighted 
+    stacked Jacobian, only used by J_times and JT_times.
+    """
+    sqrt_lambdak = np.sqrt(lambdak)
+    w1 = 1/np.sqrt(state.sample_num)
+    w2 = np.sqrt(state.lambdap/state.boundary_num)
+    n1 = state.F1.numel()
+    if apply_N is None:
+        apply_N = lambda v: v
+    def apply_A(v):
+        Nv = apply_N(v)
+        J1v, J2v = state.J_times(Nv)
+        return torch.cat([w1*J1v.flatten(),w2*J2v.flatten(),sqrt_lambdak*Nv])
+    def apply_AT(u):
+        n2 = u.numel()-n1-state.s_size
+        return apply_N(state.JT_times(w1*u[:n1],w2*u[n1:n1+n2])+sqrt_lambdak*u[n1+n2:])
+    F = state.stacked_F
+    c = torch.zeros(state.s_size,dtype=F.dtype) if correction is None else correction.to(F.dtype)
+    return apply_A, apply_AT, (-1)*torch.cat([F,c/sqrt_lambdak])
+
+
+@register_step_solver('sketch_lsqr')
+def sketch_lsqr_step(state,lambdak,options,correction=None,tol=None,**kwargs):
+    """
+    Sketch-and-precondition: LSQR on the damped least squares problem
+        min ||[J; sqrt(lambdak) I] s + [F; correction/sqrt(lambdak)]||,
+    whose normal equations are As = b, with the right preconditioner
+        N = V diag((S^2+lambdak)^{-1/2}) V^T + (I - V V^T)/sqrt(lambdak)
+    from the SVD of SJ, so [J; sqrt(lambdak) I] N is well conditioned and LSQR 
+    converges in a few iterations (options.cg_tol, options.cg_max_iter).
+    """
+    U, S, Vh = state.sketched_svd(options.sketch_type,options.sketch_size)
+    sqrt_lambdak = np.sqrt(lambdak)
+    d = 1/torch.sqrt(S**2+lambdak)
+    def apply_N(y):
+        Vy = Vh@y
+        return Vh.T@(d*Vy)+(y-Vh.T@Vy)/sqrt_lambdak
+    apply_A, apply_AT, b = _damped_operators(state,lambdak,correction,apply_N)
+    y, info = lsqr(apply_A,apply_AT,b,tol=options.cg_tol if tol is None else tol,max_iter=options.cg_max_iter)
+    return apply_N(y), info
+
+
+@register_step_solver('lsqr','lsmr')
+def least_squares_step(state,lambdak,options,correction=None,tol=None,**kwargs):
+    """
+    LSQR or LSMR (options.step_solver) on the damped least squares problem
+    of sketch_lsqr_step, without preconditioner, from J v and J^T u only.
+    """
+    apply_A, apply_AT, b = _damped_operators(state,lambdak,correction)
+    solver = lsmr if options.step_solver == 'lsmr' else lsqr
+    return solver(apply_A,apply_AT,b,tol=options.cg_tol if tol is None else tol,max_iter=options.cg_max_iter)
+
+
+@register_step_solver('minres')
+def minres_step(state,lambdak,options,correction=None,tol=None,**kwargs):
+    """
+    Preconditioned MINRES on the products Av, with the preconditioner of 
+    matrix_free_step ('jacobi', 'nystrom' or None).
+    """
+    b = (-1)*_rhs(state,correction)
+    apply_A = lambda v: state.gauss_newton_times(v,lambdak)
+    M = None
+    if options.preconditioner == 'jacobi':
+        diag = state.gauss_newton_diagonal()+lambdak
+        M = lambda r: r/diag
+    if options.preconditioner == 'nystrom':
+        M = nystrom_preconditioner(state,lambdak,options.nystrom_rank)
+    return minres(apply_A,b,M=M,tol=options.cg_tol if tol is None else tol,max_iter=options.cg_max_iter)
+
+
+@register_step_solver('scipy_cg')
+def scipy_cg_step(state,lambdak,options,correction=None,tol=None,**kwargs):
+    """
+    CG of SciPy on the products Av, through as_scipy_operator, so the vectors
+    are shared with NumPy without copy (Jacobi preconditioner if 
+    options.preconditioner is 'jacobi').
+    """
+    b = (-1)*_rhs(state,correction)
+    A = as_scipy_operator(lambda v: state.gauss_newton_times(v,lambdak),state.s_size,b.dtype)
+    M = None
+    if options.preconditioner == 'jacobi':
+        diag = state.gauss_newton_diagonal()+lambdak
+        M = as_scipy_operator(lambda r: r/diag,state.s_size,b.dtype)
+    iterations = []
+    s, flag = scipy_cg(A,b.detach().numpy(),rtol=options.cg_tol if tol is None else tol,maxiter=options.cg_max_iter,
+                       M=M,callback=iterations.append)
+    return torch.from_numpy(s), {'iterations': len(iterations), 'flag': flag}
+
+
+@register_step_solver('cholesky')
+def cholesky_step(state,lambdak,options=None,correction=None,**kwargs):
+    """
+    Dense Cholesky factorization of A = JTJ + lambdak*I (state.cholesky, kept 
+    for the same state and lambdak, e.g. for several right-hand sides), half 
+    the cost of the LU factorization of direct_step.
+    """
+    L = state.cholesky(lambdak)
+    b = (-1)*_rhs(state,correction)
+    return torch.cholesky_solve(b.unsqueeze(1).to(L.dtype),L).flatten(), {'iterations': 1}
+
+
+def forcing_term(options,grad_norm,prev_grad_norm=None,prev_forcing=None):
+    """
+    Relative tolerance of the iterative solvers for the inexact LM step, 
+    options.forcing:
+        - None: options.cg_tol, i.e. the exact step,
+        - 'gradient': min(forcing_max, sqrt(||g_k||)),
+        - 'eisenstat_walker': choice 2 of Eisenstat and Walker,
+          0.9*(||g_k||/||g_{k-1}||)^2, safeguarded by 0.9*eta_{k-1}^2 when it 
+          is above 0.1, and also capped by sqrt(||g_k||),
+    never below options.cg_tol, so the steps are cheap far from the solution
+    and exact near it. prev_forcing is None after a rejected step (no safeguard).
+    """
+    if options.forcing is None:
+        return options.cg_tol
+    eta = np.sqrt(float(grad_norm))
+    if options.forcing == 'eisenstat_walker' and prev_grad_norm is not None:
+        eta_ew = 0.9*float(grad_norm/prev_grad_norm)**2
+        if prev_forcing is not None and 0.9*prev_forcing**2 > 0.1:
+            eta_ew = max(eta_ew,0.9*prev_forcing**2)
+        eta = min(eta,eta_ew)
+    return float(max(options.cg_tol,min(options.forcing_max,eta)))
+
+
+def compute_lm_step(state,lambdak,options,correction=None,recycler=None,tol=None):
+    """
+    Solve the LM subproblem with the solver STEP_SOLVERS[options.step_solver].
+    recycler (KrylovRecycler) is only used by 'matrix_free', tol (e.g. from 
+    forcing_term) replaces options.cg_tol in the Krylov solvers. They start 
+    from 0 (or from a Galerkin guess with a recycler) and reduce the LM model
+    at every iteration, so an inexact step still has pred > 0 and the ratio 
+    test of the trust region is unchanged.
+
+    Returns
+    -------
+    s (torch.Tensor): the step
+    info (dict): information of the solver, at least the number of 
+        'iterations', the relative 'residual' ||As-b||/||b|| and the 'time'
+    """
+    if options.step_solver not in STEP_SOLVERS:
+        raise ValueError(f"Unknown step solver: {options.step_solver}")
+    start = time.perf_counter()
+    s, info = STEP_SOLVERS[options.step_solver](state,lambdak,options,correction,recycler=recycler,tol=tol)
+    info['time'] = time.perf_counter()-start
+    #true relative residual of As = b, the same measure for every backend
+    b = (-1)*_rhs(state,correction)
+    s = s.flatten()
+    info['residual'] = (torch.norm(state.gauss_newton_times(s.to(b.dtype),lambdak)-b)/torch.norm(b)).item()
+    return s, info
@@ -8,102 +8,103 @@ here, sub_A_solving_poisson is A, but sub_b_solving_poisson is actually -b.
 import numpy as np
 import torch
 from Multilevel_LM.main_lm.PoissonPDE import PoissonPDE
-from Multilevel_LM.main_lm.loss_poisson import get_1d_boundary, get_2d_boundary
-from Multilevel_LM.main_lm.neural_network_construction import compute_flatten_gradients
+from Multilevel_LM.main_lm.target_data import poisson_target
+from Multilevel_LM.main_lm.collocation import collocation_set
+from Multilevel_LM.main_lm.neural_network_construction import compute_flatten_gradients_vectorized,nn_functional,nn_laplacian_functional,is_single_hidden_layer,single_hidden_layer_jacobian
 def Fk1_solving_poisson(real_solution,model,x,regularization=True,lambdap = 0.1):
-    input_dim = model.hidden_layers[0].in_features
-    
-    if input_dim == 1:
-        pde_1d = PoissonPDE(real_solution,x)
-        real_source = pde_1d._compute_1d_source_term(x)
-        nn_pde = PoissonPDE(model,x)
-        nn_source = nn_pde._compute_1d_source_term(x)
-        main_cost = (real_source-nn_source)
-        
-        
-    if input_dim == 2:
-        
-        pde_2d = PoissonPDE(real_solution,x)
-        real_source = pde_2d._compute_2d_source_term(x).reshape(-1,1)
-        nn_pde = PoissonPDE(model,x)
-        nn_source = nn_pde._compute_2d_source_term(x).reshape(-1,1)
-        main_cost = (real_source-nn_source)
-        
+    real_source = poisson_target(real_solution).source(x)
+    #1D, 2D, 3D, ...: the Laplacian is the sum over the input_dim coordinates
+    nn_pde = PoissonPDE(model,x)
+    nn_source = nn_pde.compute_source_term(x).reshape(-1,1)
+    main_cost = (real_source-nn_source)
     return main_cost
 
 
 def Fk2_solving_poisson(real_solution,model,x,regularization=True,lambdap = 0.1):
-    input_dim = model.hidden_layers[0].in_features
-    if input_dim == 1:
-        x_boundary = get_1d_boundary(x).reshape(-1,1)
-        real = real_solution(x_boundary)
-        nn = model(x_boundary)
-        re_term = real-nn
-        
-    if input_dim == 2:
-        x_boundary = get_2d_boundary(x)
-        real = real_solution(x_boundary).reshape(-1,1)
-        nn = model(x_boundary)
-        re_term = real-nn
-        
+    x_boundary = collocation_set(x).x_boundary
+    real = poisson_target(real_solution).boundary_values(x_boundary)
+    nn = model(x_boundary)
+    re_term = real-nn
     return re_term
 
 
-def Jk1_solving_poisson(real_solution,model,x,regularization=True,lambdap = 0.1):
-    Fk1 = lambda model,x: Fk1_solving_poisson(real_solution, model, x)
-    return compute_flatten_gradients(model,Fk1,x)
+def Fk1_functional(real_solution,model,x):
+    """
+    Fk1 as a function of the parameters, which is the input of the vectorized 
+    Jacobian engine. The real source term does not depend on the parameters, 
+    so it comes from the target data (poisson_target) and is passed along 
+    with the points.
+    For a network with one hidden layer, Fk1.jacobian is the closed-form 
+    Jacobian (single_hidden_layer_jacobian), which the Jacobian engine uses.
+
+    Returns
+    -------
+    Fk1 (callable): Fk1(params,x,real_source)
+    data (tuple): (x,real_source), the pointwise inputs of Fk1
+    """
+    real_source = poisson_target(real_solution).source(x)
+    def Fk1(params,x,real_source):
+        #nn_source = -laplacian of the network
+        nn_source = -nn_laplacian_functional(model,params,x).reshape(-1,1)
+        return real_source-nn_source
+    if is_single_hidden_layer(model):
+        #Fk1 = real_source + laplacian, so J1 is the Jacobian of the laplacian
+        Fk1.jacobian = lambda params,x,real_source: single_hidden_layer_jacobian(model,params,x,laplacian=True)[1]
+    return Fk1,(x.detach(),real_source)
 
-def Jk2_solving_poisson(real_solution,model,x,regularization=True,lambdap = 0.1):
-    Fk2 = lambda model,x: Fk2_solving_poisson(real_solution, model, x,regularization=True,lambdap = 0.1)
-    return compute_flatten_gradients(model,Fk2,x)
+
+def Fk2_functional(real_solution,model,x):
+    """
+    Fk2 as a function of the parameters, see Fk1_functional.
+
+    Returns
+    -------
+    Fk2 (callable): Fk2(params,x_boundary,real)
+    data (tuple): (x_boundary,real), the pointwise inputs of Fk2
+    """
+    x_boundary = collocation_set(x).x_boundary
+    real = poisson_target(real_solution).boundary_values(x_boundary)
+    def Fk2(params,x_boundary,real):
+        return real-nn_functional(model,params)(x_boundary)
+    if is_single_hidden_layer(model):
+        Fk2.jacobian = lambda params,x_boundary,real: -single_hidden_layer_jacobian(model,params,x_boundary)[1]
+    return Fk2,(x_boundary.detach(),real)
+
+
+def Jk1_solving_poisson(real_solution,model,x,regularization=True,lambdap = 0.1,mode='auto'):
+    Fk1,data = Fk1_functional(real_solution,model,x)
+    return compute_flatten_gradients_vectorized(model,Fk1,data,mode)
+
+def Jk2_solving_poisson(real_solution,model,x,regularization=True,lambdap = 0.1,mode='auto'):
+    Fk2,data = Fk2_functional(real_solution,model,x)
+    return compute_flatten_gradients_vectorized(model,Fk2,data,mode)
 
 def sub_A_solving_poisson(real_solution,model,x,lambdak,regularization=True,lambdap = 0.1):
-    input_dim = model.hidden_layers[0].in_features
-    s_size = sum(p.numel() for p in model.parameters())
-    if input_dim == 1:
-        sample_num = x.shape[0]-2
-        J1 = Jk1_solving_poisson(real_solution,model,x)
-        
-        J2 = Jk2_solving_poisson(real_solution, model, x)
-        boundary_num = 2
-        
-    if input_dim == 2:
-        sample_num = (np.sqrt(x.shape[0])-1)**2 
-        J1 = Jk1_solving_poisson(real_solution, model, x)
-        J2 = Jk2_solving_poisson(real_solution, model, x)
-        boundary_num = x.shape[0]-sample_num
-    return J1.T @ J1/sample_num+lambdap*J2.T@J2/boundary_num+lambdak*torch.eye(s_size)
+    points = collocation_set(x)
+    J1 = Jk1_solving_poisson(real_solution,model,x)
+    J2 = Jk2_solving_poisson(real_solution,model,x)
+    A = J1.T @ J1/points.sample_num+lambdap*J2.T@J2/points.boundary_num
+    A.diagonal().add_(lambdak)
+    return A
 
 
 
 def sub_b_solving_poisson(real_solution,model,x,lambdak,regularization=True,lambdap = 0.1):
-    input_dim = model.hidden_layers[0].in_features
+    points = collocation_set(x)
     F1 = Fk1_solving_poisson(real_solution, model, x)
     J1 = Jk1_solving_poisson(real_solution, model, x)
     F2 = Fk2_solving_poisson(real_solution, model, x)
     J2 = Jk2_solving_poisson(real_solution, model, x)
-    if input_dim == 1:
-        sample_num = x.shape[0]-2
-        boundary_num = 2
-    if input_dim == 2:
-        sample_num = (np.sqrt(x.shape[0])-1)**2 
-        boundary_num = x.shape[0]-sample_num
-    return J1.T@F1/sample_num+lambdap*J2.T@F2/boundary_num
+    return J1.T@F1/points.sample_num+lambdap*J2.T@F2/points.boundary_num
     
 def Taylor_solver(real_solution,model,x,lambdak,s,regularization=True,lambdap=0.1):
-    input_dim = model.hidden_layers[0].in_features
+    points = collocation_set(x)
     F1 = Fk1_solving_poisson(real_solution, model, x)
     J1 = Jk1_solving_poisson(real_solution, model, x)
     F2 = Fk2_solving_poisson(real_solution, model, x)
     J2 = Jk2_solving_poisson(real_solution, model, x)
-    if input_dim == 1:
-        sample_num = x.shape[0]-2
-        boundary_num = 2
-    if input_dim == 2:
-        sample_num = (np.sqrt(x.shape[0])-1)**2 
-        boundary_num = x.shape[0]-sample_num
-    m1 = (torch.norm(F1)**2+2*F1.T@J1@s+s.T@J1.mT@J1@s)/(2*sample_num)
-    m2 = lambdap*(torch.norm(F2)**2+2*F2.T@J2@s+s.T@J2.mT@J2@s)/(2*boundary_num)
+    m1 = (torch.norm(F1)**2+2*F1.T@J1@s+s.T@J1.mT@J1@s)/(2*points.sample_num)
+    m2 = lambdap*(torch.norm(F2)**2+2*F2.T@J2@s+s.T@J2.mT@J2@s)/(2*points.boundary_num)
     m3 = 0.5*lambdak*torch.norm(s)**2
     return m1+m2+m3
     
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In this file, we gave the target data of the Poisson problem, i.e. the source
+term f = -laplacian u* on the collocation points and the values of u* on the
+boundary points. They do not depend on the network, so PoissonTarget computes
+them once per (real solution, points), either with autograd (PoissonPDE) or
+from an exact SymPy expression of u* (lambdify, as in derivative_check.py),
+and keeps them in memory and, optionally, in an on-disk cache.
+
+The cache key is a hash of the points (values, shape, dtype) and of the
+function, i.e. its bytecode, constants, defaults, closure and the module-level
+names it uses (e.g. a frequency k in sin(k*x)), or the parameters for a 
+network, so editing the function or these names gives a new key. The memory
+cache keeps the last _TARGET_CACHE_SIZE values.
+"""
+import hashlib
+import os
+import types
+from collections import OrderedDict
+import numpy as np
+import torch
+from Multilevel_LM.main_lm.PoissonPDE import PoissonPDE
+
+#in-memory cache, hash -> tensor, shared by all the PoissonTarget, least recently used first
+_TARGET_CACHE = OrderedDict()
+_TARGET_CACHE_SIZE = 32
+
+
+def _value_key(value, h, seen=None):
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu().numpy()
+    if isinstance(value, np.ndarray):
+        h.update(str((value.shape, value.dtype)).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif hasattr(value, '__code__') or hasattr(value, 'named_parameters'):
+        _function_key(value, h, seen)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _value_key(v, h, seen)
+    else:
+        h.update(repr(value).encode())
+
+
+def _code_key(code, h, fn_globals=None, seen=None):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    #values of the global names, the attribute names (np.pi) are not globals
+    for name in code.co_names:
+        if fn_globals is not None and name in fn_globals:
+            value = fn_globals[name]
+            h.update(name.encode())
+            if isinstance(value, types.ModuleType):
+                h.update(value.__name__.encode())
+            else:
+                _value_key(value, h, seen)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            _code_key(const, h, fn_globals, seen)
+        else:
+            h.update(repr(const).encode())
+
+
+def _function_key(fn, h, seen=None):
+    """
+    Update the hash h with the function fn: the parameters of a network, the
+    code, defaults, closure and used globals of a Python function, and repr 
+    for anything else. seen holds the functions already in the hash (recursion).
+    """
+    if hasattr(fn, 'named_parameters'):
+        h.update(type(fn).__name__.encode())
+        for name, p in fn.named_parameters():
+            h.update(name.encode())
+            _value_key(p, h)
+        return
+    code = getattr(fn, '__code__', None)
+    if code is None:
+        h.update(repr(fn).encode())
+        return
+    h.update(f"{fn.__module__}.{fn.__qualname__}".encode())
+    seen = set() if seen is None else seen
+    if id(fn) in seen:
+        return
+    seen.add(id(fn))
+    _code_key(code, h, getattr(fn, '__globals__', None), seen)
+    _value_key(fn.__defaults__, h, seen)
+    for cell in fn.__closure__ or ():
+        _value_key(cell.cell_contents, h, seen)
+
+
+def _sympy_functions(expression, input_dim):
+    """
+    u* and f = -laplacian u* as numpy functions of the coordinates, from a SymPy
+    expression of the symbols x (1D), x, y (2D) or x, y, z (3D), or a callable
+    of these symbols.
+    """
+    import sympy as sp
+    symbols = sp.symbols('x y z')[:input_dim]
+    u = expression(*symbols) if callable(expression) else sp.sympify(expression)
+    f = -sum(sp.diff(u, s, 2) for s in symbols)
+    return sp.lambdify(symbols, u, 'numpy'), sp.lambdify(symbols, f, 'numpy')
+
+
+class PoissonTarget:
+    """
+    The real solution u* with its target data. It is callable like u*, so it can
+    replace real_solution everywhere, and source(x) / boundary_values(x_boundary)
+    are computed once per set of points.
+
+    Parameters:
+    - real_solution: the real solution u*, a function of x of size (N, input_dim).
+    - expression: None (autograd), or the exact u* as a SymPy expression in the
+      symbols x (1D), x, y (2D) or x, y, z (3D), or a callable of these symbols, e.g.
+      lambda x, y: sympy.sin(x)*y**2.
+    - cache_dir: directory of the on-disk cache, None means in memory only.
+    """
+    def __init__(self, real_solution, expression=None, cache_dir=None):
+        self.real_solution = real_solution
+        self.expression = expression
+        self.cache_dir = cache_dir
+        self._sympy = None
+        h = hashlib.sha256()
+        _function_key(real_solution, h)
+        if expression is not None:
+            h.update(b'sympy')
+            _value_key(expression, h)
+        self._key = h.hexdigest()
+
+    def __call__(self, x):
+        return self.real_solution(x)
+
+    def _exact(self, input_dim):
+        if self._sympy is None:
+            self._sympy = _sympy_functions(self.expression, input_dim)
+        return self._sympy
+
+    def _cached(self, kind, x, compute):
+        h = hashlib.sha256(f"{kind}{self._key}".encode())
+        _value_key(x, h)
+        key = h.hexdigest()
+        path = None if self.cache_dir is None else os.path.join(self.cache_dir, f"poisson_{kind}_{key[:32]}.pt")
+        if key in _TARGET_CACHE:
+            value = _TARGET_CACHE[key]
+            _TARGET_CACHE.move_to_end(key)
+        elif path is not None and os.path.exists(path):
+            value = torch.load(path)
+        else:
+            with torch.enable_grad():
+                value = compute(x.detach().clone()).detach().reshape(-1,1).to(x.dtype)
+        _TARGET_CACHE[key] = value
+        while len(_TARGET_CACHE) > _TARGET_CACHE_SIZE:
+            _TARGET_CACHE.popitem(last=False)
+        if path is not None and not os.path.exists(path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            torch.save(value, path)
+        return value
+
+    def _evaluate_exact(self, x, which):
+        func = self._exact(x.shape[1])[which]
+        coords = [c for c in x.detach().cpu().double().numpy().T]
+        #a constant expression gives a scalar
+        return torch.as_tensor(np.broadcast_to(func(*coords), (x.shape[0],)).copy())
+
+    def source(self, x):
+        """
+        f = -laplacian u* on the points x, of size (N, 1).
+        """
+        if self.expression is not None:
+            return self._cached('source', x, lambda x: self._evaluate_exact(x, 1))
+        return self._cached('source', x, lambda x: PoissonPDE(self.real_solution, x).compute_source_term(x))
+
+    def boundary_values(self, x_boundary):
+        """
+        u* on the boundary points x_boundary, of size (Nb, 1).
+        """
+        if self.expression is not None:
+            return self._cached('boundary', x_boundary, lambda x: self._evaluate_exact(x, 0))
+        return self._cached('boundary', x_boundary, self.real_solution)
+
+
+def poisson_target(real_solution, expression=None, cache_dir=None):
+    """
+    real_solution as a PoissonTarget, unchanged if it is already one.
+    """
+    if isinstance(real_solution, PoissonTarget):
+        return real_solution
+    return PoissonTarget(real_solution, expression, cache_dir)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In this file, we gave the variable projection (VarPro) for the linear output
+layer of FullyConnectedNN. The residuals are linear in the output layer
+parameters c = (output_layer.weight, output_layer.bias), i.e.
+    F(theta, c) = y - Phi(theta) c,
+so for fixed hidden parameters theta, the optimal c solves a linear least
+squares problem, and -Phi is the block of columns of the (weighted stacked)
+Jacobian for c, which does not depend on c.
+
+eliminate_output_layer sets c to its optimal value, and VarProState is the LM
+subproblem in theta only, with the Kaufman Jacobian
+    J_K = (I - Q Q^T) J_theta,   Q = orthonormal basis of range(J_c),
+which is the Jacobian of the projected residual to first order.
+"""
+import torch
+from Multilevel_LM.main_lm.iteration_state import PoissonIterationState
+from Multilevel_LM.main_lm.neural_network_construction import to_functional_model
+
+
+def output_layer_mask(model):
+    """
+    Boolean mask of the output layer parameters in the flattened parameters.
+    """
+    return torch.cat([torch.full((p.numel(),),name.startswith('output_layer'))
+                      for name, p in model.named_parameters()])
+
+
+def _range_basis(J_c):
+    """
+    Truncated SVD of J_c, without the singular values below the rounding level,
+    since the features of the hidden layer are often nearly dependent.
+    """
+    U, S, Vh = torch.linalg.svd(J_c,full_matrices=False)
+    keep = S > S[0]*max(J_c.shape)*torch.finfo(J_c.dtype).eps
+    return U[:,keep], S[keep], Vh[keep]
+
+
+def eliminate_output_layer(state):
+    """
+    State of the model with the optimal output layer for its hidden parameters,
+    i.e. the minimizer in c of the loss (weighted by state.loss_weights), which
+    is one Gauss-Newton step in c since the residuals are linear in c.
+    """
+    if state.matrix_free:
+        raise ValueError("VarPro needs the Jacobians, it can not be used with the matrix_free step solver")
+    mask = output_layer_mask(state.model)
+    w = state.loss_weights.unsqueeze(1)
+    J_c = w*torch.cat([state.J1,state.J2])[:,mask]
+    F = w*torch.cat([state.F1,state.F2]).reshape(-1,1)
+    U, S, Vh = _range_basis(J_c)
+    s_c = -(Vh.T@((U.T@F)/S.unsqueeze(1))).flatten()
+    s = torch.zeros(state.s_size,dtype=s_c.dtype)
+    s[mask] = s_c
+    return state.new_state(to_functional_model(state.model).step(s))
+
+
+def least_squares_output_layer(real_solution,model,x,regularization=True,lambdap=0.1):
+    """
+    Least squares initialization of the output layer: the model (FunctionalModel)
+    with the same hidden parameters and the optimal output layer.
+    """
+    state = PoissonIterationState(real_solution,to_functional_model(model),x,regularization=regularization,lambdap=lambdap)
+    return eliminate_output_layer(state).model
+
+
+class VarProState(PoissonIterationState):
+    """
+    LM subproblem in the hidden parameters of a state whose output layer is
+    optimal (see eliminate_output_layer), with the Kaufman Jacobian. The rows 
+    are weighted by the loss weights of the state (sample_num = boundary_num = 
+    lambdap = 1 here), so the model is the one of the loss, the residual is
+    orthogonal to range(J_c), and sub_b is the gradient of the loss w.r.t. the
+    hidden parameters. full_step(s) puts a step back into all the parameters.
+    """
+    def __init__(self, state):
+        if state.matrix_free:
+            raise ValueError("VarPro needs the Jacobians, it can not be used with the matrix_free step solver")
+        self.full = state
+        for name in ['real_solution','x','regularization','jacobian_mode','matrix_free','functionals',
+                     'loss_rows','loss_boundary_num','model']:
+            setattr(self,name,getattr(state,name))
+        self.sample_num = 1
+        self.boundary_num = 1
+        self.lambdap = 1
+        self.mask = output_layer_mask(state.model)
+        self.s_size = int((~self.mask).sum())
+        w = state.loss_weights
+        self.n1 = state.F1.numel()
+        self._F1 = w[:self.n1].reshape(state.F1.shape)*state.F1
+        self._F2 = w[self.n1:].reshape(state.F2.shape)*state.F2
+        self._w = w.unsqueeze(1)
+        self._J1 = None
+        self._J2 = None
+        self._JTJ = None
+        self._JJT = None
+        self._svd = None
+        self._sketched_svd = None
+        self._nystrom = None
+        self._cholesky = None
+        self._diag = None
+
+    @property
+    def loss(self):
+        return self.full.loss
+
+    def _kaufman_jacobian(self):
+        J = self._w*torch.cat([self.full.J1,self.full.J2])
+        Q = _range_basis(J[:,self.mask])[0]
+        J_theta = J[:,~self.mask]
+        J_K = J_theta-Q@(Q.T@J_theta)
+        self._J1 = J_K[:self.n1]
+        self._J2 = J_K[self.n1:]
+
+    @property
+    def J1(self):
+        if self._J1 is None:
+            self._kaufman_jacobian()
+        return self._J1
+
+    @property
+    def J2(self):
+        if self._J2 is None:
+            self._kaufman_jacobian()
+        return self._J2
+
+    def gauss_newton_diagonal(self, chunk_size=64):
+        """
+        Diagonal of J1^T J1 + J2^T J2 for the Kaufman Jacobian (hidden parameters 
+        only), i.e. its squared column norms, for the Jacobi preconditioner.
+        """
+        if self._diag is None:
+            self._diag = (self.J1**2).sum(0)/self.sample_num+self.lambdap*(self.J2**2).sum(0)/self.boundary_num
+        return self._diag
+
+    def full_step(self, s):
+        s_full = torch.zeros(self.full.s_size,dtype=s.dtype)
+        s_full[~self.mask] = s
+        return s_full
+
+    def new_state(self, model):
+        return self.full.new_state(model)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In this file, we gave the nested iteration (full multigrid) over the width of
+the network: the widths r, ceil(r/m), ceil(r/m^2), ... down to
+options.min_width (or options.max_levels levels) are trained from the
+narrowest one up, each one starting from the prolongation (prolongate_model)
+of the previous trained network. The prolongation is a correction of the 
+initial network of that width,
+    theta_h = theta_h0 + P(theta_H) - P(theta_H0),
+where theta_H0 is the average of theta_h0, since the plain copy P(theta_H) has
+equal nodes in every block, which LM can not separate anymore (they get the
+same updates). The narrow networks are trained by
+LMTR_solving_poisson up to options.fmg_epsilon, the target width up to
+options.epsilon, so most of the early iterations run on small models.
+"""
+import copy
+import math
+from Multilevel_LM.main_lm.params_options import MLM_TR_params_options
+from Multilevel_LM.main_lm.LMTR_poisson import LMTR_solving_poisson
+from Multilevel_LM.main_lm.neural_network_construction import to_functional_model
+from Multilevel_LM.mlm_main.average_strategies import average_nodes_model,prolongate_model
+from Multilevel_LM.main_lm.target_data import poisson_target
+from Multilevel_LM.main_lm.collocation import collocation_set
+
+
+def width_hierarchy(r_nodes_per_layer,m,options):
+    """
+    Widths of the nested iteration, from the target width to the narrowest one.
+    """
+    widths = [r_nodes_per_layer]
+    while (options.max_levels is None or len(widths) < options.max_levels) \
+            and widths[-1] > options.min_width and math.ceil(widths[-1]/m) >= options.min_width:
+        widths.append(math.ceil(widths[-1]/m))
+    return widths
+
+
+def FMG_width_continuation(real_solution,model,x,lambdak,m=2,regularization=True,lambdap=0.1,options=None,return_model=False):
+    """
+    Nested iteration over the width of the network.
+
+    Args:
+        model (FullyConnectedNN): the network of the target width, its averages
+            (average_nodes_model) are the initial narrow networks.
+        m (int): ratio of the widths of two consecutive networks.
+        options (MLM_TR_params_options): min_width, max_levels, fmg_epsilon 
+            and the options of the LM steps.
+
+    Returns
+    -------
+    model(x) of the final model, or the final FunctionalModel if return_model is True.
+    """
+    if options is None:
+        options = MLM_TR_params_options()
+    widths = width_hierarchy(model.r_nodes_per_layer,m,options)
+    coarse_options = copy.copy(options)
+    coarse_options.epsilon = options.fmg_epsilon
+    #initial networks of every width
+    initial = [to_functional_model(model,options.dtype)]
+    x = collocation_set(x).to(initial[0].theta.dtype).x
+    real_solution = poisson_target(real_solution,options.target_expression,options.target_cache_dir)
+    for _ in widths[1:]:
+        initial.append(to_functional_model(average_nodes_model(initial[-1].to_module(),m)))
+    current = initial[-1]
+    for level in reversed(range(len(widths))):
+        if level < len(widths)-1:
+            #theta_h0 + P(theta_H) - P(theta_H0)
+            correction = to_functional_model(prolongate_model(current.to_module(),m,widths[level])).theta \
+                - to_functional_model(prolongate_model(initial[level+1].to_module(),m,widths[level])).theta
+            current = initial[level].step(correction)
+        level_options = options if level == 0 else coarse_options
+        current = LMTR_solving_poisson(real_solution,current,x,lambdak,regularization=True,lambdap=0.1,
+                                       options=level_options,return_model=True)
+    if return_model:
+        return current
+    return current(x)
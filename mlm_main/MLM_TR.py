@@ -2,20 +2,40 @@
 # -*- coding: utf-8 -*-
 
 from Multilevel_LM.main_lm.params_options import MLM_TR_params_options
-from Multilevel_LM.main_lm.loss_poisson import loss_solving_poisson,compute_loss_gradients
+from Multilevel_LM.main_lm.loss_poisson import subsample_grid
 
 from Multilevel_LM.main_lm.LMTR_poisson import update_model_parameters,LMTR_solving_poisson
 import torch
 
 #from scipy.sparse.linalg import cg, LinearOperator,splu
-import numpy as np
 #from scipy.sparse import csc_matrix
-from Multilevel_LM.mlm_main.subsolver_two_level import create_block_matrix_torch,Taylor_H, sub_A_H,sub_b_H
-from Multilevel_LM.mlm_main.average_strategies import restriction,average_nodes_model
-def MLM_TR(real_solution,model,x,lambdak,m=2,regularization=True,lambdap =0.1,l=2):
+from Multilevel_LM.main_lm.iteration_state import PoissonIterationState
+from Multilevel_LM.main_lm.step_solvers import compute_lm_step,KrylovRecycler,forcing_term
+from Multilevel_LM.main_lm.neural_network_construction import to_functional_model
+from Multilevel_LM.mlm_main.subsolver_two_level import restriction_operator,GalerkinCoarseState
+from Multilevel_LM.mlm_main.average_strategies import average_nodes_model
+from Multilevel_LM.main_lm.target_data import poisson_target
+from Multilevel_LM.main_lm.collocation import collocation_set
+def coherence_correction(R_extend,grad_fh,stateH):
+    """
+    First-order coherence term of the coarse LM model, such that its gradient 
+    at sH = 0, sub_b of stateH plus the correction, is the restricted fine 
+    gradient R grad_fh (the gradient of Taylor_H_re at sH = 0).
+    """
+    return R_extend@grad_fh-stateH.sub_b().flatten().to(grad_fh.dtype)
+
+
+def MLM_TR(real_solution,model,x,lambdak,m=2,regularization=True,lambdap =0.1,l=2,options=None,return_model=False):
     #fk = loss_solving_poisson(real_solution,model,x)
+    #model can be an nn.Module or a FunctionalModel, the fine and coarse iterates are FunctionalModel
     
-    options = MLM_TR_params_options()
+    if options is None:
+        options = MLM_TR_params_options()
+    model = to_functional_model(model,options.dtype)
+    #x can be a tensor or a CollocationSet (e.g. a point cloud with its sdf)
+    x = collocation_set(x).to(model.theta.dtype).x
+    #f and the boundary values of the real solution, computed once per grid
+    real_solution = poisson_target(real_solution,options.target_expression,options.target_cache_dir)
     eta1 = options.eta1
     eta2 = options.eta2
     gamma1 = options.gamma1
@@ -27,46 +47,77 @@ def MLM_TR(real_solution,model,x,lambdak,m=2,regularization=True,lambdap =0.1,l=
     epsilonH = options.epsilonH
     max_iter = 100
     k=0
-    R = restriction(model,m)
     input_dim = model.input_dim
     
-   
-    if input_dim == 1 and model.n_hidden_layers == 1:
-        R_extend = create_block_matrix_torch(R,3)
-    elif input_dim == 2 and model.n_hidden_layers == 1:
-        R_extend = create_block_matrix_torch(R,4)
-    P_extend = R_extend.T
+    #sparse and cached, R_extend@v and P_extend@v cost O(number of parameters)
+    R_extend = restriction_operator(model,m)
+    P_extend = R_extend.t()
+    #loss and gradient of the fine model, computed once per accepted model
+    state = PoissonIterationState(real_solution,model,x,regularization=True,lambdap=0.1,
+                                  matrix_free=options.step_solver == 'matrix_free')
+    #coarse model, its Jacobians (and factorization) only change when a step is accepted
+    stateH = None
+    #Ritz vectors of the coarse CG solves, recycled from one iteration to the next
+    recycler = KrylovRecycler(options.recycle_dim) if options.recycle_dim > 0 else None
+    #forcing term of the inexact coarse steps, from the fine gradient norm
+    forcing_state, grad_norm, tol, prev_forcing = None, None, None, None
+    #coarse collocation grid: the coarse model only sees the residuals on every 
+    #grid_stride-th point, the full grid is used for the acceptance of the steps,
+    #with the same pair (fine ared, coherent coarse pred) as without it
+    coarse_grid = options.grid_stride > 1
+    if coarse_grid:
+        grid_state = PoissonIterationState(real_solution,model,subsample_grid(x,options.grid_stride),regularization=True,lambdap=0.1,
+                                           matrix_free=options.step_solver == 'matrix_free')
+    else:
+        grid_state = state
     
-    while torch.norm(compute_loss_gradients(real_solution, model, x,regularization=True,lambdap=0.1))>=epsilon and k <= max_iter:
-        #print(torch.norm(compute_loss_gradients(real_solution,model,x,regularization=True,lambdap = 0.1)))
-        #print(torch.norm(loss_solving_poisson(real_solution, model, x)))
-        grad_fh = compute_loss_gradients(real_solution, model, x,regularization=True,lambdap=0.1)
+    while torch.norm(state.gradient)>=epsilon and k <= max_iter:
+        #print(torch.norm(state.gradient))
+        #print(torch.norm(state.loss))
+        grad_fh = state.gradient
+        if forcing_state is not state:
+            prev_grad_norm, grad_norm = grad_norm, torch.norm(grad_fh)
+            tol = forcing_term(options,grad_norm,prev_grad_norm,prev_forcing)
+            prev_forcing = tol
+            forcing_state = state
         if l >1 and torch.norm(R_extend@grad_fh)>=kappaH*torch.norm(grad_fh) and torch.norm(R_extend@grad_fh) > epsilonH:
-            AH = sub_A_H(real_solution,model,x,lambdak,m=2,regularization=True,lambdap=0.1)
-            bH = (-1)*sub_b_H(real_solution,model,x,lambdak,m=2,regularization=True,lambdap=0.1)
-            sH = np.linalg.solve(AH.detach().numpy(),bH.detach().numpy().flatten())
-            sH = torch.tensor(sH)
+            if stateH is None and options.coarse_model == 'galerkin':
+                #J_H = J_h P from the fine Jacobian, coherent without correction on the full grid
+                stateH = GalerkinCoarseState(state if not coarse_grid else grid_state.new_state(model),P_extend)
+                correction = coherence_correction(R_extend,grad_fh,stateH) if coarse_grid else None
+            elif stateH is None:
+                modelH = to_functional_model(average_nodes_model(model.to_module(), m))
+                stateH = grid_state.new_state(modelH)
+                #first-order coherence term of the coarse model, as in sub_b_H and Taylor_H_re
+                correction = coherence_correction(R_extend,grad_fh,stateH)
+            sH, info = compute_lm_step(stateH,lambdak,options,correction,recycler,tol)
             s = P_extend @ sH
-            modelH = average_nodes_model(model, m)
-            new_modelH = update_model_parameters(modelH,sH)[1]
             new_modelh = update_model_parameters(model, s)[1]
-            fhs = loss_solving_poisson(real_solution, new_modelh, x)
-            fh = loss_solving_poisson(real_solution, model, x)
-            fH = loss_solving_poisson(real_solution, modelH, x)
-            fHs = loss_solving_poisson(real_solution, new_modelH, x)
-            mHs = Taylor_H(real_solution,model,x,lambdak,sH)
-            mH = Taylor_H(real_solution,model,x,lambdak,torch.zeros(sum(p.numel() for p in modelH.parameters())))
-            ared = fH-fHs
-            pred = mH-mHs
+            new_state = state.new_state(new_modelh)
+            fhs = new_state.loss
+            fh = state.loss
+            #actual and predicted reductions of the same function, the fine loss along 
+            #s = P sH, whose model is the coherent coarse model (first order), 
+            #m_H(0)-m_H(sH) = taylor(0)-taylor(sH)-correction@sH, which agrees with 
+            #Taylor_H_re(real_solution,model,x,lambdak,sH) to first order
+            ared = fh-fhs
+            pred = stateH.predicted_reduction(sH,lambdak)
+            if correction is not None:
+                pred = pred-correction@sH.to(correction.dtype)
             
             print(ared,pred)
-            pho = ared/pred
-            #print(pho)
-            if pred == 0:
-                print("pred = 0")
+            if pred <= 0:
+                #no predicted decrease, the step is rejected
+                print("pred <= 0")
+                lambdak = gamma3*lambdak
+                prev_forcing = None
+                tol = forcing_term(options,grad_norm)
             else:
+                pho = ared/pred
                 if pho >= eta1:
                     model = new_modelh
+                    state = new_state
+                    stateH = None
                     if pho >= eta2:
                         lambdak = max(lambda_min,gamma2*lambdak)
                     else:
@@ -74,14 +125,19 @@ def MLM_TR(real_solution,model,x,lambdak,m=2,regularization=True,lambdap =0.1,l=
                 else:
                     model = model
                     lambdak = gamma3*lambdak
+                    #the forcing term starts again from sqrt(||g_k||), without the safeguard
+                    prev_forcing = None
+                    tol = forcing_term(options,grad_norm)
             k += 1
 
         
             
         else:
             print("just fine case")
-            return LMTR_solving_poisson(real_solution,model,x,lambdak,regularization=True,lambdap=0.1)
+            return LMTR_solving_poisson(real_solution,model,x,lambdak,regularization=True,lambdap=0.1,options=options,return_model=return_model)
         
+    if return_model:
+        return model
     return model(x)
 #TEST           
 #def test_func_1d(x):
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In this file, we gave the recursive multilevel LM, which generalizes MLM_TR to
+any number of levels. The hierarchy is r -> ceil(r/m) -> ceil(r/m^2) -> ...
+(average_nodes_model), down to options.min_width nodes per layer or
+options.max_levels levels.
+
+On a level, the objective is
+    h(theta) = f(theta) + correction^T (theta - theta0),
+where f is the PDE loss of the network of this level and the correction makes
+the gradient of h at theta0 equal to the restricted gradient of the finer
+level (first-order coherence), correction = 0 on the finest level.
+
+One cycle of a level is
+    - options.smoothing_steps LM steps (compute_lm_step) of this level,
+    - a coarse correction, if the restricted gradient passes the coarse test
+      ||R g|| >= kappaH ||g|| and ||R g|| > epsilonH: one (V-cycle) or two
+      (W-cycle) cycles of the coarser level, whose step is prolongated and
+      accepted by the ratio of the reduction of h and the one of the coarser
+      objective,
+    - options.smoothing_steps LM steps again,
+and the coarsest level takes up to options.coarse_max_iter LM steps instead.
+The finest level repeats cycles until the gradient is small.
+"""
+import math
+import torch
+from Multilevel_LM.main_lm.params_options import MLM_TR_params_options
+from Multilevel_LM.main_lm.iteration_state import PoissonIterationState
+from Multilevel_LM.main_lm.step_solvers import compute_lm_step
+from Multilevel_LM.main_lm.neural_network_construction import to_functional_model
+from Multilevel_LM.mlm_main.subsolver_two_level import restriction_operator
+from Multilevel_LM.mlm_main.average_strategies import average_nodes_model
+from Multilevel_LM.main_lm.target_data import poisson_target
+from Multilevel_LM.main_lm.collocation import collocation_set
+
+
+class _LevelObjective:
+    """
+    h(theta) = f(theta) + correction^T (theta - theta0) on one level, from the
+    PoissonIterationState of the current iterate.
+    """
+    def __init__(self, correction=None, theta0=None):
+        self.correction = correction
+        self.theta0 = theta0
+
+    def value(self, state):
+        if self.correction is None:
+            return state.loss
+        return state.loss+self.correction@(state.theta-self.theta0).to(self.correction.dtype)
+
+    def gradient(self, state):
+        if self.correction is None:
+            return state.gradient
+        return state.gradient+self.correction
+
+    def model_value(self, state, s, lambdak):
+        """
+        LM model of h at theta + s.
+        """
+        m = state.taylor(s,lambdak)
+        if self.correction is None:
+            return m
+        return m+self.correction@(state.theta-self.theta0+s).to(self.correction.dtype)
+
+
+def _has_coarse_level(model, m, level, options):
+    if options.max_levels is not None and level+1 >= options.max_levels:
+        return False
+    return model.r_nodes_per_layer > options.min_width and math.ceil(model.r_nodes_per_layer/m) >= options.min_width
+
+
+def _update_lambda(pho, lambdak, options):
+    if pho >= options.eta2:
+        return max(options.lambda_min,options.gamma2*lambdak)
+    if pho >= options.eta1:
+        return max(options.lambda_min,options.gamma1*lambdak)
+    return options.gamma3*lambdak
+
+
+def _lm_steps(state, objective, lambdak, n_steps, epsilon, options):
+    """
+    Up to n_steps LM iterations on h, as in LMTR_solving_poisson.
+    """
+    for _ in range(n_steps):
+        if torch.norm(objective.gradient(state)) < epsilon:
+            break
+        s = compute_lm_step(state,lambdak,options,objective.correction)[0]
+        pred = objective.model_value(state,torch.zeros_like(s),lambdak)-objective.model_value(state,s,lambdak)
+        new_state = state.new_state(state.model.step(s))
+        ared = objective.value(state)-objective.value(new_state)
+        #no predicted decrease, the step is rejected and lambdak increases
+        pho = ared/pred if pred > 0 else 0
+        if pho >= options.eta1:
+            state = new_state
+        lambdak = _update_lambda(pho,lambdak,options)
+    return state, lambdak
+
+
+def _coarse_correction(state, objective, lambdak, m, level, options):
+    """
+    Coarse step from the cycles of the coarser level, if the coarse test holds.
+    """
+    grad = objective.gradient(state)
+    R_extend = restriction_operator(state.model,m)
+    R_grad = R_extend@grad
+    if torch.norm(R_grad) < options.kappaH*torch.norm(grad) or torch.norm(R_grad) <= options.epsilonH:
+        return state, lambdak
+    #h_H(theta_H) = f_H(theta_H) + (R g - grad f_H(theta_H0))^T (theta_H - theta_H0)
+    modelH = to_functional_model(average_nodes_model(state.model.to_module(),m))
+    stateH = state.new_state(modelH)
+    objectiveH = _LevelObjective(R_grad-stateH.gradient,stateH.theta)
+    stateH_new = stateH
+    for _ in range(1 if options.cycle == 'V' else 2):
+        stateH_new = _cycle(stateH_new,objectiveH,lambdak,m,level+1,options.epsilonH,options)[0]
+    pred = objectiveH.value(stateH)-objectiveH.value(stateH_new)
+    if pred <= 0:
+        #no predicted decrease, the coarse step is rejected
+        return state, options.gamma3*lambdak
+    s = R_extend.t()@(stateH_new.theta-objectiveH.theta0)
+    new_state = state.new_state(state.model.step(s))
+    pho = (objective.value(state)-objective.value(new_state))/pred
+    if pho >= options.eta1:
+        state = new_state
+    return state, _update_lambda(pho,lambdak,options)
+
+
+def _cycle(state, objective, lambdak, m, level, epsilon, options):
+    """
+    One V- or W-cycle from the level of state.
+
+    Returns
+    -------
+    state (PoissonIterationState): state of the last accepted iterate
+    lambdak (float): the regularization coefficient
+    """
+    if not _has_coarse_level(state.model,m,level,options):
+        return _lm_steps(state,objective,lambdak,options.coarse_max_iter,epsilon,options)
+    state, lambdak = _lm_steps(state,objective,lambdak,options.smoothing_steps,epsilon,options)
+    state, lambdak = _coarse_correction(state,objective,lambdak,m,level,options)
+    return _lm_steps(state,objective,lambdak,options.smoothing_steps,epsilon,options)
+
+
+def MLM_recursive(real_solution,model,x,lambdak,m=2,regularization=True,lambdap=0.1,options=None,return_model=False):
+    """
+    Recursive multilevel LM (V-cycle or W-cycle, options.cycle) on the width
+    hierarchy of the model.
+
+    Args:
+        model: nn.Module or FunctionalModel, the finest level.
+        m (int): number of nodes averaged into one node between two levels.
+        options (MLM_TR_params_options): cycle, min_width, max_levels, 
+            smoothing_steps and coarse_max_iter control the hierarchy.
+
+    Returns
+    -------
+    model(x) of the final model, or the final FunctionalModel if return_model is True.
+    """
+    if options is None:
+        options = MLM_TR_params_options()
+    model = to_functional_model(model,options.dtype)
+    #x can be a tensor or a CollocationSet (e.g. a point cloud with its sdf)
+    x = collocation_set(x).to(model.theta.dtype).x
+    #f and the boundary values of the real solution, computed once per grid
+    real_solution = poisson_target(real_solution,options.target_expression,options.target_cache_dir)
+    state = PoissonIterationState(real_solution,model,x,regularization=True,lambdap=0.1,
+                                  matrix_free=options.step_solver == 'matrix_free')
+    objective = _LevelObjective()
+    max_iter = 100
+    k = 0
+    while torch.norm(state.gradient) >= options.epsilon and k <= max_iter:
+        state, lambdak = _cycle(state,objective,lambdak,m,0,options.epsilon,options)
+        k += 1
+    if return_model:
+        return state.model
+    return state.model(x)
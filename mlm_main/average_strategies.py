@@ -1,108 +1,100 @@
 
+import functools
 import math
 import torch
 import torch.nn as nn
 
 from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN
 #In this file, we simply average every m nodes, and contruct a new coarser neural network.
-def split_tensor_into_blocks(tensor, block_size):
+def block_mean(tensor, block_size, dim=0):
+    """
+    Average every block_size consecutive entries of tensor along dim, the last 
+    block being smaller if block_size does not divide the size. The tensor is 
+    padded with zeros to a multiple of block_size, reshaped and summed, then 
+    divided by the actual size of each block, so there is no Python loop.
+    """
+    tensor = tensor.movedim(dim,0)
     n = tensor.shape[0]
     size_b = math.ceil(n/block_size)
-    blocks = []
-    block_average = torch.zeros((size_b,size_b))
-    # Loop over the tensor with step size `block_size`
-    for i in range(0, n, block_size):
-        row_blocks = []
-        for j in range(0, n, block_size):
-            # Determine the size of the current block
-            row_end = min(i + block_size, n)
-            col_end = min(j + block_size, n)
-            
-            # Extract the block
-            block = tensor[i:row_end, j:col_end]
-            
-            row_blocks.append(block)
-        
-        # Append all blocks of the current row
-        blocks.append(row_blocks)
-    for k in range(size_b):
-        for l in range(size_b):
-            block_average[k,l] = (blocks[k][l].sum())/(blocks[k][l].shape[0]*blocks[k][l].shape[1])
-            
-    
-    return block_average
+    padded = torch.nn.functional.pad(tensor.reshape(n,-1),(0,0,0,size_b*block_size-n))
+    sums = padded.view(size_b,block_size,-1).sum(dim=1)
+    counts = torch.clamp(n-torch.arange(size_b)*block_size,max=block_size).to(tensor.dtype)
+    means = sums/counts.unsqueeze(1)
+    return means.view(size_b,*tensor.shape[1:]).movedim(0,dim)
+
+
+def split_tensor_into_blocks(tensor, block_size):
+    """
+    Average of every (block_size x block_size) block of the tensor, i.e. a
+    (ceil(n/block_size), ceil(k/block_size)) tensor for a (n, k) tensor.
+    """
+    return block_mean(block_mean(tensor,block_size,dim=0),block_size,dim=1)
 
 def average_nodes_model(model,m):
+    """
+    Coarse network, where every m consecutive nodes of each hidden layer are 
+    averaged into one node (the last one averages the remaining nodes if m does
+    not divide r):
+        - first hidden layer: rows (nodes) are averaged, the input columns are kept,
+        - other hidden layers: blocks of m x m weights are averaged,
+        - biases: averaged like the nodes,
+        - output layer: columns are averaged, the bias is kept.
+    It works for any input_dim and n_hidden_layers.
+    """
     #Define a new model with reduced number of r_nodes_per_layer
     input_dim = model.input_dim
     n_hidden_layers = model.n_hidden_layers
     r_nodes_per_layer = math.ceil(model.r_nodes_per_layer / m)
     output_dim = model.output_dim
     activation_function = model.activation_function
-    new_model = FullyConnectedNN(input_dim, n_hidden_layers, r_nodes_per_layer, output_dim,activation_function)
-    #print(new_model.hidden_layers[0].weight)
-    previous_out_features = model.input_dim
-    floor_m = math.floor(model.r_nodes_per_layer / m)
-    floormm = floor_m*m
-    remain = model.r_nodes_per_layer-floormm
-    if math.floor(model.r_nodes_per_layer / m) == math.ceil(model.r_nodes_per_layer / m):
-        for i,layer in enumerate(model.hidden_layers):
-           
-            weights = layer.weight.data.view(-1,m,previous_out_features).mean(dim=1)
-            biases = layer.bias.data.view(-1,m).mean(dim=1)
-            new_model.hidden_layers[i].weight.data =  weights
-            new_model.hidden_layers[i].bias.data = biases
-            previous_out_features = new_model.hidden_layers[i].out_features
-                
-                
-    else:
-        for i, layer in enumerate(model.hidden_layers):
-            for j, new_layer in enumerate(new_model.hidden_layers):
-                #if  layer.weight.shape[1] == 1:
-                    
-            
-
-                    #weights = layer.weight.data[0:floormm].view(-1,m,previous_out_features).mean(dim=1)
-                    #biases = layer.bias.data[0:floormm].view(-1,m).mean(dim=1)
-                    
-                    #remain = model.r_nodes_per_layer-floormm
-
-                    #weights_end = layer.weight.data[floormm:].mean(dim=1)
-                    #biases_end = layer.bias.data[floormm:].view(-1,remain).mean(dim=1)
-                    #weights = torch.cat((weights,weights_end))
-                    #biases = torch.cat((biases,biases_end))
-                    #new_model.hidden_layers[i].weight.data =  weights
-                    #new_model.hidden_layers[i].bias.data = biases
-                    #previous_out_features = new_model.hidden_layers[i].out_features
-                #else:
-                   
-                weights = split_tensor_into_blocks(layer.weight.data,m)
-                mask = ~torch.isnan(weights).any(dim=0)
-
-                # Filter out the columns with NaN
-                weights = weights[:, mask]
-                biases = layer.bias.data[0:floormm].view(-1,m).mean(dim=1)
-                biases_end = layer.bias.data[floormm:].view(-1,remain).mean(dim=1)
-                biases = torch.cat((biases,biases_end))
-                new_model.hidden_layers[i].weight.data =  weights
-                new_model.hidden_layers[i].bias.data = biases
-                previous_out_features = new_model.hidden_layers[i].out_features
-                
-    #Adjust the output layer weights and keep the output weight as the original model
-    output_weights = model.output_layer.weight.data
-    output_weights_avg = output_weights[:,:floormm].view(1,-1,m).mean(dim=2)
-    if remain>0 :
-        output_weights_end = output_weights[:,floormm:].mean(dim=1,keepdim=True)
-        output_weights_avg = torch.cat((output_weights_avg,output_weights_end))
-    new_model.output_layer.weight.data = output_weights_avg
-    new_model.output_layer.bias.data = model.output_layer.bias.data
- 
+    new_model = FullyConnectedNN(input_dim, n_hidden_layers, r_nodes_per_layer, output_dim,activation_function).to(model.output_layer.weight.dtype)
+    with torch.no_grad():
+        for i, (layer, new_layer) in enumerate(zip(model.hidden_layers,new_model.hidden_layers)):
+            if i == 0:
+                weights = block_mean(layer.weight,m,dim=0)
+            else:
+                weights = split_tensor_into_blocks(layer.weight,m)
+            new_layer.weight.copy_(weights)
+            new_layer.bias.copy_(block_mean(layer.bias,m))
+        #Adjust the output layer weights and keep the output weight as the original model
+        new_model.output_layer.weight.copy_(block_mean(model.output_layer.weight,m,dim=1))
+        new_model.output_layer.bias.copy_(model.output_layer.bias)
     
     return new_model
 
 
 
 
+def prolongate_model(model,m,r_nodes_per_layer):
+    """
+    Wider network with r_nodes_per_layer nodes per hidden layer, which computes
+    the same function as model, where model has ceil(r_nodes_per_layer/m) nodes
+    (e.g. model = average_nodes_model(fine_model,m)). It goes through the 
+    transpose of the restriction R = restriction(fine_model,m):
+        - every coarse node is copied to the fine nodes of its block, i.e. 
+          rows are prolongated by R^+ = R^T diag(block sizes),
+        - the outgoing weights of a coarse node are split over its block, 
+          i.e. columns are prolongated by R (W R, for the output layer and 
+          the other hidden layers).
+    """
+    R = sparse_restriction(r_nodes_per_layer,m,model.output_layer.weight.dtype)
+    if R.shape[0] != model.r_nodes_per_layer:
+        raise ValueError(f"{model.r_nodes_per_layer} nodes can not be prolongated to {r_nodes_per_layer} nodes with m = {m}")
+    #R^T diag(block sizes), i.e. 1 for the fine nodes of each coarse node
+    R_pinv = torch.sparse_coo_tensor(R.indices(),torch.ones_like(R.values()),R.shape,check_invariants=True).t()
+    new_model = FullyConnectedNN(model.input_dim, model.n_hidden_layers, r_nodes_per_layer, model.output_dim, model.activation_function).to(R.dtype)
+    with torch.no_grad():
+        for i, (layer, new_layer) in enumerate(zip(model.hidden_layers,new_model.hidden_layers)):
+            weights = R_pinv@layer.weight
+            if i > 0:
+                weights = (R.t()@weights.T).T
+            new_layer.weight.copy_(weights)
+            new_layer.bias.copy_(R_pinv@layer.bias)
+        new_model.output_layer.weight.copy_((R.t()@model.output_layer.weight.T).T)
+        new_model.output_layer.bias.copy_(model.output_layer.bias)
+    return new_model
+
+
 # The transformation_matrix between old model and new model
 #First we give the restriction matrix, i.e. from Fine case to coarse case
 
@@ -122,22 +114,23 @@ def restriction(model,m):
     T (torch.Tensor): The transformation matrix of size (new_model_size,model_size)
 
     """
-    old_size = model.r_nodes_per_layer
-    new_size = math.ceil(model.r_nodes_per_layer/m)
-    T = torch.zeros((new_size,old_size))
-    #Fill in the transformation matrix by averaging blocks of 'm' rows
-    for i in range(new_size):
-        start_idx = i*m
-        end_idx = min(start_idx+m,old_size)
-        T[i,start_idx:end_idx] = 1.0/(end_idx-start_idx)
-        
-    return T
-
-                
-                
-                    
-
-                
-                
-                
-    
+    dtype = next(iter(model.parameters())).dtype
+    return sparse_restriction(model.r_nodes_per_layer,m,dtype).to_dense()
+
+
+@functools.lru_cache(maxsize=None)
+def sparse_restriction(old_size,m,dtype=torch.float32):
+    """
+    Same transformation matrix as restriction, as a sparse COO tensor with one 
+    nonzero per fine node, built once per (old_size, m, dtype) and cached.
+    Node j of the fine layer goes to the coarse node j//m, with the weight 
+    1/(size of its block), the last block being smaller if m does not divide old_size.
+    The weights are computed in dtype, e.g. 1/3 is not rounded to float32 first.
+    """
+    new_size = math.ceil(old_size/m)
+    cols = torch.arange(old_size)
+    rows = cols//m
+    block_sizes = torch.clamp(old_size-torch.arange(new_size)*m,max=m)
+    values = block_sizes[rows].to(dtype).reciprocal()
+    return torch.sparse_coo_tensor(torch.stack([rows,cols]),values,(new_size,old_size),check_invariants=True).coalesce()
+
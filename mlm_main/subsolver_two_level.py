@@ -2,14 +2,16 @@
 # -*- coding: utf-8 -*-
 
 
+import functools
 import numpy as np
 import torch
 #from Multilevel_LM.main_lm.PoissonPDE import PoissonPDE
 from Multilevel_LM.main_lm.loss_poisson import loss_solving_poisson,compute_loss_gradients
 from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN
 from Multilevel_LM.main_lm.LMTR_poisson import update_model_parameters
-from Multilevel_LM.mlm_main.average_strategies import average_nodes_model, restriction
+from Multilevel_LM.mlm_main.average_strategies import average_nodes_model, restriction, sparse_restriction
 from Multilevel_LM.main_lm.subsolver_poisson import sub_A_solving_poisson,sub_b_solving_poisson
+from Multilevel_LM.main_lm.iteration_state import PoissonIterationState
 
 
 def create_block_matrix_torch(R, m):
@@ -44,16 +46,160 @@ def create_block_matrix_torch(R, m):
     return block_matrix
 
 
+def _sparse_identity(n,dtype=torch.float32):
+    idx = torch.arange(n)
+    return torch.sparse_coo_tensor(torch.stack([idx,idx]),torch.ones(n,dtype=dtype),(n,n),check_invariants=True).coalesce()
+
+
+def _sparse_kron(A,B):
+    """
+    Kronecker product of two sparse COO matrices, i.e. the matrix acting on the
+    row-major flattening of X as vec(A X B^T).
+    """
+    (ia, ja), va = A.indices(), A.values()
+    (ib, jb), vb = B.indices(), B.values()
+    rows = (ia[:,None]*B.shape[0]+ib[None,:]).reshape(-1)
+    cols = (ja[:,None]*B.shape[1]+jb[None,:]).reshape(-1)
+    values = (va[:,None]*vb[None,:]).reshape(-1)
+    size = (A.shape[0]*B.shape[0],A.shape[1]*B.shape[1])
+    return torch.sparse_coo_tensor(torch.stack([rows,cols]),values,size,check_invariants=True).coalesce()
+
+
+def _sparse_block_diag(blocks):
+    rows, cols, values = [], [], []
+    n_rows = n_cols = 0
+    for block in blocks:
+        i, j = block.indices()
+        rows.append(i+n_rows)
+        cols.append(j+n_cols)
+        values.append(block.values())
+        n_rows += block.shape[0]
+        n_cols += block.shape[1]
+    return torch.sparse_coo_tensor(torch.stack([torch.cat(rows),torch.cat(cols)]),torch.cat(values),(n_rows,n_cols),check_invariants=True).coalesce()
+
+
+@functools.lru_cache(maxsize=None)
+def _layout_restriction(layout,r,m,dtype):
+    R = sparse_restriction(r,m,dtype)
+    blocks = []
+    for name, shape in layout:
+        if name.endswith('bias'):
+            blocks.append(R if name.startswith('hidden_layers') else _sparse_identity(shape[0],dtype))
+        elif name == 'hidden_layers.0.weight':
+            blocks.append(_sparse_kron(R,_sparse_identity(shape[1],dtype)))
+        elif name.startswith('hidden_layers'):
+            blocks.append(_sparse_kron(R,R))
+        else:
+            blocks.append(_sparse_kron(_sparse_identity(shape[0],dtype),R))
+    return _sparse_block_diag(blocks)
+
+
+def restriction_operator(model,m):
+    """
+    Restriction R_extend from the parameters of the model to the ones of 
+    average_nodes_model(model,m), i.e. theta_H = R_extend theta_h, generated 
+    from the parameter layout of the model (any input_dim and n_hidden_layers).
+    With R = restriction(model,m), the blocks of R_extend are, in the order of 
+    model.parameters():
+        - first hidden layer weight W (r x input_dim): R W,
+        - other hidden layer weights W (r x r): R W R^T,
+        - hidden biases: R b,
+        - output layer weight W (output_dim x r): W R^T, output bias: unchanged,
+    each one written on the row-major flattening (Kronecker products). For one 
+    hidden layer and input_dim 1, it is create_block_matrix_torch(R,3).
+    It is sparse, with (about) one nonzero per fine parameter of each block, 
+    built directly in the dtype of the model (options.dtype in the solvers) and
+    cached per (r, m, input_dim, depth, output_dim, dtype), so a call only looks
+    it up, and the prolongation is P_extend = R_extend.t().
+    """
+    layout = tuple((name,tuple(p.shape)) for name,p in model.named_parameters())
+    dtype = next(iter(model.parameters())).dtype
+    return _layout_restriction(layout,model.r_nodes_per_layer,m,dtype)
+
+
+class GalerkinCoarseState(PoissonIterationState):
+    """
+    Galerkin coarse level of a fine PoissonIterationState: the coarse residuals 
+    are the fine ones and the coarse Jacobians are J_H = J_h P, so that
+        A_H = P^T A_h P,   b_H = P^T b_h,
+    with the prolongation P = P_extend. Nothing is differentiated again, the 
+    coarse quantities come from the (cached) fine Jacobians, and since 
+    P^T = R_extend the gradient is already the restricted fine gradient, 
+    i.e. the model is first-order coherent without a correction term.
+
+    It has the interface of PoissonIterationState used by the step solvers,
+    and taylor(sH, lambdak) is the coarse model m_H(sH). new_state takes the
+    fine model of the new iterate, e.g. fine.model.step(P sH).
+    """
+    def __init__(self, fine_state, P):
+        self.fine = fine_state
+        self.P = P
+        for name in ['real_solution','x','regularization','lambdap','jacobian_mode','matrix_free','functionals',
+                     'sample_num','boundary_num','loss_rows','loss_boundary_num']:
+            setattr(self,name,getattr(fine_state,name))
+        self.model = None
+        self.s_size = P.shape[1]
+        self._J1 = None
+        self._J2 = None
+        self._JTJ = None
+        self._JJT = None
+        self._svd = None
+        self._sketched_svd = None
+        self._nystrom = None
+        self._cholesky = None
+        self._diag = None
+
+    @property
+    def F1(self):
+        return self.fine.F1
+
+    @property
+    def F2(self):
+        return self.fine.F2
+
+    @property
+    def loss(self):
+        return self.fine.loss
+
+    @property
+    def J1(self):
+        if self._J1 is None:
+            self._J1 = self.fine.J1@self.P
+        return self._J1
+
+    @property
+    def J2(self):
+        if self._J2 is None:
+            self._J2 = self.fine.J2@self.P
+        return self._J2
+
+    def _jacobian(self, Fk, data):
+        return self.fine._jacobian(Fk,data)@self.P
+
+    def J_times(self, v):
+        return self.fine.J_times(self.P@v.to(self.P.dtype))
+
+    def JT_times(self, u1, u2):
+        return self.P.T@self.fine.JT_times(u1,u2)
+
+    def new_state(self, model):
+        """
+        Galerkin coarse level at the fine model model, e.g. the fine iterate 
+        model.step(P sH) of a coarse step sH, rebuilt from the new fine state
+        with the same prolongation. The coarse level has no network of its own,
+        so model is a fine model (a FunctionalModel of the fine parameters).
+        """
+        if model is None or (hasattr(model,'theta') and model.theta.numel() != self.P.shape[0]):
+            raise ValueError("GalerkinCoarseState.new_state takes a fine model, with P.shape[0] parameters")
+        return GalerkinCoarseState(self.fine.new_state(model),self.P)
+
+
 def Taylor_H(real_solution,model,x,sH,m=2,regularization=True,lambdap=0.1):
     input_dim = model.input_dim
     sH.requires_grad_(True)
     new_model = average_nodes_model(model,m)
     new_model_s = update_model_parameters(new_model, sH)[1]
-    R = restriction(model,m)
-    if input_dim == 1 and model.n_hidden_layers == 1:
-        R_extend = create_block_matrix_torch(R,3)
-    elif input_dim == 2 and model.n_hidden_layers == 1:
-        R_extend = create_block_matrix_torch(R,4)
+    R_extend = restriction_operator(model,m)
     fHs = loss_solving_poisson(real_solution,new_model_s,x, regularization=True,lambdap=0.1)
     #sH.grad=True
     #fHs.backward()
@@ -69,11 +215,7 @@ def Taylor_H_re(real_solution,model,x,lambdak,sH,m=2,regularization=True,lambdap
     input_dim = model.input_dim
     new_model = average_nodes_model(model,m)
     new_model_s = update_model_parameters(new_model, sH)[1]
-    R = restriction(model,m)
-    if input_dim == 1 and model.n_hidden_layers == 1:
-        R_extend = create_block_matrix_torch(R,3)
-    elif input_dim == 2 and model.n_hidden_layers == 1:
-        R_extend = create_block_matrix_torch(R,4)
+    R_extend = restriction_operator(model,m)
     fHs = loss_solving_poisson(real_solution,new_model_s,x, regularization=True,lambdap=0.1)
     grad_fh = compute_loss_gradients(real_solution, model, x,regularization=True,lambdap=0.1)
     grad_fH = compute_loss_gradients(real_solution, new_model, x)
@@ -88,11 +230,7 @@ def sub_A_H(real_solution,model,x,lambdak,m=2,regularization=True,lambdap=0.1):
 def sub_b_H(real_solution,model,x,lambdak,m=2,regularization=True,lambdap=0.1):
     input_dim = model.input_dim
     new_model = average_nodes_model(model, m)
-    R = restriction(model,m)
-    if input_dim == 1 and model.n_hidden_layers == 1:
-        R_extend = create_block_matrix_torch(R,3)
-    elif input_dim == 2 and model.n_hidden_layers == 1:
-        R_extend = create_block_matrix_torch(R,4)
+    R_extend = restriction_operator(model,m)
     grad_fh = compute_loss_gradients(real_solution, model, x,regularization=True,lambdap=0.1)
     grad_fH = compute_loss_gradients(real_solution, new_model, x)
     return sub_b_solving_poisson(real_solution, new_model, x, lambdak) + (R_extend@grad_fh-grad_fH).view(-1,1)    
@@ -0,0 +1,17 @@
+"""
+The modules import each other as Multilevel_LM.main_lm / Multilevel_LM.mlm_main,
+so the repository is registered as the package Multilevel_LM if it is not
+installed under that name.
+"""
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import Multilevel_LM
+except ImportError:
+    package = types.ModuleType('Multilevel_LM')
+    package.__path__ = [ROOT]
+    sys.modules['Multilevel_LM'] = package
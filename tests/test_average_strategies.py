@@ -0,0 +1,32 @@
+import torch
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN
+from Multilevel_LM.mlm_main.average_strategies import sparse_restriction, restriction, prolongate_model, average_nodes_model
+from Multilevel_LM.mlm_main.subsolver_two_level import restriction_operator
+
+
+def test_restriction_weights_in_the_requested_dtype():
+    R = sparse_restriction(7,3,torch.float64)
+    assert R.dtype == torch.float64
+    assert torch.equal(R.to_dense().sum(1),torch.ones(3,dtype=torch.float64))
+    assert R.values()[0].item() == 1/3
+    assert sparse_restriction(7,3).dtype == torch.float32
+
+
+def test_prolongation_keeps_the_function_in_float64():
+    torch.manual_seed(0)
+    model = FullyConnectedNN(2,2,6,1).double()
+    assert restriction(model,3).dtype == torch.float64
+    coarse = average_nodes_model(model,3)
+    fine = prolongate_model(coarse,3,6)
+    x = torch.rand(10,2,dtype=torch.float64)
+    assert torch.allclose(fine(x),coarse(x),atol=1e-14)
+
+
+def test_restriction_operator_is_built_once_per_dtype():
+    torch.manual_seed(0)
+    model = FullyConnectedNN(3,2,6,1)
+    R32 = restriction_operator(model,2)
+    R64 = restriction_operator(model.double(),2)
+    assert R32.dtype == torch.float32 and R64.dtype == torch.float64
+    assert restriction_operator(model,2) is R64
+    assert torch.allclose(R64.to_dense().float(),R32.to_dense())
@@ -0,0 +1,29 @@
+import gc
+import numpy as np
+import torch
+from Multilevel_LM.main_lm import collocation
+from Multilevel_LM.main_lm.collocation import collocation_set
+
+
+def grid_2d(n):
+    t = np.linspace(0,1,n)
+    return torch.tensor(np.stack(np.meshgrid(t,t),-1).reshape(-1,2),dtype=torch.float64)
+
+
+def test_set_is_reused_while_x_is_alive():
+    x = grid_2d(5)
+    points = collocation_set(x)
+    assert collocation_set(x).x is x
+    assert torch.equal(collocation_set(x).boundary,points.boundary)
+    assert points.n_boundary == 16
+
+
+def test_cache_does_not_keep_x_alive():
+    x = grid_2d(5)
+    points = collocation_set(x).to(torch.float32)
+    key, key32 = id(x), id(points.x)
+    assert key in collocation._COLLOCATION_SETS and key32 in collocation._COLLOCATION_SETS
+    del x, points
+    gc.collect()
+    assert key not in collocation._COLLOCATION_SETS
+    assert key32 not in collocation._COLLOCATION_SETS
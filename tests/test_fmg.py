@@ -0,0 +1,65 @@
+import contextlib
+import io
+import numpy as np
+import torch
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN
+from Multilevel_LM.main_lm.loss_poisson import loss_solving_poisson
+from Multilevel_LM.main_lm.params_options import MLM_TR_params_options
+from Multilevel_LM.mlm_main import FMG_width_continuation as fmg
+from Multilevel_LM.mlm_main.FMG_width_continuation import FMG_width_continuation, width_hierarchy
+
+
+def real_solution_1d(x):
+    return torch.sin(x)
+
+
+def real_solution_2d(x):
+    return torch.sin(x[:,0])*torch.sin(x[:,1])
+
+
+def test_width_hierarchy():
+    assert width_hierarchy(20,2,MLM_TR_params_options(min_width=2)) == [20,10,5,3,2]
+    assert width_hierarchy(20,2,MLM_TR_params_options(min_width=2,max_levels=3)) == [20,10,5]
+    assert width_hierarchy(9,3,MLM_TR_params_options(min_width=2)) == [9,3]
+
+
+def run(real_solution, model, x, options, monkeypatch):
+    """
+    FMG_width_continuation with the initial network and the width of every LMTR solve recorded.
+    """
+    calls = []
+    lmtr = fmg.LMTR_solving_poisson
+    def record(real_solution, model, *args, **kwargs):
+        calls.append((model.r_nodes_per_layer,model))
+        return lmtr(real_solution,model,*args,**kwargs)
+    monkeypatch.setattr(fmg,'LMTR_solving_poisson',record)
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = FMG_width_continuation(real_solution,model,x,0.1,options=options,return_model=True)
+    return result, calls
+
+
+def test_fmg_on_three_widths_1d(monkeypatch):
+    torch.manual_seed(0)
+    model = FullyConnectedNN(1,1,8,1).double()
+    x = torch.linspace(0,1,41,dtype=torch.float64).reshape(-1,1)
+    loss0 = float(loss_solving_poisson(real_solution_1d,model,x))
+    options = MLM_TR_params_options(min_width=2,dtype=torch.float64)
+    result, calls = run(real_solution_1d,model,x,options,monkeypatch)
+    assert [width for width, _ in calls] == [2,4,8]
+    #every width starts from the prolongation of the trained narrower network, 
+    #which is not worse than the initial network of that width
+    for _, start in calls[1:]:
+        assert loss_solving_poisson(real_solution_1d,start,x) < loss0
+    assert float(loss_solving_poisson(real_solution_1d,result,x)) < 1e-3*loss0
+    assert (result(x).flatten()-real_solution_1d(x).flatten()).abs().max() < 1e-2
+
+
+def test_fmg_on_two_widths_2d(monkeypatch):
+    torch.manual_seed(0)
+    model = FullyConnectedNN(2,1,8,1).double()
+    t = np.linspace(0,1,9)
+    x = torch.tensor(np.stack(np.meshgrid(t,t),-1).reshape(-1,2),dtype=torch.float64)
+    loss0 = float(loss_solving_poisson(real_solution_2d,model,x))
+    result, calls = run(real_solution_2d,model,x,MLM_TR_params_options(max_levels=2,dtype=torch.float64),monkeypatch)
+    assert [width for width, _ in calls] == [4,8]
+    assert float(loss_solving_poisson(real_solution_2d,result,x)) < 1e-3*loss0
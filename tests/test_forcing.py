@@ -0,0 +1,41 @@
+import numpy as np
+import torch
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN
+from Multilevel_LM.main_lm.params_options import LMTR_params_options
+from Multilevel_LM.main_lm.LMTR_poisson import LMTR_solving_poisson
+from Multilevel_LM.main_lm.step_solvers import forcing_term
+
+
+def real_solution(x):
+    return torch.sin(x)
+
+
+def solve(capsys, forcing):
+    torch.manual_seed(0)
+    model = FullyConnectedNN(1,1,50,1)
+    x = torch.tensor(np.linspace(0,1,101).reshape(-1,1),dtype=torch.float32)
+    options = LMTR_params_options(step_solver='matrix_free',preconditioner=None,recycle_dim=10,forcing=forcing)
+    capsys.readouterr()
+    out = LMTR_solving_poisson(real_solution,model,x,0.1,options=options)
+    #LMTR_solving_poisson prints the loss once per iteration
+    iterations = capsys.readouterr().out.count('tensor(')
+    return iterations, (out.flatten()-real_solution(x).flatten()).abs().max().item()
+
+
+def test_forcing_term_safeguard_and_cap():
+    options = LMTR_params_options(forcing='eisenstat_walker')
+    #capped by sqrt(||g||) even when the gradient norm grows
+    assert forcing_term(options,1e-4,1e-5,0.5) == np.sqrt(1e-4)
+    #safeguard 0.9*eta^2 only above 0.1
+    assert forcing_term(options,0.25,1.0,0.45) == 0.9*0.45**2
+    assert forcing_term(options,0.25,1.0,0.3) == 0.9*0.25**2
+    #no safeguard after a rejected step
+    assert forcing_term(options,0.25,1.0,None) == 0.9*0.25**2
+    assert forcing_term(options,1e-16,1.0,0.5) == options.cg_tol
+
+
+def test_eisenstat_walker_converges_like_the_exact_step(capsys):
+    iterations_exact, error_exact = solve(capsys,None)
+    iterations_ew, error_ew = solve(capsys,'eisenstat_walker')
+    assert iterations_ew <= 1.2*iterations_exact+2
+    assert error_ew <= 10*error_exact
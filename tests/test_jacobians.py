@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+import torch
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN, parameters_dict, taylor_forward, single_hidden_layer_jacobian
+from Multilevel_LM.main_lm.subsolver_poisson import Jk1_solving_poisson, Jk2_solving_poisson
+
+
+def real_solution(x):
+    return torch.sin(x).prod(1)
+
+
+def points(input_dim):
+    t = np.linspace(0,1,5)
+    grid = np.stack(np.meshgrid(*[t]*input_dim),-1).reshape(-1,input_dim)
+    return torch.tensor(grid,dtype=torch.float64)
+
+
+def network(input_dim, n_hidden_layers):
+    torch.manual_seed(0)
+    return FullyConnectedNN(input_dim,n_hidden_layers,6,1).double()
+
+
+@pytest.mark.parametrize('input_dim',[1,2])
+@pytest.mark.parametrize('n_hidden_layers',[1,2])
+@pytest.mark.parametrize('mode',['rev','fwd','auto'])
+def test_jacobian_modes_match_the_loop(input_dim, n_hidden_layers, mode):
+    model = network(input_dim,n_hidden_layers)
+    x = points(input_dim)
+    for jacobian in [Jk1_solving_poisson,Jk2_solving_poisson]:
+        J_loop = jacobian(real_solution,model,x,mode='loop')
+        J = jacobian(real_solution,model,x,mode=mode)
+        assert J.shape == J_loop.shape
+        assert torch.allclose(J,J_loop,rtol=1e-10,atol=1e-12)
+
+
+@pytest.mark.parametrize('input_dim',[1,2])
+@pytest.mark.parametrize('activation',[torch.nn.Sigmoid(),torch.nn.Tanh(),torch.nn.SiLU()])
+def test_closed_form_jacobian_matches_the_loop(input_dim, activation):
+    torch.manual_seed(0)
+    model = FullyConnectedNN(input_dim,1,6,1,activation).double()
+    x = points(input_dim)
+    for jacobian in [Jk1_solving_poisson,Jk2_solving_poisson]:
+        J_loop = jacobian(real_solution,model,x,mode='loop')
+        J = jacobian(real_solution,model,x,mode='analytic')
+        assert torch.allclose(J,J_loop,rtol=1e-10,atol=1e-12)
+
+
+@pytest.mark.parametrize('input_dim',[1,2])
+def test_closed_form_values_match_taylor_forward(input_dim):
+    model = network(input_dim,1)
+    x = points(input_dim)
+    params = parameters_dict(model)
+    u, grad_u, laplacian_u = taylor_forward(model,params,x)
+    value, J = single_hidden_layer_jacobian(model,params,x)
+    assert torch.allclose(value,u.reshape(-1))
+    value, J = single_hidden_layer_jacobian(model,params,x,laplacian=True)
+    assert torch.allclose(value,laplacian_u.reshape(-1))
@@ -0,0 +1,31 @@
+import re
+import numpy as np
+import torch
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN
+from Multilevel_LM.main_lm.params_options import LMTR_params_options
+from Multilevel_LM.main_lm.LMTR_poisson import LMTR_solving_poisson
+from Multilevel_LM.main_lm.loss_poisson import loss_solving_poisson
+
+
+def real_solution(x):
+    return torch.sin(x)
+
+
+def losses(output):
+    #LMTR_solving_poisson prints the loss once per iteration
+    return [float(v) for v in re.findall(r'tensor\(([-+.\deE]+)',output)]
+
+
+def test_steps_without_predicted_decrease_are_rejected(capsys):
+    #a sketch of 5 rows for 61 parameters, so (SJ)^T SJ underestimates J^T J and pred < 0 happens
+    torch.manual_seed(0)
+    model = FullyConnectedNN(1,1,20,1).double()
+    x = torch.tensor(np.linspace(0,1,21).reshape(-1,1),dtype=torch.float64)
+    loss0 = float(loss_solving_poisson(real_solution,model,x))
+    capsys.readouterr()
+    model = LMTR_solving_poisson(real_solution,model,x,0.1,options=LMTR_params_options(step_solver='sketch',sketch_size=5),return_model=True)
+    output = capsys.readouterr().out
+    assert 'pred <= 0' in output
+    history = losses(output)
+    assert all(b <= a for a, b in zip(history,history[1:]))
+    assert float(loss_solving_poisson(real_solution,model,x)) < 1e-2*loss0
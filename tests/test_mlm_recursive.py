@@ -0,0 +1,80 @@
+import contextlib
+import io
+import numpy as np
+import pytest
+import torch
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN, to_functional_model
+from Multilevel_LM.main_lm.iteration_state import PoissonIterationState
+from Multilevel_LM.main_lm.loss_poisson import loss_solving_poisson
+from Multilevel_LM.main_lm.params_options import MLM_TR_params_options
+from Multilevel_LM.mlm_main import MLM_recursive as recursive
+from Multilevel_LM.mlm_main.MLM_recursive import MLM_recursive, _LevelObjective, _coarse_correction
+
+
+def real_solution_1d(x):
+    return torch.sin(x)
+
+
+def real_solution_2d(x):
+    return torch.sin(x[:,0])*torch.sin(x[:,1])
+
+
+def grid_2d(n):
+    t = np.linspace(0,1,n)
+    return torch.tensor(np.stack(np.meshgrid(t,t),-1).reshape(-1,2),dtype=torch.float64)
+
+
+def visited_levels(monkeypatch):
+    """
+    Levels on which _lm_steps runs, recorded through the width of the model.
+    """
+    widths = []
+    lm_steps = recursive._lm_steps
+    def record(state, *args):
+        widths.append(state.model.r_nodes_per_layer)
+        return lm_steps(state,*args)
+    monkeypatch.setattr(recursive,'_lm_steps',record)
+    return widths
+
+
+@pytest.mark.parametrize('cycle',['V','W'])
+def test_cycles_on_three_levels_1d(cycle, monkeypatch):
+    torch.manual_seed(0)
+    model = FullyConnectedNN(1,1,8,1).double()
+    x = torch.linspace(0,1,41,dtype=torch.float64).reshape(-1,1)
+    loss0 = float(loss_solving_poisson(real_solution_1d,model,x))
+    widths = visited_levels(monkeypatch)
+    options = MLM_TR_params_options(cycle=cycle,min_width=2,dtype=torch.float64)
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = MLM_recursive(real_solution_1d,model,x,0.1,options=options,return_model=True)
+    #widths 8 -> 4 -> 2
+    assert set(widths) == {8,4,2}
+    assert float(loss_solving_poisson(real_solution_1d,model,x)) < 1e-3*loss0
+    assert (model(x).flatten()-real_solution_1d(x).flatten()).abs().max() < 1e-2
+
+
+def test_v_cycle_on_two_levels_2d(monkeypatch):
+    torch.manual_seed(0)
+    model = FullyConnectedNN(2,1,8,1).double()
+    x = grid_2d(9)
+    loss0 = float(loss_solving_poisson(real_solution_2d,model,x))
+    widths = visited_levels(monkeypatch)
+    options = MLM_TR_params_options(max_levels=2,dtype=torch.float64)
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = MLM_recursive(real_solution_2d,model,x,0.1,options=options,return_model=True)
+    assert set(widths) == {8,4}
+    assert float(loss_solving_poisson(real_solution_2d,model,x)) < 1e-3*loss0
+
+
+def test_coarse_correction_does_not_increase_the_loss():
+    options = MLM_TR_params_options(max_levels=2,kappaH=0,epsilonH=0)
+    for seed in range(5):
+        torch.manual_seed(seed)
+        model = to_functional_model(FullyConnectedNN(1,2,8,1),torch.float64)
+        x = torch.linspace(0,1,21,dtype=torch.float64).reshape(-1,1)
+        state = PoissonIterationState(real_solution_1d,model,x)
+        with contextlib.redirect_stdout(io.StringIO()):
+            new_state, lambdak = _coarse_correction(state,_LevelObjective(),0.1,2,0,options)
+        assert new_state.loss <= state.loss
+        #a rejected coarse step increases lambdak
+        assert new_state is not state or lambdak > 0.1
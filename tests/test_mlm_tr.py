@@ -0,0 +1,112 @@
+import re
+import numpy as np
+import pytest
+import torch
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN, to_functional_model
+from Multilevel_LM.main_lm.iteration_state import PoissonIterationState
+from Multilevel_LM.main_lm.loss_poisson import loss_solving_poisson
+from Multilevel_LM.main_lm.params_options import MLM_TR_params_options
+from Multilevel_LM.mlm_main.average_strategies import average_nodes_model
+from Multilevel_LM.mlm_main.subsolver_two_level import restriction_operator, Taylor_H_re, GalerkinCoarseState
+from Multilevel_LM.mlm_main.MLM_TR import MLM_TR, coherence_correction
+
+
+def real_solution_1d(x):
+    return torch.sin(x)
+
+
+def coarse_problem(model, x, m=2):
+    """
+    Fine state, relinearized coarse state and first-order coherence term, as in MLM_TR.
+    """
+    state = PoissonIterationState(real_solution_1d,to_functional_model(model),x)
+    stateH = state.new_state(to_functional_model(average_nodes_model(model,m)))
+    correction = coherence_correction(restriction_operator(model,m),state.gradient,stateH)
+    return state, stateH, correction
+
+
+def test_coarse_pred_models_taylor_H_re():
+    torch.manual_seed(0)
+    model = FullyConnectedNN(1,1,8,1).double()
+    x = torch.linspace(0,1,21,dtype=torch.float64).reshape(-1,1)
+    lambdak = 0.1
+    state, stateH, correction = coarse_problem(model,x)
+    d = torch.randn(stateH.s_size,dtype=torch.float64)
+    d = d/torch.norm(d)
+    f0 = Taylor_H_re(real_solution_1d,model,x,lambdak,torch.zeros_like(d))
+    errors = []
+    for t in [1e-2,1e-3]:
+        sH = t*d
+        pred = stateH.taylor(torch.zeros_like(sH),lambdak)-stateH.taylor(sH,lambdak)-correction@sH
+        assert torch.allclose(pred,stateH.predicted_reduction(sH,lambdak)-correction@sH,rtol=1e-8)
+        true = f0-Taylor_H_re(real_solution_1d,model,x,lambdak,sH)
+        errors.append(float(abs(pred-true)/abs(pred)))
+    #the Gauss-Newton model agrees with the coarse function to first order
+    assert errors[1] < 1e-2
+    assert errors[1] < 0.2*errors[0]
+
+
+def real_solution_2d(x):
+    return torch.sin(x[:,0])*torch.sin(x[:,1])
+
+
+def grid_2d(n):
+    points = np.stack(np.meshgrid(np.linspace(0,1,n),np.linspace(0,1,n)),-1).reshape(-1,2)
+    return torch.tensor(points,dtype=torch.float32)
+
+
+def accepted_reductions(output, eta1=0.1):
+    """
+    ared of the accepted steps, from the lines 'ared pred' printed by MLM_TR.
+    """
+    reductions = []
+    for line in output.splitlines():
+        values = re.findall(r'tensor\(([-+0-9.e]+)',line)
+        if len(values) == 2:
+            ared, pred = map(float,values)
+            if pred > 0 and ared/pred >= eta1:
+                reductions.append(ared)
+    return reductions
+
+
+def test_relinearized_coarse_model_decreases_the_loss_2d(capsys):
+    torch.manual_seed(0)
+    model = FullyConnectedNN(2,1,16,1)
+    x = grid_2d(11)
+    loss0 = loss_solving_poisson(real_solution_2d,model,x).item()
+    final = MLM_TR(real_solution_2d,model,x,0.1,options=MLM_TR_params_options(),return_model=True)
+    reductions = accepted_reductions(capsys.readouterr().out)
+    assert reductions and min(reductions) >= 0
+    loss = loss_solving_poisson(real_solution_2d,final,x).item()
+    assert loss <= loss0
+    assert abs(loss-(loss0-sum(reductions))) <= 1e-3*loss0
+
+
+def test_coarse_grid_uses_the_same_acceptance_test(capsys):
+    #two hidden layers, relinearized coarse model on every other point of the grid
+    torch.manual_seed(0)
+    model = FullyConnectedNN(1,2,16,1)
+    x = torch.linspace(0,1,41).reshape(-1,1)
+    loss0 = loss_solving_poisson(real_solution_1d,model,x).item()
+    final = MLM_TR(real_solution_1d,model,x,0.1,options=MLM_TR_params_options(grid_stride=2),return_model=True)
+    reductions = accepted_reductions(capsys.readouterr().out)
+    assert reductions and min(reductions) >= 0
+    assert loss_solving_poisson(real_solution_1d,final,x).item() <= loss0
+    assert (final(x)-real_solution_1d(x)).abs().max() < 1
+
+
+def test_galerkin_new_state_is_rebuilt_from_the_fine_state():
+    torch.manual_seed(0)
+    model = to_functional_model(FullyConnectedNN(1,1,8,1),torch.float64)
+    x = torch.linspace(0,1,21,dtype=torch.float64).reshape(-1,1)
+    P = restriction_operator(model,2).t()
+    stateH = GalerkinCoarseState(PoissonIterationState(real_solution_1d,model,x),P)
+    sH = 1e-2*torch.randn(stateH.s_size,dtype=torch.float64)
+    new_model = model.step(P@sH)
+    new_stateH = stateH.new_state(new_model)
+    fine = PoissonIterationState(real_solution_1d,new_model,x)
+    assert torch.allclose(new_stateH.loss,fine.loss)
+    assert torch.allclose(new_stateH.J1,fine.J1@P)
+    assert torch.allclose(new_stateH.sub_b(),(P.t()@fine.sub_b()).reshape(new_stateH.sub_b().shape))
+    with pytest.raises(ValueError):
+        stateH.new_state(to_functional_model(average_nodes_model(model.to_module(),2)))
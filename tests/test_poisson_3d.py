@@ -0,0 +1,41 @@
+import contextlib
+import io
+import numpy as np
+import torch
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN
+from Multilevel_LM.main_lm.params_options import LMTR_params_options, MLM_TR_params_options
+from Multilevel_LM.main_lm.LMTR_poisson import LMTR_solving_poisson
+from Multilevel_LM.main_lm.loss_poisson import loss_solving_poisson, subsample_grid
+from Multilevel_LM.main_lm.collocation import collocation_set
+from Multilevel_LM.main_lm.PoissonPDE import PoissonPDE
+from Multilevel_LM.mlm_main.MLM_TR import MLM_TR
+
+
+def real_solution(x):
+    return torch.sin(x[:,0])*torch.sin(x[:,1])*torch.sin(x[:,2])
+
+
+def grid_3d(n):
+    t = np.linspace(0,1,n)
+    return torch.tensor(np.stack(np.meshgrid(t,t,t),-1).reshape(-1,3),dtype=torch.float64)
+
+
+def test_source_term_and_boundary_3d():
+    x = grid_3d(6)
+    source = PoissonPDE(real_solution,x).compute_source_term(x.clone())
+    assert torch.allclose(source.reshape(-1),3*real_solution(x))
+    points = collocation_set(x)
+    assert points.n_boundary == 6**3-4**3
+    assert subsample_grid(x,2).shape == (4**3,3)
+
+
+def test_lm_and_multilevel_lm_3d():
+    x = grid_3d(6)
+    for solver, options in [(LMTR_solving_poisson,LMTR_params_options(dtype=torch.float64)),
+                            (MLM_TR,MLM_TR_params_options(dtype=torch.float64,coarse_model='galerkin',grid_stride=2))]:
+        torch.manual_seed(0)
+        model = FullyConnectedNN(3,2,8,1).double()
+        loss0 = float(loss_solving_poisson(real_solution,model,x))
+        with contextlib.redirect_stdout(io.StringIO()):
+            model = solver(real_solution,model,x,0.1,options=options,return_model=True)
+        assert float(loss_solving_poisson(real_solution,model,x)) < 1e-3*loss0
@@ -0,0 +1,58 @@
+import numpy as np
+import torch
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN, to_functional_model
+from Multilevel_LM.main_lm.params_options import LMTR_params_options
+from Multilevel_LM.main_lm.iteration_state import PoissonIterationState
+from Multilevel_LM.main_lm.step_solvers import compute_lm_step
+
+
+def real_solution(x):
+    return torch.sin(x[:,0])*torch.sin(x[:,1])
+
+
+def real_solution_1d(x):
+    return torch.sin(x)
+
+
+def test_cg_iterations_of_the_preconditioners():
+    torch.manual_seed(0)
+    model = to_functional_model(FullyConnectedNN(2,1,20,1),torch.float64)
+    t = np.linspace(0,1,15)
+    x = torch.tensor(np.stack(np.meshgrid(t,t),-1).reshape(-1,2),dtype=torch.float64)
+    state = PoissonIterationState(real_solution,model,x,matrix_free=True)
+    s_direct = compute_lm_step(PoissonIterationState(real_solution,model,x),1e-3,LMTR_params_options())[0].flatten()
+    iterations = {}
+    for preconditioner in [None,'jacobi','nystrom']:
+        options = LMTR_params_options(step_solver='matrix_free',preconditioner=preconditioner,cg_tol=1e-8,cg_max_iter=5000)
+        s, info = compute_lm_step(state,1e-3,options)
+        assert torch.norm(s.flatten()-s_direct) < 1e-4*torch.norm(s_direct)
+        iterations[preconditioner] = info['iterations']
+    #the default (plain CG) is not worse than Jacobi, and Nystrom is the best
+    assert LMTR_params_options().preconditioner is None
+    assert iterations[None] <= iterations['jacobi']
+    assert iterations['nystrom'] <= iterations[None]
+
+
+def test_nystrom_approximation():
+    torch.manual_seed(0)
+    model = to_functional_model(FullyConnectedNN(1,1,8,1),torch.float64)
+    x = torch.linspace(0,1,21,dtype=torch.float64).reshape(-1,1)
+    J = PoissonIterationState(real_solution_1d,model,x).stacked_J
+    JTJ = J.T@J
+    for rank in [5,10]:
+        U, Lam = PoissonIterationState(real_solution_1d,model,x,matrix_free=True).nystrom(rank)
+        assert torch.allclose(U.T@U,torch.eye(rank,dtype=torch.float64),atol=1e-10)
+        assert torch.all(Lam[:-1] >= Lam[1:]) and torch.all(Lam >= 0)
+        #Nystrom underestimates JTJ: JTJ - U diag(Lam) U^T is positive semidefinite
+        E = JTJ-U@torch.diag(Lam)@U.T
+        assert torch.linalg.eigvalsh(0.5*(E+E.T)).min() > -1e-10*torch.norm(JTJ)
+    #with every column, it is JTJ, then the preconditioned CG converges at once
+    state = PoissonIterationState(real_solution_1d,model,x,matrix_free=True)
+    U, Lam = state.nystrom(100)
+    assert torch.allclose(U@torch.diag(Lam)@U.T,JTJ,atol=1e-8*torch.norm(JTJ))
+    assert state.nystrom(100)[0] is U
+    options = LMTR_params_options(step_solver='matrix_free',preconditioner='nystrom',nystrom_rank=100,cg_tol=1e-10)
+    s, info = compute_lm_step(state,1e-2,options)
+    s_direct = compute_lm_step(PoissonIterationState(real_solution_1d,model,x),1e-2,LMTR_params_options())[0]
+    assert torch.allclose(s.flatten(),s_direct.flatten(),rtol=1e-6,atol=1e-9)
+    assert info['iterations'] <= 2
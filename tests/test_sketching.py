@@ -0,0 +1,48 @@
+import numpy as np
+import torch
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN, to_functional_model
+from Multilevel_LM.main_lm.params_options import LMTR_params_options
+from Multilevel_LM.main_lm.iteration_state import PoissonIterationState
+from Multilevel_LM.main_lm.LMTR_poisson import LMTR_solving_poisson
+from Multilevel_LM.main_lm.loss_poisson import loss_solving_poisson
+from Multilevel_LM.main_lm.step_solvers import compute_lm_step
+
+
+def real_solution(x):
+    return torch.sin(x)
+
+
+def grid(n):
+    return torch.tensor(np.linspace(0,1,n).reshape(-1,1),dtype=torch.float64)
+
+
+def make_state(n):
+    torch.manual_seed(0)
+    model = to_functional_model(FullyConnectedNN(1,1,20,1),torch.float64)
+    return PoissonIterationState(real_solution,model,grid(n),regularization=True,lambdap=0.1)
+
+
+def test_sketch_not_smaller_than_J_is_the_exact_svd():
+    state = make_state(31)
+    assert state.n_rows <= 4*state.s_size
+    assert state.sketched_svd() is state.svd
+    s, info = compute_lm_step(state,0.1,LMTR_params_options(step_solver='sketch'))
+    s_exact, info = compute_lm_step(state,0.1,LMTR_params_options(step_solver='direct'))
+    assert torch.allclose(s,s_exact)
+
+
+def test_default_sketch_has_a_few_times_p_rows():
+    state = make_state(1001)
+    U, S, Vh = state.sketched_svd()
+    assert U.shape[0] == 4*state.s_size < state.n_rows
+
+
+def test_sketch_decreases_the_loss_with_fewer_rows_than_parameters(capsys):
+    #21 points and 61 parameters
+    torch.manual_seed(0)
+    model = FullyConnectedNN(1,1,20,1).double()
+    x = grid(21)
+    loss0 = float(loss_solving_poisson(real_solution,model,x))
+    for solver in ['sketch','sketch_lsqr']:
+        result = LMTR_solving_poisson(real_solution,model,x,0.1,options=LMTR_params_options(step_solver=solver),return_model=True)
+        assert float(loss_solving_poisson(real_solution,result,x)) < 1e-3*loss0
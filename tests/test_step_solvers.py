@@ -0,0 +1,85 @@
+import pytest
+import torch
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN, to_functional_model
+from Multilevel_LM.main_lm.params_options import LMTR_params_options
+from Multilevel_LM.main_lm.iteration_state import PoissonIterationState
+from Multilevel_LM.main_lm.step_solvers import STEP_SOLVERS, compute_lm_step
+from Multilevel_LM.main_lm.varpro import VarProState, eliminate_output_layer
+from Multilevel_LM.mlm_main.subsolver_two_level import GalerkinCoarseState, restriction_operator
+
+
+def real_solution(x):
+    return torch.sin(x)
+
+
+def make_state(kind):
+    """
+    Small LM subproblem (23 rows, at most 25 parameters, so 'sketch' is exact) 
+    on a fine, VarPro or Galerkin coarse state.
+    """
+    torch.manual_seed(0)
+    model = to_functional_model(FullyConnectedNN(1,1,8,1),torch.float64)
+    x = torch.linspace(0,1,21,dtype=torch.float64).reshape(-1,1)
+    state = PoissonIterationState(real_solution,model,x)
+    if kind == 'varpro':
+        return VarProState(eliminate_output_layer(state))
+    if kind == 'galerkin':
+        return GalerkinCoarseState(state,restriction_operator(model,2).t())
+    return state
+
+
+@pytest.mark.parametrize('solver',sorted(STEP_SOLVERS))
+@pytest.mark.parametrize('kind',['fine','varpro','galerkin'])
+@pytest.mark.parametrize('preconditioner',[None,'jacobi','nystrom'])
+def test_every_solver_matches_direct(solver, kind, preconditioner):
+    state = make_state(kind)
+    correction = 1e-3*torch.ones(state.s_size,dtype=torch.float64)
+    for c in [None,correction]:
+        s_direct = compute_lm_step(state,0.1,LMTR_params_options(step_solver='direct'),c)[0]
+        options = LMTR_params_options(step_solver=solver,preconditioner=preconditioner,nystrom_rank=5,cg_tol=1e-12,cg_max_iter=2000)
+        s, info = compute_lm_step(state,0.1,options,c)
+        assert s.shape == s_direct.shape
+        assert torch.allclose(s,s_direct,rtol=1e-6,atol=1e-9)
+        assert info['residual'] < 1e-6
+
+
+def test_unknown_solver():
+    options = LMTR_params_options()
+    options.step_solver = 'unknown'
+    with pytest.raises(ValueError):
+        compute_lm_step(make_state('fine'),0.1,options)
+
+
+@pytest.mark.parametrize('width',[8,30])
+def test_dual_form_matches_primal(width):
+    #8 hidden nodes: 23 rows and 25 parameters, 30 hidden nodes: 23 rows and 91 parameters
+    torch.manual_seed(0)
+    model = to_functional_model(FullyConnectedNN(1,1,width,1),torch.float64)
+    x = torch.linspace(0,1,21,dtype=torch.float64).reshape(-1,1)
+    state = PoissonIterationState(real_solution,model,x)
+    assert state.n_rows < state.s_size
+    correction = 1e-3*torch.ones(state.s_size,dtype=torch.float64)
+    for c in [None,correction]:
+        for lambdak in [1e-3,0.1,10]:
+            s_primal, info = compute_lm_step(state,lambdak,LMTR_params_options(step_solver='direct',direct_form='primal'),c)
+            assert info['form'] == 'primal'
+            s_dual, info = compute_lm_step(state,lambdak,LMTR_params_options(step_solver='direct',direct_form='dual'),c)
+            assert info['form'] == 'dual'
+            assert torch.allclose(s_dual,s_primal,rtol=1e-6,atol=1e-9)
+            assert compute_lm_step(state,lambdak,LMTR_params_options(step_solver='direct',direct_form='auto'),c)[1]['form'] == 'dual'
+
+
+@pytest.mark.parametrize('kind',['fine','varpro','galerkin'])
+def test_spectral_step_reuses_the_svd(kind, monkeypatch):
+    state = make_state(kind)
+    state.J1 #the Kaufman Jacobian of VarPro is built from an SVD as well
+    calls = []
+    svd = torch.linalg.svd
+    monkeypatch.setattr(torch.linalg,'svd',lambda *args, **kwargs: calls.append(1) or svd(*args,**kwargs))
+    correction = 1e-3*torch.ones(state.s_size,dtype=torch.float64)
+    for c in [None,correction]:
+        for lambdak in [1e-4,1e-2,1,100]:
+            s_direct = compute_lm_step(state,lambdak,LMTR_params_options(step_solver='direct'),c)[0]
+            s = compute_lm_step(state,lambdak,LMTR_params_options(step_solver='spectral'),c)[0]
+            assert torch.allclose(s,s_direct,rtol=1e-6,atol=1e-9)
+    assert len(calls) == 1
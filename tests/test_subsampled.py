@@ -0,0 +1,81 @@
+import torch
+import Multilevel_LM.main_lm.LMTR_poisson as L
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN
+from Multilevel_LM.main_lm.params_options import LMTR_params_options
+from Multilevel_LM.main_lm.LMTR_poisson import LMTR_subsampled_poisson, sample_rows
+from Multilevel_LM.main_lm.loss_poisson import loss_solving_poisson
+
+
+def real_solution(x):
+    return torch.sin(x)
+
+
+def setup():
+    torch.manual_seed(0)
+    model = FullyConnectedNN(1,1,8,1).double()
+    x = torch.linspace(0,1,201,dtype=torch.float64).reshape(-1,1)
+    return model, x
+
+
+def record(monkeypatch):
+    """
+    Sizes of the samples, and the arguments of the full-batch LMTR, which only returns its model.
+    """
+    sizes, full = [], []
+    monkeypatch.setattr(L,'sample_rows',lambda n, size, sampling='random': sizes.append((n,size)) or sample_rows(n,size,sampling))
+    monkeypatch.setattr(L,'LMTR_solving_poisson',lambda real_solution, model, x, lambdak, *args: full.append((model,lambdak)) or model)
+    return sizes, full
+
+
+def test_sample_rows():
+    for sampling in ['random','stratified']:
+        idx = sample_rows(100,10,sampling)
+        assert idx.numel() == 10 and idx.unique().numel() == 10
+        assert idx.min() >= 0 and idx.max() < 100
+        assert sample_rows(100,1000,sampling).numel() == 100
+    #one index in each stratum
+    assert torch.equal(sample_rows(100,10,'stratified')//10,torch.arange(10))
+
+
+def test_sample_grows_after_rejections_then_full_batch(monkeypatch):
+    model, x = setup()
+    sizes, full = record(monkeypatch)
+    #steps that increase the loss, so every step is rejected
+    monkeypatch.setattr(L,'compute_lm_step',lambda state, lambdak, options: (10*state.gradient,{}))
+    options = LMTR_params_options(batch_size=0.125)
+    LMTR_subsampled_poisson(real_solution,model,x,0.1,options=options)
+    #interior samples of 1/8, 1/4 and 1/2 of the rows, then the full set
+    n_interior = sizes[0][0]
+    assert [size for n, size in sizes[::2]] == [round(f*n_interior) for f in [0.125,0.25,0.5]]
+    assert len(full) == 1
+    #no step accepted, the full-batch LMTR starts from the initial model with lambdak increased 3 times
+    final_model, lambdak = full[0]
+    assert torch.equal(final_model.theta,torch.cat([p.detach().flatten() for p in model.parameters()]))
+    assert abs(lambdak-0.1*options.gamma3**3) < 1e-12
+
+
+def test_small_sample_gradient_falls_back_to_full_batch(monkeypatch):
+    model, x = setup()
+    sizes, full = record(monkeypatch)
+    options = LMTR_params_options()
+    options.epsilon = 1e10
+    LMTR_subsampled_poisson(real_solution,model,x,0.1,options=options)
+    assert len(sizes) == 2 and len(full) == 1
+    assert full[0][1] == 0.1
+
+
+def test_subsampled_steps_decrease_the_loss(monkeypatch):
+    model, x = setup()
+    sizes, full = record(monkeypatch)
+    loss0 = float(loss_solving_poisson(real_solution,model,x))
+    LMTR_subsampled_poisson(real_solution,model,x,0.1,options=LMTR_params_options(batch_size=0.25))
+    #the iterate handed to the full-batch LMTR comes from the sampled steps only
+    assert len(full) == 1
+    assert float(loss_solving_poisson(real_solution,full[0][0].to_module(),x)) < 0.5*loss0
+
+
+def test_subsampled_lmtr_converges(capsys):
+    model, x = setup()
+    loss0 = float(loss_solving_poisson(real_solution,model,x))
+    model = LMTR_subsampled_poisson(real_solution,model,x,0.1,options=LMTR_params_options(batch_size=0.25,sampling='stratified'),return_model=True)
+    assert float(loss_solving_poisson(real_solution,model,x)) < 1e-3*loss0
@@ -0,0 +1,33 @@
+import torch
+from Multilevel_LM.main_lm import target_data
+from Multilevel_LM.main_lm.target_data import PoissonTarget
+
+K = 1.0
+
+
+def real_solution(x):
+    return torch.sin(K*x)
+
+
+def test_key_follows_the_module_level_names():
+    global K
+    K = 1.0
+    key = PoissonTarget(real_solution)._key
+    x = torch.linspace(0,1,11,dtype=torch.float64).reshape(-1,1)
+    source = PoissonTarget(real_solution).source(x)
+    K = 2.0
+    try:
+        assert PoissonTarget(real_solution)._key != key
+        #f = k^2 sin(kx), not the cached value of k = 1
+        assert torch.allclose(PoissonTarget(real_solution).source(x),4*torch.sin(2*x))
+        assert torch.allclose(source,torch.sin(x))
+    finally:
+        K = 1.0
+    assert PoissonTarget(real_solution)._key == key
+
+
+def test_memory_cache_is_bounded():
+    target = PoissonTarget(real_solution)
+    for n in range(target_data._TARGET_CACHE_SIZE+5):
+        target.boundary_values(torch.full((2,1),float(n),dtype=torch.float64))
+    assert len(target_data._TARGET_CACHE) == target_data._TARGET_CACHE_SIZE
@@ -0,0 +1,21 @@
+import pytest
+import torch
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN, to_functional_model
+from Multilevel_LM.main_lm.PoissonPDE import PoissonPDE
+
+
+@pytest.mark.parametrize('input_dim',[1,2,3])
+def test_functional_model_source_term_is_taylor_mode(input_dim):
+    torch.manual_seed(0)
+    model = to_functional_model(FullyConnectedNN(input_dim,2,8,1),torch.float64)
+    x = torch.rand(30,input_dim,dtype=torch.float64)
+    #the same network without forward_taylor, so PoissonPDE uses nested autograd
+    autograd_source = PoissonPDE(lambda x: model(x),x).compute_source_term(x.clone())
+    source = PoissonPDE(model,x).compute_source_term(x)
+    assert not x.requires_grad
+    assert torch.allclose(source.reshape(-1),autograd_source.reshape(-1))
+    u, grad_u, laplacian_u = model.forward_taylor(x)
+    assert torch.allclose(u,model(x))
+    assert torch.allclose(u,model.to_module()(x))
+    #theta + s is used, not the parameters of the template module
+    assert not torch.allclose(model.step(torch.ones_like(model.theta)).forward_taylor(x)[2],laplacian_u)
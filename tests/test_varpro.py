@@ -0,0 +1,60 @@
+import contextlib
+import io
+import numpy as np
+import pytest
+import torch
+from Multilevel_LM.main_lm.neural_network_construction import FullyConnectedNN, to_functional_model
+from Multilevel_LM.main_lm.params_options import LMTR_params_options
+from Multilevel_LM.main_lm.iteration_state import PoissonIterationState
+from Multilevel_LM.main_lm.LMTR_poisson import LMTR_solving_poisson
+from Multilevel_LM.main_lm.loss_poisson import loss_solving_poisson
+from Multilevel_LM.main_lm.step_solvers import compute_lm_step
+from Multilevel_LM.main_lm.varpro import VarProState, eliminate_output_layer, output_layer_mask
+
+SOLVERS = [('direct',{}),('spectral',{}),('cholesky',{}),('matrix_free',{'preconditioner':'jacobi'}),
+           ('pcg',{'preconditioner':'nystrom','nystrom_rank':5}),('minres',{'preconditioner':'jacobi'}),
+           ('scipy_cg',{'preconditioner':'jacobi'}),('lsqr',{}),('sketch_lsqr',{})]
+
+
+def real_solution(x):
+    return torch.sin(x[:,0])*torch.sin(x[:,1])
+
+
+def grid_2d(n):
+    t = np.linspace(0,1,n)
+    return torch.tensor(np.stack(np.meshgrid(t,t),-1).reshape(-1,2),dtype=torch.float64)
+
+
+def varpro_state():
+    torch.manual_seed(0)
+    model = to_functional_model(FullyConnectedNN(2,1,6,1),torch.float64)
+    state = eliminate_output_layer(PoissonIterationState(real_solution,model,grid_2d(7)))
+    return state, VarProState(state)
+
+
+def test_output_layer_is_optimal():
+    state, sub_state = varpro_state()
+    mask = output_layer_mask(state.model)
+    assert torch.norm(state.gradient[mask]) < 1e-10*torch.norm(state.gradient)+1e-12
+    #sub_b is the gradient of the loss w.r.t. the hidden parameters
+    assert torch.allclose(sub_state.sub_b().flatten(),state.gradient[~mask],atol=1e-10)
+
+
+@pytest.mark.parametrize('solver,kwargs',SOLVERS)
+def test_varpro_step_matches_direct(solver,kwargs):
+    state, sub_state = varpro_state()
+    s_direct = compute_lm_step(sub_state,0.1,LMTR_params_options(step_solver='direct'))[0]
+    s = compute_lm_step(VarProState(state),0.1,LMTR_params_options(step_solver=solver,cg_tol=1e-10,**kwargs))[0]
+    assert s.numel() == sub_state.s_size
+    assert torch.allclose(s.flatten(),s_direct.flatten(),rtol=1e-5,atol=1e-8)
+
+
+@pytest.mark.parametrize('solver,kwargs',SOLVERS)
+def test_varpro_lm_decreases_the_loss(solver,kwargs):
+    torch.manual_seed(0)
+    model = FullyConnectedNN(2,1,6,1).double()
+    x = grid_2d(7)
+    loss0 = float(loss_solving_poisson(real_solution,model,x))
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = LMTR_solving_poisson(real_solution,model,x,0.1,options=LMTR_params_options(step_solver=solver,varpro=True,**kwargs),return_model=True)
+    assert float(loss_solving_poisson(real_solution,model,x)) < 1e-3*loss0